@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark the sockpuppet collection pipeline on synthetic socket tables.
+
+Generates ss2 style JSON with a configurable number of flows, port and
+address distributions, and times each stage of a scrape:
+
+- fetch: read the raw ss2 output from a subprocess
+- parse: stream parse the output
+- match: match every socket against the flow definitions
+- extract: create the metric samples of the matched sockets
+- render: render the exposition text
+- scrape: a complete collect() and render, with peak memory on python 3
+
+Example::
+
+    python benchmarks/bench_collect.py --flows 1000 10000 100000 \\
+        --rules example many:200 --output results.json
+"""
+from __future__ import division, print_function, absolute_import
+
+import argparse
+import gc
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:  # python2
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from prometheus_client.core import CollectorRegistry  # noqa: E402
+from prometheus_client.exposition import generate_latest  # noqa: E402
+
+from sockpuppet import cli  # noqa: E402
+from sockpuppet.columnar import ENGINE_COLUMNAR, ENGINE_PYTHON  # noqa: E402
+from sockpuppet.collector import BACKEND_SS2, ScrapeContext, \
+    SockPuppetCollector, TCPFlowContext, read_ss2_output  # noqa: E402
+
+CONFIG_DIR = os.path.join(os.path.dirname(__file__), "..", "config")
+
+PORT_DISTRIBUTIONS = ("ceph", "uniform", "ephemeral")
+
+
+def random_address(rng, pool):
+    return "10.{}.{}.{}".format(*[rng.randint(0, 255) for _ in range(3)]) \
+        if pool is None else rng.choice(pool)
+
+
+def random_ports(rng, distribution):
+    ephemeral = rng.randint(32768, 60999)
+    if distribution == "ceph":
+        # most sockets talk to OSDs, a few to the monitors
+        if rng.random() < 0.9:
+            service = rng.randint(6800, 7300)
+        else:
+            service = 6789
+    elif distribution == "uniform":
+        service = rng.randint(1, 65535)
+    else:
+        service = rng.randint(1, 1024)
+    if rng.random() < 0.5:
+        return ephemeral, service
+    return service, ephemeral
+
+
+def make_flow(rng, index, distribution, pool):
+    src_port, dst_port = random_ports(rng, distribution)
+    return {
+        "src": random_address(rng, pool),
+        "dst": random_address(rng, pool),
+        "src_port": src_port,
+        "dst_port": dst_port,
+        "inode": 100000 + index,
+        "iface_idx": 0,
+        "retrans": 0,
+        "meminfo": {"r": 0, "w": rng.randint(0, 4096), "f": 4096,
+                    "t": rng.randint(0, 4096)},
+        "tcp_info": {
+            "state": "established",
+            "opts": ["ts", "sack"],
+            "rto": 204.0,
+            "ato": 40.0,
+            "snd_mss": 1448,
+            "rcv_mss": 1448,
+            "rtt": round(rng.uniform(0.05, 50), 3),
+            "rttvar": round(rng.uniform(0.01, 10), 3),
+            "snd_cwnd": rng.randint(1, 100),
+            "rcv_rtt": round(rng.uniform(0, 100), 3),
+            "total_retrans": rng.randint(0, 10),
+            "pacing_rate": rng.randint(0, 10 ** 9),
+            "bytes_acked": rng.randint(0, 10 ** 10),
+            "bytes_received": rng.randint(0, 10 ** 10),
+            "notsent_bytes": rng.randint(0, 10 ** 5),
+            "min_rtt": rng.randint(10, 50000),
+            "delivery_rate": rng.randint(0, 10 ** 9),
+            "busy_time": rng.randint(0, 10 ** 9),
+            "rwnd_limited": 0,
+            "sndbuf_limited": 0,
+        },
+        "cong_algo": "cubic",
+        "usr_ctxt": {
+            "ceph": {
+                str(1000 + index % 64): {
+                    "full_cmd": ["/usr/bin/ceph-osd", "-f", "--cluster",
+                                 "ceph", "--id", str(index % 64)],
+                    "cmd": "/usr/bin/ceph-osd",
+                    "fds": [index % 1000],
+                },
+            },
+        },
+    }
+
+
+def make_ss2_output(flows, distribution="ceph", addresses=256, seed=0):
+    """Return synthetic ss2 -a -t -p output as bytes"""
+    rng = random.Random(seed)
+    pool = None
+    if addresses:
+        pool = [random_address(rng, None) for _ in range(addresses)]
+    table = {"TCP": {"flows": [make_flow(rng, i, distribution, pool)
+                               for i in range(flows)]}}
+    return json.dumps(table).encode("utf-8")
+
+
+class Config(object):
+    """Stand-in for a loaded config module"""
+
+    def __init__(self, flow_definitions, engine=ENGINE_PYTHON):
+        self.flow_definitions = flow_definitions
+        self.engine = engine
+
+
+def make_config(rules):
+    """Build a config from a rule set name
+
+    ``example`` and ``sample`` load the configs in ``config/``, ``many:N``
+    generates N single port flows.
+    """
+    if rules == "example":
+        return cli.load_config(os.path.join(CONFIG_DIR, "config_example.py"))
+    if rules == "sample":
+        return cli.load_config(os.path.join(CONFIG_DIR,
+                                            "config_sample_1.py"))
+    if rules.startswith("many:"):
+        count = int(rules.split(":", 1)[1])
+        flows = []
+        for i in range(count):
+            port = 6800 + i
+            flows.append({"flow": "in-{}".format(port), "src_port": port})
+            flows.append({"flow": "out-{}".format(port), "dst_port": port})
+        return Config([{"class": "many", "flows": flows}])
+    raise ValueError("unknown rule set: {}".format(rules))
+
+
+class Families(object):
+    """A registry stand-in that yields already collected families"""
+
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return iter(self.families)
+
+
+# python2 has no perf_counter
+_timer = getattr(time, "perf_counter", time.time)
+
+
+def timed(func, repeat):
+    """Return the result of func and its best wall time over repeat runs"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        start = _timer()
+        result = func()
+        elapsed = _timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def run_case(flows, distribution, rules, repeat, workdir,
+             engine=ENGINE_PYTHON):
+    raw = make_ss2_output(flows, distribution)
+    path = os.path.join(workdir, "ss2.json")
+    with open(path, "wb") as f:
+        f.write(raw)
+    config = make_config(rules)
+    config.engine = engine
+    collector = SockPuppetCollector(config)
+    collector.context.backend = BACKEND_SS2
+    collector.context.process = False
+    # scrapes match while parsing, here parse and match are timed apart
+    flow_filter = collector.context.flow_filter
+    collector.context.flow_filter = None
+    stages = {}
+
+    def fetch():
+        return subprocess.check_output(["cat", path])
+
+    _, stages["fetch"] = timed(fetch, repeat)
+
+    def parse():
+        return read_ss2_output(io.BytesIO(raw), collector.context)
+
+    stats, stages["parse"] = timed(parse, repeat)
+    parsed = stats["TCP"]["flows"]
+
+    def match():
+        if collector.engine == ENGINE_COLUMNAR:
+            return collector.match_columnar(parsed)
+        return [TCPFlowContext(collector.matcher, flow) for flow in parsed]
+
+    contexts, stages["match"] = timed(match, repeat)
+    matched = [x for x in contexts if x.should_collect()]
+
+    def extract():
+        scrape = ScrapeContext(collector.metrics())
+        collector.state.begin(time.time())
+        if collector.engine == ENGINE_COLUMNAR:
+            collector.process_columnar(matched, scrape)
+        else:
+            for context in matched:
+                collector.process_tcp_context(context, scrape)
+        collector.state.end()
+        scrape.aggregator.flush()
+        return scrape
+
+    _, stages["extract"] = timed(extract, repeat)
+
+    collector.context.flow_filter = flow_filter
+    import sockpuppet.collector as module
+    original = module.get_socket_stats
+    module.get_socket_stats = lambda _context: stats
+    try:
+        families = list(collector.collect())
+    finally:
+        module.get_socket_stats = original
+    output, stages["render"] = timed(
+        lambda: generate_latest(Families(families)), repeat)
+
+    # a complete scrape through a fake ss2 binary on the PATH
+    registry = CollectorRegistry(auto_describe=False)
+    registry.register(collector)
+    fake_ss2 = os.path.join(workdir, "ss2")
+    with open(fake_ss2, "w") as f:
+        f.write("#!/bin/sh\nexec cat {}\n".format(path))
+    os.chmod(fake_ss2, 0o755)
+    old_path = os.environ.get("PATH", "")
+    os.environ["PATH"] = workdir + os.pathsep + old_path
+    try:
+        _, stages["scrape"] = timed(lambda: generate_latest(registry),
+                                    repeat)
+        peak = None
+        if tracemalloc is not None:
+            gc.collect()
+            tracemalloc.start()
+            generate_latest(registry)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    finally:
+        os.environ["PATH"] = old_path
+
+    return {
+        "engine": collector.engine,
+        "flows": flows,
+        "ports": distribution,
+        "rules": rules,
+        "matched": len(matched),
+        "series": output.count(b"\n") - output.count(b"\n#"),
+        "seconds": stages,
+        "peak_memory_bytes": peak,
+    }
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the sockpuppet collection pipeline")
+    parser.add_argument("--flows", type=int, nargs="+",
+                        default=[1000, 10000, 50000],
+                        help="socket table sizes to benchmark")
+    parser.add_argument("--ports", nargs="+", default=["ceph"],
+                        choices=PORT_DISTRIBUTIONS,
+                        help="port distributions of the synthetic sockets")
+    parser.add_argument("--rules", nargs="+", default=["example"],
+                        help="rule sets: example, sample or many:N")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per stage, the best time is reported")
+    parser.add_argument("--engine", nargs="+", default=[ENGINE_PYTHON],
+                        choices=[ENGINE_PYTHON, ENGINE_COLUMNAR],
+                        help="collection engines to benchmark")
+    parser.add_argument("--output", default=None,
+                        help="write the results as JSON to this file")
+    return parser.parse_args(args)
+
+
+def main(args):
+    args = parse_args(args)
+    results = []
+    workdir = tempfile.mkdtemp(prefix="sockpuppet-bench-")
+    try:
+        cases = itertools.product(args.engine, args.rules, args.ports,
+                                  args.flows)
+        for engine, rules, distribution, flows in cases:
+            result = run_case(flows, distribution, rules, args.repeat,
+                              workdir, engine)
+            results.append(result)
+            print("{engine:>8} {rules:>10} {ports:>9} {flows:>7} flows "
+                  "{matched:>7} matched ".format(**result) +
+                  " ".join("{}={:.4f}s".format(k, v) for k, v in
+                           sorted(result["seconds"].items())) +
+                  ("" if result["peak_memory_bytes"] is None else
+                   " peak={:.1f}MiB".format(
+                       result["peak_memory_bytes"] / 2.0 ** 20)))
+    finally:
+        shutil.rmtree(workdir)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": sys.version, "results": results}, f,
+                      indent=2, sort_keys=True)
+    return results
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,11 +4,13 @@ flow_definitions = [
         "flows": [
             {
                 "flow": "vpn-inbound",
-                "src_port": 1194
+                "src_port": 1194,
+                "protocol": ["tcp", "udp"],
             },
             {
                 "flow": "vpn-outbound",
-                "dst_port": 1194
+                "dst_port": 1194,
+                "protocol": ["tcp", "udp"],
             },
         ],
     },
@@ -0,0 +1,124 @@
+"""Flow level aggregation of per-socket samples
+
+A flow definition, or an individual flow, may contain an ``aggregate``
+section to collapse the per-socket series of the matching sockets::
+
+    {
+        "class": "ceph",
+        "aggregate": {
+            # labels to keep in addition to class and flow
+            "labels": ["dst"],
+            # how to combine gauges: sum, max, mean or count
+            "gauge": "max",
+        },
+        "flows": [...],
+    }
+
+Counters are always summed. Labels that are aggregated away are exported
+with an empty value, which Prometheus treats the same as a missing label.
+"""
+
+GAUGE_AGGREGATIONS = ("sum", "max", "mean", "count")
+
+# labels that are never aggregated away
+_FLOW_LABELS = ("class", "flow")
+
+
+class Aggregation(object):
+
+    def __init__(self, spec, label_names):
+        labels = spec.get("labels", [])
+        for label in labels:
+            if label not in label_names:
+                raise ValueError(
+                    "cannot aggregate by unknown label: {}".format(label))
+        self.keep = [x in labels or x in _FLOW_LABELS for x in label_names]
+        self.gauge = spec.get("gauge", "sum")
+        if self.gauge not in GAUGE_AGGREGATIONS:
+            raise ValueError("unknown gauge aggregation: {}, expected one "
+                             "of {}".format(self.gauge, GAUGE_AGGREGATIONS))
+
+    def key(self, label_values):
+        return tuple(value if keep else ""
+                     for value, keep in zip(label_values, self.keep))
+
+
+def flow_aggregations(definitions, label_names):
+    """Return the Aggregation for each flow, in definition order
+
+    Flows that are not aggregated have an entry of None.
+    """
+    result = []
+    for flow_definition in definitions:
+        default = flow_definition.get("aggregate")
+        for flow in flow_definition["flows"]:
+            spec = flow.get("aggregate", default)
+            result.append(Aggregation(spec, label_names) if spec else None)
+    return result
+
+
+class _Series(object):
+    __slots__ = ("total", "maximum", "count", "how")
+
+    def __init__(self, how):
+        self.total = 0
+        self.maximum = None
+        self.count = 0
+        self.how = how
+
+    def add(self, value):
+        self.total += value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        self.count += 1
+
+    def merge(self, total, maximum, count):
+        self.total += total
+        if self.maximum is None or maximum > self.maximum:
+            self.maximum = maximum
+        self.count += count
+
+    def value(self):
+        if self.how == "max":
+            return self.maximum
+        if self.how == "mean":
+            return self.total / float(self.count)
+        if self.how == "count":
+            return self.count
+        return self.total
+
+
+class Aggregator(object):
+    """Accumulates aggregated samples for a single scrape"""
+
+    def __init__(self):
+        self.families = {}
+
+    def _series(self, metric, aggregation, key):
+        how = "sum" if metric.type == "counter" else aggregation.gauge
+        family = self.families.setdefault(id(metric), (metric, {}))[1]
+        series = family.get((how, key))
+        if series is None:
+            series = family[how, key] = _Series(how)
+        return series
+
+    def add(self, metric, aggregation, label_values, value):
+        self._series(metric, aggregation,
+                     aggregation.key(label_values)).add(value)
+
+    def merge(self, metric, aggregation, key, total, maximum, count):
+        """Add a partial result computed elsewhere, see
+        :func:`sockpuppet.columnar.group_reduce`
+
+        Args:
+          key (tuple): the label values, as returned by
+            :meth:`Aggregation.key`
+        """
+        self._series(metric, aggregation, key).merge(total, maximum, count)
+
+    def flush(self):
+        """Add the aggregated samples to their metric families"""
+        for metric, family in self.families.values():
+            for (_, labels), series in family.items():
+                metric.add_metric(list(labels), series.value())
+        self.families = {}
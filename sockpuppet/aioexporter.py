@@ -0,0 +1,208 @@
+"""Asyncio HTTP exporter that coalesces concurrent scrapes
+
+Every scrape served by ``prometheus_client.start_http_server`` runs its own
+collection. With several Prometheus servers, or federation, polling the same
+node this multiplies the cost of a scrape. :class:`AsyncExporter` instead
+shares one in-flight collection between all the scrapes that arrive while
+it runs (single-flight), and can keep serving its result for a short window
+afterwards. Responses are gzip compressed for clients that accept it, at
+most once per collection, and connections are kept alive between scrapes.
+
+Requires Python 3.
+"""
+import asyncio
+import gzip
+import logging
+import threading
+import time
+
+from prometheus_client.exposition import CONTENT_TYPE_LATEST
+
+_logger = logging.getLogger(__name__)
+
+# seconds an idle keep-alive connection is kept open
+DEFAULT_IDLE_TIMEOUT = 60.0
+
+_MAX_HEADERS = 100
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class _Output(object):
+    """The result of one collection, with its compressed form"""
+
+    def __init__(self, body):
+        self.body = body
+        self._compressed = None
+
+    def compressed(self):
+        if self._compressed is None:
+            self._compressed = gzip.compress(self.body)
+        return self._compressed
+
+
+class AsyncExporter(object):
+    """Serves the exposition produced by a blocking render function
+
+    Args:
+      render (callable): returns the exposition as bytes, or None when there
+        is nothing to serve (answered with 503). Runs in a worker thread.
+      window (float): seconds for which a finished collection is also served
+        to scrapes that arrive after it, 0 only shares in-flight ones
+      idle_timeout (float): seconds before idle connections are closed
+    """
+
+    def __init__(self, render, window=0.0, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 clock=time.monotonic):
+        self.render = render
+        self.window = window
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.pending = None
+        # (output, time the collection finished)
+        self.result = None
+        # number of times render was called
+        self.collections = 0
+
+    async def output(self):
+        """Return the output of the current or a new collection"""
+        if self.result is not None:
+            output, finished = self.result
+            if self.clock() - finished < self.window:
+                return output
+        if self.pending is None:
+            self.pending = asyncio.ensure_future(self._collect())
+        # a client going away must not cancel the collection of the others
+        return await asyncio.shield(self.pending)
+
+    async def _collect(self):
+        loop = asyncio.get_event_loop()
+        self.collections += 1
+        try:
+            body = await loop.run_in_executor(None, self.render)
+            output = _Output(body) if body is not None else None
+            self.result = (output, self.clock())
+            return output
+        finally:
+            self.pending = None
+
+    async def _respond(self, method, headers):
+        """Return (status, extra headers, body) for a request"""
+        if method not in ("GET", "HEAD"):
+            return 405, [], b""
+        try:
+            output = await self.output()
+        except Exception:
+            _logger.exception("Failed to collect metrics")
+            return 500, [], b""
+        if output is None:
+            return 503, [], b"Metrics are not available\n"
+        extra = [("Content-Type", CONTENT_TYPE_LATEST)]
+        encodings = [x.split(";")[0].strip() for x in
+                     headers.get("accept-encoding", "").split(",")]
+        if "gzip" in encodings:
+            extra.append(("Content-Encoding", "gzip"))
+            body = output.compressed()
+        else:
+            body = output.body
+        return 200, extra, body
+
+    async def handle(self, reader, writer):
+        """Serve the HTTP requests of one connection"""
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(reader.readline(),
+                                                     self.idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not request:
+                    break
+                headers = {}
+                for _ in range(_MAX_HEADERS):
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                parts = request.decode("latin-1").split()
+                if len(parts) != 3:
+                    self._write(writer, 400, [], b"", False, False)
+                    break
+                method, _, version = parts
+                length = int(headers.get("content-length", 0) or 0)
+                if length:
+                    await reader.readexactly(length)
+                connection = headers.get("connection", "").lower()
+                if version == "HTTP/1.0":
+                    keep_alive = connection == "keep-alive"
+                else:
+                    keep_alive = connection != "close"
+                status, extra, body = await self._respond(method, headers)
+                self._write(writer, status, extra, body, keep_alive,
+                            method == "HEAD")
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _write(self, writer, status, extra, body, keep_alive, head):
+        lines = ["HTTP/1.1 {} {}".format(status, _REASONS[status])]
+        for name, value in extra:
+            lines.append("{}: {}".format(name, value))
+        lines.append("Content-Length: {}".format(len(body)))
+        lines.append("Connection: {}".format(
+            "keep-alive" if keep_alive else "close"))
+        header = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        writer.write(header if head else header + body)
+
+
+class AsyncServer(object):
+    """Runs an :class:`AsyncExporter` on an event loop in a daemon thread"""
+
+    def __init__(self, exporter, port, addr=""):
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            self._start(exporter, addr, port))
+        self.server_address = self.server.sockets[0].getsockname()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name="sockpuppet-http")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @staticmethod
+    async def _start(exporter, addr, port):
+        return await asyncio.start_server(exporter.handle, addr or None,
+                                          port)
+
+    @staticmethod
+    async def _cancel():
+        tasks = [x for x in asyncio.all_tasks()
+                 if x is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.server.close()
+        # close the idle keep-alive connections
+        self.loop.run_until_complete(self._cancel())
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+
+def start_async_server(exporter, port, addr=""):
+    """Serve an :class:`AsyncExporter` over HTTP from a daemon thread"""
+    return AsyncServer(exporter, port, addr)
@@ -0,0 +1,240 @@
+"""Compile flow definitions into an inet_diag bytecode filter
+
+The kernel runs the filter against every socket while dumping, so only
+sockets that could match one of the configured flows are sent back to us.
+The filter is a pre-filter: sockets that pass it are still checked by
+:class:`sockpuppet.matcher.FlowMatcher`. Selectors that cannot be expressed
+in bytecode are therefore treated as matching everything.
+"""
+import logging
+import struct
+
+from sockpuppet.matcher import PROTOCOL_TCP, flow_protocols, \
+    parse_port_range
+from sockpuppet.prefixes import parse_prefix
+
+try:
+    xrange = xrange
+except NameError:  # python3
+    xrange = range
+
+_logger = logging.getLogger(__name__)
+
+INET_DIAG_BC_NOP = 0
+INET_DIAG_BC_JMP = 1
+INET_DIAG_BC_S_GE = 2
+INET_DIAG_BC_S_LE = 3
+INET_DIAG_BC_D_GE = 4
+INET_DIAG_BC_D_LE = 5
+INET_DIAG_BC_S_COND = 7
+INET_DIAG_BC_D_COND = 8
+
+# jump offsets are stored in a u16
+MAX_BYTECODE_LEN = 0xffff
+
+_OP = struct.Struct("=BBH")
+_HOSTCOND = struct.Struct("=BBxxi")
+
+_PORT_OPS = {
+    "src_port": (INET_DIAG_BC_S_GE, INET_DIAG_BC_S_LE),
+    "dst_port": (INET_DIAG_BC_D_GE, INET_DIAG_BC_D_LE),
+}
+
+_ADDRESS_OPS = {
+    "src": INET_DIAG_BC_S_COND,
+    "dst": INET_DIAG_BC_D_COND,
+}
+
+TRUE = ("true",)
+FALSE = ("false",)
+
+
+class UnsupportedSelector(Exception):
+    pass
+
+
+def _and(children):
+    children = [x for x in children if x is not TRUE]
+    if FALSE in children:
+        return FALSE
+    if not children:
+        return TRUE
+    if len(children) == 1:
+        return children[0]
+    return ("and", children)
+
+
+def _or(children):
+    children = [x for x in children if x is not FALSE]
+    if TRUE in children:
+        return TRUE
+    if not children:
+        return FALSE
+    if len(children) == 1:
+        return children[0]
+    return ("or", children)
+
+
+def _port_range(item, minimum, maximum):
+    ge, le = _PORT_OPS[item]
+    return _and([
+        ("cond", ge, _OP.pack(0, 0, minimum)),
+        ("cond", le, _OP.pack(0, 0, maximum)),
+    ])
+
+
+def _port_set(item, ports):
+    ports = sorted(set(ports))
+    ranges = []
+    for port in ports:
+        if ranges and ranges[-1][1] == port - 1:
+            ranges[-1][1] = port
+        else:
+            ranges.append([port, port])
+    return _or([_port_range(item, lo, hi) for lo, hi in ranges])
+
+
+def _port_expr(item, value):
+    if isinstance(value, int):
+        return _port_range(item, value, value)
+    if isinstance(value, xrange):
+        if value.step == 1 and len(value):
+            return _port_range(item, value[0], value[-1])
+        return _port_set(item, value)
+    if isinstance(value, (set, frozenset)):
+        if not all(isinstance(x, int) for x in value):
+            raise UnsupportedSelector(value)
+        return _port_set(item, value)
+    if isinstance(value, str) and ":" in value:
+        return _port_range(item, *parse_port_range(value))
+    raise UnsupportedSelector(value)
+
+
+def _hostcond(item, address):
+    # IPv4 conditions also match IPv4-mapped addresses of IPv6 sockets
+    prefix = parse_prefix(address)
+    if prefix is None:
+        raise UnsupportedSelector(address)
+    family, packed, length = prefix
+    payload = _HOSTCOND.pack(family, length, -1) + packed
+    return ("cond", _ADDRESS_OPS[item], payload)
+
+
+def _address_expr(item, value):
+    if isinstance(value, str):
+        return _hostcond(item, value)
+    if isinstance(value, (set, frozenset)):
+        return _or([_hostcond(item, x) for x in value])
+    raise UnsupportedSelector(value)
+
+
+def _selector_expr(item, value):
+    try:
+        if item in _PORT_OPS:
+            return _port_expr(item, value)
+        return _address_expr(item, value)
+    except UnsupportedSelector:
+        _logger.info("{} selector {!r} cannot be filtered in the kernel, "
+                     "it will be matched in sockpuppet".format(item, value))
+        return TRUE
+
+
+def flow_definitions_expr(definitions, protocol=PROTOCOL_TCP):
+    """Build a filter expression equivalent to (or looser than) find_flow"""
+    flows = []
+    for flow_definition in definitions:
+        for flow in flow_definition["flows"]:
+            if protocol not in flow_protocols(flow):
+                continue
+            flows.append(_and([
+                _selector_expr(item, flow[item])
+                for item in list(_PORT_OPS) + list(_ADDRESS_OPS)
+                if item in flow
+            ]))
+    return _or(flows)
+
+
+class _Label(object):
+    pass
+
+
+def _emit(expr, fail, program):
+    """Emit code that falls through on success and jumps to fail otherwise"""
+    kind = expr[0]
+    if kind == "cond":
+        program.append(("cond", expr[1], expr[2], fail))
+    elif kind == "false":
+        program.append(("jmp", fail))
+    elif kind == "and":
+        for child in expr[1]:
+            _emit(child, fail, program)
+    elif kind == "or":
+        ok = _Label()
+        for child in expr[1][:-1]:
+            next_ = _Label()
+            _emit(child, next_, program)
+            program.append(("jmp", ok))
+            program.append(("label", next_))
+        _emit(expr[1][-1], fail, program)
+        program.append(("label", ok))
+
+
+def assemble(expr):
+    """Assemble a filter expression into inet_diag bytecode
+
+    Returns:
+      bytes: the bytecode, or None if the expression accepts every socket
+    """
+    if expr is TRUE:
+        return None
+    reject = _Label()
+    program = []
+    _emit(expr, reject, program)
+
+    offsets = {}
+    position = 0
+    for instruction in program:
+        if instruction[0] == "label":
+            offsets[instruction[1]] = position
+        elif instruction[0] == "jmp":
+            position += _OP.size
+        else:
+            position += _OP.size + len(instruction[2])
+    # jumping one op past the end of the program rejects the socket
+    offsets[reject] = position + _OP.size
+    if position > MAX_BYTECODE_LEN - _OP.size:
+        raise ValueError("bytecode too long: {} bytes".format(position))
+
+    code = []
+    position = 0
+    for instruction in program:
+        if instruction[0] == "label":
+            continue
+        if instruction[0] == "jmp":
+            target = offsets[instruction[1]]
+            code.append(_OP.pack(INET_DIAG_BC_JMP, _OP.size,
+                                 target - position))
+            position += _OP.size
+        else:
+            _, op, payload, fail = instruction
+            size = _OP.size + len(payload)
+            code.append(_OP.pack(op, size, offsets[fail] - position))
+            code.append(payload)
+            position += size
+    return b"".join(code)
+
+
+def compile_flow_definitions(definitions, protocol=PROTOCOL_TCP):
+    """Compile flow definitions into an INET_DIAG_REQ_BYTECODE filter
+
+    Args:
+      protocol (str): only include the flows of this protocol
+
+    Returns:
+      bytes: the bytecode, or None if no kernel side filtering is possible
+    """
+    try:
+        return assemble(flow_definitions_expr(definitions, protocol))
+    except ValueError as e:
+        _logger.warning("Not filtering sockets in the kernel: {}".format(e))
+        return None
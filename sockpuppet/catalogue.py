@@ -0,0 +1,278 @@
+"""The catalogue of per-socket metrics that can be exported
+
+Each entry is keyed by a short id and gives the exported metric ``name``,
+the ``path`` of the value in the flow dict, its ``type`` (gauge or counter)
+and its ``help`` text. The built-in catalogue covers every numeric field of
+``tcp_info`` and ``meminfo``. The config file may add entries, or replace
+built-in ones, with a ``metric_catalogue`` dict::
+
+    metric_catalogue = {
+        "cwnd": {
+            "name": "sockpuppet_tcp_cwnd_segments",
+            "path": "tcp_info.snd_cwnd",
+            "type": "gauge",
+            "help": "Congestion window in segments",
+        },
+    }
+
+Which metrics are exported is chosen per flow definition with a ``metrics``
+list of ids, falling back to the config's ``default_metrics`` and then to
+:data:`DEFAULT_METRICS`::
+
+    {
+        "class": "ceph",
+        "metrics": ["rtt", "snd_cwnd", "total_retrans", "delivery_rate"],
+        "flows": [...],
+    }
+
+Only the fields of the metrics enabled for a flow are extracted from its
+sockets.
+
+UDP sockets of the flows that apply to UDP always export the metrics of
+:data:`UDP_METRICS`.
+"""
+from sockpuppet.paths import accessor
+
+METRIC_TYPES = ("gauge", "counter")
+
+# enabled when neither the flow definition nor the config says otherwise
+DEFAULT_METRICS = ("rtt", "rcv_rtt", "bytes_acked", "bytes_received",
+                   "notsent_bytes", "tmem", "wmem")
+
+
+def _entry(path, kind, help_text, name=None):
+    return {"name": name, "path": path, "type": kind, "help": help_text}
+
+
+# id to entry, the name defaults to sockpuppet_tcp_<id>
+_BUILTIN = {
+    "rtt": _entry(
+        "tcp_info.rtt", "gauge",
+        "The smooth round trip time of delays between sent packets and "
+        "received ACK"),
+    "rcv_rtt": _entry(
+        "tcp_info.rcv_rtt", "gauge", "Time to receive one full window"),
+    "bytes_acked": _entry(
+        "tcp_info.bytes_acked", "counter",
+        "Number of bytes that have been sent and acknowledged"),
+    "bytes_received": _entry(
+        "tcp_info.bytes_received", "counter",
+        "Number of bytes that have been received"),
+    # https://github.com/torvalds/linux/commit/cd9b266095f422267bddbec88f9098b48ea548fc,  # noqa
+    "notsent_bytes": _entry(
+        "tcp_info.notsent_bytes", "gauge",
+        "the amount of bytes in the write queue that were not yet sent. "
+        "This is only likely to work with a linux >= 4.6."),
+    # idiag_tmem, see: man sock_diag
+    "tmem": _entry(
+        "meminfo.t", "gauge", "The amount of data in send queue",
+        name="sockpuppet_tcp_tmem_bytes"),
+    # idiag_wmem
+    "wmem": _entry(
+        "meminfo.w", "gauge",
+        "The amount of data that is queued by TCP but not yet sent.",
+        name="sockpuppet_tcp_wmem_bytes"),
+    # idiag_rmem
+    "rmem": _entry(
+        "meminfo.r", "gauge", "The amount of data in the receive queue",
+        name="sockpuppet_tcp_rmem_bytes"),
+    # idiag_fmem
+    "fmem": _entry(
+        "meminfo.f", "gauge", "The amount of memory scheduled for future use",
+        name="sockpuppet_tcp_fmem_bytes"),
+    "ca_state": _entry(
+        "tcp_info.ca_state", "gauge", "Congestion avoidance state"),
+    "retransmits": _entry(
+        "tcp_info.retransmits", "gauge",
+        "Number of unrecovered retransmission timeouts"),
+    "probes": _entry(
+        "tcp_info.probes", "gauge", "Number of unanswered zero window probes"),
+    "backoff": _entry(
+        "tcp_info.backoff", "gauge", "Retransmission timer backoff"),
+    "rto": _entry(
+        "tcp_info.rto", "gauge", "Retransmission timeout in milliseconds"),
+    "ato": _entry(
+        "tcp_info.ato", "gauge",
+        "Delayed ACK timeout in milliseconds"),
+    "snd_mss": _entry(
+        "tcp_info.snd_mss", "gauge", "Sending maximum segment size"),
+    "rcv_mss": _entry(
+        "tcp_info.rcv_mss", "gauge",
+        "Estimated receiving maximum segment size"),
+    "unacked": _entry(
+        "tcp_info.unacked", "gauge", "Number of unacknowledged segments"),
+    "sacked": _entry(
+        "tcp_info.sacked", "gauge", "Number of selectively acknowledged "
+        "segments"),
+    "lost": _entry(
+        "tcp_info.lost", "gauge", "Number of segments considered lost"),
+    "retrans": _entry(
+        "tcp_info.retrans", "gauge",
+        "Number of retransmitted segments not yet acknowledged"),
+    "fackets": _entry(
+        "tcp_info.fackets", "gauge", "Number of forward acknowledged "
+        "segments"),
+    "last_data_sent": _entry(
+        "tcp_info.last_data_sent", "gauge",
+        "Milliseconds since data was last sent"),
+    "last_ack_sent": _entry(
+        "tcp_info.last_ack_sent", "gauge",
+        "Milliseconds since an ACK was last sent"),
+    "last_data_recv": _entry(
+        "tcp_info.last_data_recv", "gauge",
+        "Milliseconds since data was last received"),
+    "last_ack_recv": _entry(
+        "tcp_info.last_ack_recv", "gauge",
+        "Milliseconds since an ACK was last received"),
+    "pmtu": _entry(
+        "tcp_info.pmtu", "gauge", "Path maximum transmission unit"),
+    "rcv_ssthresh": _entry(
+        "tcp_info.rcv_ssthresh", "gauge", "Receive window slow start "
+        "threshold"),
+    "rttvar": _entry(
+        "tcp_info.rttvar", "gauge",
+        "Round trip time variance in milliseconds"),
+    "snd_ssthresh": _entry(
+        "tcp_info.snd_ssthresh", "gauge",
+        "Slow start threshold in segments, missing while infinite"),
+    "snd_cwnd": _entry(
+        "tcp_info.snd_cwnd", "gauge", "Congestion window in segments"),
+    "advmss": _entry(
+        "tcp_info.advmss", "gauge", "Advertised maximum segment size"),
+    "reordering": _entry(
+        "tcp_info.reordering", "gauge", "Packet reordering metric"),
+    "rcv_space": _entry(
+        "tcp_info.rcv_space", "gauge", "Receive buffer space estimate"),
+    "total_retrans": _entry(
+        "tcp_info.total_retrans", "counter",
+        "Number of segments retransmitted"),
+    "pacing_rate": _entry(
+        "tcp_info.pacing_rate", "gauge", "Pacing rate in bytes per second"),
+    "max_pacing_rate": _entry(
+        "tcp_info.max_pacing_rate", "gauge",
+        "Maximum pacing rate in bytes per second"),
+    "segs_out": _entry(
+        "tcp_info.segs_out", "counter", "Number of segments sent"),
+    "segs_in": _entry(
+        "tcp_info.segs_in", "counter", "Number of segments received"),
+    "min_rtt": _entry(
+        "tcp_info.min_rtt", "gauge",
+        "Minimum round trip time seen in microseconds"),
+    "data_segs_in": _entry(
+        "tcp_info.data_segs_in", "counter",
+        "Number of segments received carrying data"),
+    "data_segs_out": _entry(
+        "tcp_info.data_segs_out", "counter",
+        "Number of segments sent carrying data"),
+    "delivery_rate": _entry(
+        "tcp_info.delivery_rate", "gauge",
+        "Recent delivery rate in bytes per second"),
+    "delivery_rate_app_limited": _entry(
+        "tcp_info.delivery_rate_app_limited", "gauge",
+        "1 if the delivery rate was limited by the application"),
+    "busy_time": _entry(
+        "tcp_info.busy_time", "counter",
+        "Microseconds spent with data in flight"),
+    "rwnd_limited": _entry(
+        "tcp_info.rwnd_limited", "counter",
+        "Microseconds spent limited by the receive window"),
+    "sndbuf_limited": _entry(
+        "tcp_info.sndbuf_limited", "counter",
+        "Microseconds spent limited by the send buffer"),
+    "delivered": _entry(
+        "tcp_info.delivered", "counter",
+        "Number of segments delivered, including retransmissions"),
+    "delivered_ce": _entry(
+        "tcp_info.delivered_ce", "counter",
+        "Number of delivered segments marked with ECN congestion "
+        "experienced"),
+    "bytes_sent": _entry(
+        "tcp_info.bytes_sent", "counter",
+        "Number of bytes sent, including retransmissions"),
+    "bytes_retrans": _entry(
+        "tcp_info.bytes_retrans", "counter", "Number of bytes retransmitted"),
+    "dsack_dups": _entry(
+        "tcp_info.dsack_dups", "counter",
+        "Number of duplicate segments reported by DSACK"),
+    "reord_seen": _entry(
+        "tcp_info.reord_seen", "counter",
+        "Number of reordering events seen"),
+    "rcv_ooopack": _entry(
+        "tcp_info.rcv_ooopack", "counter",
+        "Number of out of order packets received"),
+    "snd_wnd": _entry(
+        "tcp_info.snd_wnd", "gauge", "Window advertised by the peer"),
+    "snd_wscale": _entry(
+        "tcp_info.snd_wscale", "gauge", "Send window scale"),
+    "rcv_wscale": _entry(
+        "tcp_info.rcv_wscale", "gauge", "Receive window scale"),
+}
+
+
+# id to entry of the metrics exported for UDP sockets
+UDP_METRICS = {
+    "receive_queue": _entry(
+        "skmeminfo.rmem_alloc", "gauge",
+        "The amount of data in the receive queue",
+        name="sockpuppet_udp_receive_queue_bytes"),
+    "receive_buffer": _entry(
+        "skmeminfo.rcvbuf", "gauge", "The size of the receive buffer",
+        name="sockpuppet_udp_receive_buffer_bytes"),
+    "send_queue": _entry(
+        "skmeminfo.wmem_alloc", "gauge",
+        "The amount of data in the send queue",
+        name="sockpuppet_udp_send_queue_bytes"),
+    "send_buffer": _entry(
+        "skmeminfo.sndbuf", "gauge", "The size of the send buffer",
+        name="sockpuppet_udp_send_buffer_bytes"),
+    "drops": _entry(
+        "skmeminfo.drops", "counter",
+        "Number of datagrams dropped by the socket, for instance because "
+        "the receive buffer was full",
+        name="sockpuppet_udp_drops"),
+}
+
+
+def _validate(metric_id, entry):
+    for key in ("path", "type", "help"):
+        if key not in entry:
+            raise ValueError("metric {} is missing {}".format(metric_id, key))
+    if entry["type"] not in METRIC_TYPES:
+        raise ValueError("metric {} has unknown type: {}, expected one of "
+                         "{}".format(metric_id, entry["type"], METRIC_TYPES))
+    # fails early on invalid jmespath expressions
+    accessor(entry["path"])
+    result = dict(entry)
+    if not result.get("name"):
+        result["name"] = "sockpuppet_tcp_{}".format(metric_id)
+    return result
+
+
+def build_catalogue(extra=None):
+    """Return the built-in catalogue updated with the given entries"""
+    catalogue = {}
+    for metric_id, entry in _BUILTIN.items():
+        catalogue[metric_id] = _validate(metric_id, entry)
+    for metric_id, entry in (extra or {}).items():
+        catalogue[metric_id] = _validate(metric_id, entry)
+    names = {}
+    for metric_id, entry in catalogue.items():
+        other = names.setdefault(entry["name"], metric_id)
+        if other != metric_id:
+            raise ValueError("metrics {} and {} are both named {}".format(
+                min(other, metric_id), max(other, metric_id), entry["name"]))
+    return catalogue
+
+
+def flow_metric_ids(definitions, catalogue, default=DEFAULT_METRICS):
+    """Return the ids of the metrics enabled for each flow, in definition
+    order
+    """
+    result = []
+    for flow_definition in definitions:
+        ids = tuple(flow_definition.get("metrics", default))
+        for metric_id in ids:
+            if metric_id not in catalogue:
+                raise ValueError("unknown metric: {}".format(metric_id))
+        result.extend(ids for _ in flow_definition["flows"])
+    return result
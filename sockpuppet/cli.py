@@ -25,11 +25,13 @@ import logging
 import time
 
 from prometheus_client.core import REGISTRY
-from prometheus_client import start_http_server
+from prometheus_client import generate_latest, start_http_server
 
 
-from sockpuppet import __version__
+from sockpuppet import __version__, remotewrite
 from sockpuppet.collector import SockPuppetCollector
+from sockpuppet.reload import ConfigReloader, ReloadingCollector
+from sockpuppet.sampler import Sampler, start_snapshot_server
 
 __author__ = "Will Szumski"
 __copyright__ = "Will Szumski"
@@ -51,16 +53,42 @@ def check_port(value):
             "%s isn't a valid port number" % value)
 
 
+def check_interval(value):
+    try:
+        fvalue = float(value)
+        if fvalue < 0:
+            raise ValueError()
+        return fvalue
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "%s isn't a valid number of seconds" % value)
+
+
+def check_positive(value):
+    try:
+        ivalue = int(value)
+        if ivalue <= 0:
+            raise ValueError()
+        return ivalue
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "%s isn't a positive integer" % value)
+
+
 def check_file(value):
+    # the config is only loaded once, by main
     try:
-        load_config(value)
-        return value
+        with open(value):
+            return value
     except (ValueError, IOError):
         raise argparse.ArgumentTypeError(
             "cannot open config file: %s" % value)
 
 
 def load_config(path):
+    # a fresh module, so that settings removed from the file are not kept
+    # from a previous load
+    sys.modules.pop('config', None)
     return imp.load_source('config', path)
 
 
@@ -99,6 +127,74 @@ def parse_args(args):
         type=check_file,
         metavar="PATH",
         default="/etc/sockpuppet/config.py"),
+    parser.add_argument(
+        '--sample-interval',
+        dest="sample_interval",
+        help="collect in the background every SECONDS and serve the latest "
+             "snapshot to scrapes, 0 collects on every scrape",
+        type=check_interval,
+        metavar="SECONDS",
+        default=0)
+    parser.add_argument(
+        '--max-staleness',
+        dest="max_staleness",
+        help="refuse to serve snapshots older than SECONDS, defaults to "
+             "three sample intervals",
+        type=check_interval,
+        metavar="SECONDS",
+        default=None)
+    parser.add_argument(
+        '--config-watch-interval',
+        dest="config_watch_interval",
+        help="check the config file for changes every SECONDS and reload "
+             "it, 0 only reloads on SIGHUP",
+        type=check_interval,
+        metavar="SECONDS",
+        default=0)
+    parser.add_argument(
+        '--async',
+        dest="use_async",
+        help="serve scrapes from an asyncio event loop, sharing one "
+             "collection between concurrent scrapes (python 3 only)",
+        action='store_true')
+    parser.add_argument(
+        '--coalesce-window',
+        dest="coalesce_window",
+        help="with --async, also serve a finished collection to scrapes "
+             "arriving up to SECONDS after it",
+        type=check_interval,
+        metavar="SECONDS",
+        default=0)
+    parser.add_argument(
+        '--remote-write-url',
+        dest="remote_write_url",
+        help="also push the metrics to this Prometheus remote-write "
+             "endpoint, this implies background sampling",
+        metavar="URL",
+        default=None)
+    parser.add_argument(
+        '--remote-write-interval',
+        dest="remote_write_interval",
+        help="push the latest sample every SECONDS, also the sample "
+             "interval if --sample-interval is not given",
+        type=check_interval,
+        metavar="SECONDS",
+        default=remotewrite.DEFAULT_INTERVAL)
+    parser.add_argument(
+        '--remote-write-batch-size',
+        dest="remote_write_batch_size",
+        help="maximum number of samples per remote-write request",
+        type=check_positive,
+        metavar="N",
+        default=remotewrite.DEFAULT_BATCH_SIZE)
+    parser.add_argument(
+        '--remote-write-queue-size',
+        dest="remote_write_queue_size",
+        help="maximum number of batches waiting to be pushed, the oldest "
+             "are dropped beyond that",
+        type=check_positive,
+        metavar="N",
+        default=remotewrite.DEFAULT_QUEUE_SIZE)
     parser.add_argument(
         '-v',
         '--verbose',
@@ -135,11 +231,48 @@ def main(args):
     """
     args = parse_args(args)
     setup_logging(args.loglevel)
-    _logger.info("Listening on: {}:{}".format(args.address, args.port))
-    start_http_server(args.port, addr=args.address)
     config = load_config(args.config_path)
-    collector = SockPuppetCollector(config=config)
+    collector = ReloadingCollector(SockPuppetCollector(config=config))
     REGISTRY.register(collector)
+    reloader = ConfigReloader(args.config_path, collector, load_config,
+                              interval=args.config_watch_interval)
+    reloader.install_signal_handler()
+    reloader.start()
+    sample_interval = args.sample_interval
+    if args.remote_write_url and not sample_interval:
+        # scrapes and pushes share the collections of the sampler
+        sample_interval = args.remote_write_interval or \
+            remotewrite.DEFAULT_INTERVAL
+    _logger.info("Listening on: {}:{}".format(args.address, args.port))
+    if sample_interval:
+        max_staleness = args.max_staleness
+        if max_staleness is None:
+            max_staleness = 3 * sample_interval
+        sampler = Sampler(REGISTRY, sample_interval,
+                          max_staleness=max_staleness)
+        sampler.start()
+        render = sampler.render
+    else:
+        def render():
+            return generate_latest(REGISTRY)
+    if args.remote_write_url:
+        writer = remotewrite.RemoteWriter(
+            args.remote_write_url, sampler,
+            interval=args.remote_write_interval or
+            remotewrite.DEFAULT_INTERVAL,
+            batch_size=args.remote_write_batch_size,
+            queue_size=args.remote_write_queue_size)
+        REGISTRY.register(writer)
+        writer.start()
+        _logger.info("Pushing to: {}".format(args.remote_write_url))
+    if args.use_async:
+        from sockpuppet.aioexporter import AsyncExporter, start_async_server
+        exporter = AsyncExporter(render, window=args.coalesce_window)
+        start_async_server(exporter, args.port, addr=args.address)
+    elif sample_interval:
+        start_snapshot_server(sampler, args.port, addr=args.address)
+    else:
+        start_http_server(args.port, addr=args.address)
     while True:
         time.sleep(10)
 
@@ -1,13 +1,41 @@
+import errno
+import itertools
 import subprocess
 import logging
-import json
-import jmespath
+import socket
+import tempfile
+import threading
+import time
+from timeit import default_timer
+
+from sockpuppet import netlink
+from sockpuppet.jsonstream import iter_flows
+from sockpuppet.paths import FieldExtractor, dotted_keys, project, \
+    projection, WILDCARD
+from sockpuppet.process import DEFAULT_CACHE_TTL, ProcessCache
+from sockpuppet.state import SocketStateTable, TRACKED_COUNTERS, \
+    DEFAULT_MAX_SOCKETS, socket_key
+from sockpuppet.aggregation import Aggregator, flow_aggregations
+from sockpuppet import columnar
+from sockpuppet.bytecode import compile_flow_definitions
+from sockpuppet.catalogue import DEFAULT_METRICS, UDP_METRICS, \
+    build_catalogue, flow_metric_ids
+from sockpuppet.histograms import FlowHistograms, flow_histograms
+from sockpuppet.matcher import FlowMatcher, ADDRESS_SELECTORS, \
+    PROTOCOL_TCP, PROTOCOL_UDP, flow_protocols, unchanged_flows
+from sockpuppet.prefixes import address_matches
+from sockpuppet.netns import NamespacePool
+from sockpuppet.quantiles import FlowQuantiles, flow_quantiles
+from sockpuppet.shards import DEFAULT_SHARD_SIZE, DEFAULT_SHARD_TIMEOUT, \
+    ShardPool, ShardSpec
+from sockpuppet.topk import TopSockets, flow_tops
 
 try:
     xrange = xrange
 except NameError:  # python3
     xrange = range
 
+from prometheus_client import Histogram
 from prometheus_client.metrics_core import GaugeMetricFamily, \
     CounterMetricFamily
 
@@ -15,42 +43,236 @@ _logger = logging.getLogger(__name__)
 
 _allowed_selectors = ["src_port", "dst_port", "src", "dst"]
 
+BACKEND_NETLINK = "netlink"
+BACKEND_SS2 = "ss2"
+
+STAGE_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5,
+                 5.0, 10.0, 30.0, float("inf"))
+
 
 class SSContext:
-    def __init__(self, tcp=False, udp=False, process=False):
+    def __init__(self, tcp=False, udp=False, process=False,
+                 backend=BACKEND_NETLINK, bytecode=None, process_cache=None,
+                 namespaces=None, udp_bytecode=None):
         self.tcp = tcp
         self.udp = udp
         self.process = process
+        # when set, processes are resolved through this ProcessCache rather
+        # than by the backend on every scrape
+        self.process_cache = process_cache
+        self.backend = backend
+        # kernel side socket filters, only used by the netlink backend
+        self.bytecode = bytecode
+        self.udp_bytecode = udp_bytecode
+        # flows for which these return False are dropped while parsing
+        self.flow_filter = None
+        self.udp_flow_filter = None
+        # projection of the flow fields to keep, see sockpuppet.paths
+        self.fields = None
+        self.sock_diag = netlink.SockDiag()
+        # NamespacePool of the other network namespaces to collect, only
+        # supported by the netlink backend
+        self.namespaces = namespaces
+        # backend name to the number of failed queries
+        self.errors = {}
+        # times process gathering was disabled after a failure
+        self.process_fallbacks = 0
+        # ShardPool decoding and matching the sockets in worker processes,
+        # only supported by the netlink backend
+        self.shards = None
+        # seconds spent waiting for the backend and in the flow filters, see
+        # SockPuppetCollector.collect_locked
+        self.fetch_seconds = 0.0
+        self.filter_seconds = 0.0
+
+    def record_error(self, backend):
+        self.errors[backend] = self.errors.get(backend, 0) + 1
+
+
+class _TimedStream(object):
+    """Adds the time spent reading a stream to the fetch time of a context
+    """
+
+    def __init__(self, stream, context):
+        self.stream = stream
+        self.context = context
+
+    def read(self, size=-1):
+        start = default_timer()
+        try:
+            return self.stream.read(size)
+        finally:
+            self.context.fetch_seconds += default_timer() - start
+
+
+def _timed_replies(replies, context):
+    """Yield the sock_diag replies, timing the dump as fetch time"""
+    while True:
+        start = default_timer()
+        try:
+            reply = next(replies)
+        except StopIteration:
+            return
+        finally:
+            context.fetch_seconds += default_timer() - start
+        yield reply
+
+
+def _add_process_info(stats, context):
+    start = default_timer()
+    netlink.add_process_info(stats, context.process_cache)
+    context.fetch_seconds += default_timer() - start
 
 
 def get_socket_stats(context, retry=0):
+    if context.backend == BACKEND_NETLINK:
+        try:
+            return get_netlink_socket_stats(context)
+        except (IOError, OSError) as e:
+            _logger.error("sock_diag query failed, falling back to "
+                          "ss2: {}".format(e))
+            context.record_error(BACKEND_NETLINK)
+            context.backend = BACKEND_SS2
+    return get_ss2_socket_stats(context, retry=retry)
+
+
+def get_sharded_socket_stats(context):
+    """Like :meth:`SockDiag.get_socket_stats` using the shard pool
+
+    Each protocol also has the (flow index, values) of its flows under
+    ``matches``, and TCP the number of unmatched sockets by state under
+    ``unmatched``.
+    """
+    replies = context.sock_diag.dump_replies(
+        tcp=context.tcp, udp=context.udp, bytecode=context.bytecode,
+        udp_bytecode=context.udp_bytecode, namespaces=context.namespaces)
+    tcp_rows, udp_rows, unmatched = context.shards.run(
+        _timed_replies(replies, context))
+    stats = {}
+    if context.tcp:
+        stats["TCP"] = {"flows": [x[1] for x in tcp_rows],
+                        "matches": [(x[0], x[2]) for x in tcp_rows],
+                        "unmatched": unmatched}
+    if context.udp:
+        stats["UDP"] = {"flows": [x[1] for x in udp_rows],
+                        "matches": [(x[0], x[2]) for x in udp_rows]}
+    if context.process:
+        _add_process_info(stats, context)
+    return stats
+
+
+def get_netlink_socket_stats(context):
+    """Like :meth:`SockDiag.get_socket_stats`, timing the dump apart from
+    decoding
+    """
+    try:
+        if context.shards is not None:
+            return get_sharded_socket_stats(context)
+        replies = context.sock_diag.dump_replies(
+            tcp=context.tcp, udp=context.udp, bytecode=context.bytecode,
+            udp_bytecode=context.udp_bytecode, namespaces=context.namespaces)
+        stats = {}
+        if context.tcp:
+            stats["TCP"] = {"flows": []}
+        if context.udp:
+            stats["UDP"] = {"flows": []}
+        for netns, tcp_bodies, udp_bodies in _timed_replies(replies,
+                                                            context):
+            if context.tcp:
+                stats["TCP"]["flows"].extend(netlink.decode_flows(
+                    tcp_bodies, context.flow_filter, netns))
+            if context.udp:
+                stats["UDP"]["flows"].extend(netlink.decode_flows(
+                    udp_bodies, context.udp_flow_filter, netns,
+                    socket.IPPROTO_UDP))
+        if context.process:
+            _add_process_info(stats, context)
+        return stats
+    except (IOError, OSError) as e:
+        if e.errno != errno.EINVAL or (context.bytecode is None and
+                                       context.udp_bytecode is None):
+            raise
+        _logger.error("Kernel rejected the socket filter, disabling "
+                      "kernel side filtering: {}".format(e))
+        context.bytecode = None
+        context.udp_bytecode = None
+        return get_netlink_socket_stats(context)
+
+
+def read_ss2_output(stream, context):
+    """Parse ss2 output, keeping only the wanted flows and fields"""
+    stats = {}
+    if context.tcp:
+        stats["TCP"] = {"flows": []}
+    if context.udp:
+        stats["UDP"] = {"flows": []}
+    for protocol, flow in iter_flows(_TimedStream(stream, context)):
+        flows = stats.setdefault(protocol, {"flows": []})["flows"]
+        flow_filter = context.udp_flow_filter if protocol == "UDP" \
+            else context.flow_filter
+        if flow_filter is not None and not flow_filter(flow):
+            continue
+        if context.fields is not None:
+            flow = project(flow, context.fields)
+        flows.append(flow)
+    return stats
+
+
+def get_ss2_socket_stats(context, retry=0):
     args = []
     args += ["-a"]
     if context.tcp:
         args += ["-t"]
     if context.udp:
         args += ["-u"]
-    if context.process:
+    if context.process and context.process_cache is None:
         args += ["-p"]
     cmd = ["ss2"] + args
     try:
-        pipes = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-        std_out, std_err = pipes.communicate()
-
-        if pipes.returncode != 0:
-            _logger.error("return code non-zero: {}".format(std_err))
-            if retry < 1 and context.process:
-                _logger.error("Gathering process information requires root "
-                              "privileges, auto disabling process gathering.")
-                context.process = False
-                return get_socket_stats(context, retry=retry + 1)
-        return json.loads(std_out)
-    except IOError as e:
-        _logger.error("Failed to run ss2", e)
-
-
-def find_flow(definitions, labels):
+        with tempfile.TemporaryFile() as std_err:
+            start = default_timer()
+            pipes = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                     stderr=std_err)
+            context.fetch_seconds += default_timer() - start
+            parse_error = None
+            try:
+                stats = read_ss2_output(pipes.stdout, context)
+            except ValueError as e:
+                parse_error = e
+            finally:
+                start = default_timer()
+                pipes.stdout.close()
+                pipes.wait()
+                context.fetch_seconds += default_timer() - start
+
+            if pipes.returncode != 0:
+                std_err.seek(0)
+                _logger.error("return code non-zero: {}".format(
+                    std_err.read()))
+                context.record_error(BACKEND_SS2)
+                if retry < 1 and context.process:
+                    _logger.error("Gathering process information requires "
+                                  "root privileges, auto disabling process "
+                                  "gathering.")
+                    context.process = False
+                    context.process_fallbacks += 1
+                    return get_ss2_socket_stats(context, retry=retry + 1)
+            if parse_error is not None:
+                _logger.error("Failed to parse ss2 output: {}".format(
+                    parse_error))
+                if pipes.returncode == 0:
+                    context.record_error(BACKEND_SS2)
+                return None
+            if context.process and context.process_cache is not None:
+                _add_process_info(stats, context)
+            return stats
+    except (IOError, OSError) as e:
+        _logger.error("Failed to run ss2: {}".format(e))
+        context.record_error(BACKEND_SS2)
+
+
+def find_flow(definitions, labels, protocol=PROTOCOL_TCP):
+    """Linear scan reference implementation of :class:`FlowMatcher`"""
     def test(flow, item):
         if item not in flow:
             return True
@@ -58,6 +280,8 @@ def find_flow(definitions, labels):
             return False
         if isinstance(flow[item], int):
             return flow[item] == labels[item]
+        if item in ADDRESS_SELECTORS:
+            return address_matches(flow[item], labels[item])
         if isinstance(flow[item], set) or isinstance(flow[item], xrange):
             return labels[item] in flow[item]
         if (item == "src_port" or item == "dst_port") and ":" in flow[item]:
@@ -69,6 +293,8 @@ def find_flow(definitions, labels):
 
     for flow_definition in definitions:
         for flow in flow_definition["flows"]:
+            if protocol not in flow_protocols(flow):
+                continue
             if all([test(flow, x) for x in _allowed_selectors]):
                 return flow_definition, flow
     return None, None
@@ -76,60 +302,106 @@ def find_flow(definitions, labels):
 
 class TCPFlowContext(object):
 
-    def __init__(self, config, flow):
+    def __init__(self, matcher, flow, flow_index=None, extra_labels=(),
+                 values=None):
         self.flow = flow
+        # the extracted metric values, if they are already known
+        self.values = values
         self.label_values = TCPMetric.get_label_values(flow)
 
-        labels = dict(zip(TCPMetric.tcp_label_names, self.label_values))
-        matching_def, matching_flow = find_flow(
-            config.flow_definitions,
-            labels
-        )
-        if matching_flow:
+        if flow_index is None:
+            labels = dict(zip(self.label_names, self.label_values))
+            flow_index = matcher.match_index(labels)
+        self.flow_index = flow_index
+        if self.flow_index is not None:
+            matching_def, matching_flow = matcher.flows[self.flow_index]
             self.flow_class = matching_def["class"]
             self.flow_name = matching_flow["flow"]
+            self.all_labels = [self.flow_class, self.flow_name,
+                               process_cmd(flow)] + \
+                [str(flow.get(x, "")) for x in extra_labels] + \
+                [str(x) for x in self.label_values]
         else:
             self.flow_class = None
             self.flow_name = None
+            self.all_labels = None
+
+    @property
+    def label_names(self):
+        return TCPMetric.tcp_label_names
 
     def should_collect(self):
         return self.flow_class and self.flow_name
 
 
+class UDPFlowContext(TCPFlowContext):
+    """A UDP socket, matched against the flows that apply to UDP"""
+
+    @property
+    def label_names(self):
+        return UDPMetric.udp_label_names
+
+
+class ScrapeContext(object):
+    """The metric families and accumulators filled in by one scrape"""
+
+    def __init__(self, metrics, udp_metrics=None):
+        self.metrics = metrics
+        self.udp_metrics = udp_metrics or {}
+        self.aggregator = Aggregator()
+        self.histograms = FlowHistograms()
+        # (class, flow) to the summed counter deltas of its sockets
+        self.flow_deltas = {}
+        self.top = TopSockets()
+
+    def add_flow_deltas(self, context, deltas):
+        key = (context.flow_class, context.flow_name)
+        total = self.flow_deltas.get(key)
+        if total is None:
+            self.flow_deltas[key] = deltas
+        else:
+            self.flow_deltas[key] = tuple(a + b for a, b in zip(total, deltas))
+
+
+def process_cmd(flow):
+    if "usr_ctxt" in flow:
+        for user, groups in flow["usr_ctxt"].items():
+            for group, cmd_meta in groups.items():
+                # Just pick the first one, I'm not sure under which
+                # circumstances you would see more than one, if ever.
+                return cmd_meta["cmd"]
+    return "None"
+
+
 class Metric(object):
 
-    def __init__(self, path):
-        self.path = jmespath.compile(path)
+    def __init__(self, path, name=None, kind="gauge", help_text="",
+                 extra_label_names=()):
+        self.path = path
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        # labels between the base and the protocol labels, such as netns
+        self.extra_label_names = list(extra_label_names)
+
+    def family(self):
+        """Return an empty metric family for this metric"""
+        if self.kind == "counter":
+            return CounterMetricFamily(self.name, self.help_text,
+                                       labels=self.label_names)
+        return GaugeMetricFamily(self.name, self.help_text,
+                                 labels=self.label_names)
+
+    base_label_names = ["class", "flow", "process"]
 
     @property
     def label_names(self):
-        return ["class", "flow", "process"]
-
-    def create(self, context, metric):
-        value = self.path.search(context.flow)
-        cmd = "None"
-        if "usr_ctxt" in context.flow:
-            for user, groups in context.flow["usr_ctxt"].items():
-                for group, cmd_meta in groups.items():
-                    # Just pick the first one, I'm not sure under which
-                    # circumstances you would see more than one, if ever.
-                    cmd = cmd_meta["cmd"]
-                    break
-        if value is not None:
-            all_labels = [context.flow_class, context.flow_name, cmd] + \
-                         [str(x) for x in context.label_values]
-            metric.add_metric(all_labels, value)
+        return self.base_label_names + self.extra_label_names
 
 
 class TCPMetric(Metric):
 
     tcp_label_names = ["src", "src_port", "dst", "dst_port"]
-    tcp_label_paths = [
-        jmespath.compile("src"),
-        jmespath.compile("src_port"),
-        jmespath.compile("dst"),
-        jmespath.compile("dst_port"),
-    ]
 
     @property
     def label_names(self):
@@ -137,81 +409,589 @@ class TCPMetric(Metric):
 
     @staticmethod
     def get_label_values(flow):
-        return [x.search(flow) for x in TCPMetric.tcp_label_paths]
+        return [flow.get(x) for x in TCPMetric.tcp_label_names]
+
+
+class UDPMetric(Metric):
+
+    # the same selectors as TCP, so aggregations apply to both
+    udp_label_names = TCPMetric.tcp_label_names
+
+    @property
+    def label_names(self):
+        return super(UDPMetric, self).label_names + self.udp_label_names
 
 
 class SockPuppetCollector(object):
 
     def __init__(self, config):
-        self.context = SSContext(tcp=True, process=True)
+        ttl = getattr(config, "process_cache_ttl", DEFAULT_CACHE_TTL)
+        namespaces = getattr(config, "namespaces", None)
+        self.context = SSContext(
+            tcp=True, process=True,
+            backend=getattr(config, "backend", BACKEND_NETLINK),
+            bytecode=compile_flow_definitions(config.flow_definitions),
+            process_cache=ProcessCache(ttl) if ttl else None,
+            namespaces=NamespacePool(namespaces) if namespaces else None)
+        # flow labels exported in addition to the base and TCP labels
+        self.extra_labels = ("netns",) if namespaces else ()
+        if namespaces and self.context.backend != BACKEND_NETLINK:
+            _logger.warning("Network namespaces are only supported by the "
+                            "netlink backend, only sockets of the current "
+                            "namespace will be collected")
         self.config = config
-        self.metric_definitions = {
-            "rtt": TCPMetric("tcp_info.rtt"),
-            "rcv_rtt": TCPMetric("tcp_info_rcv_rtt"),
-            "bytes_acked": TCPMetric("tcp_info.bytes_acked"),
-            "bytes_received": TCPMetric("tcp_info.bytes_received"),
-            "notsent_bytes": TCPMetric("tcp_info.notsent_bytes"),
-            "tmem": TCPMetric("meminfo.t"),
-            "wmem": TCPMetric("meminfo.w"),
-        }
+        self.matcher = FlowMatcher(config.flow_definitions)
+        self.udp_matcher = FlowMatcher(config.flow_definitions, PROTOCOL_UDP)
+        # UDP sockets are only dumped if a flow applies to them
+        if self.udp_matcher.all:
+            self.context.udp = True
+            self.context.udp_bytecode = compile_flow_definitions(
+                config.flow_definitions, PROTOCOL_UDP)
+        self.engine = getattr(config, "engine", columnar.ENGINE_PYTHON)
+        if self.engine not in (columnar.ENGINE_PYTHON,
+                               columnar.ENGINE_COLUMNAR):
+            raise ValueError("unknown engine: {}".format(self.engine))
+        if self.engine == columnar.ENGINE_COLUMNAR and \
+                not columnar.available():
+            _logger.warning("NumPy is not installed, falling back to the "
+                            "python engine")
+            self.engine = columnar.ENGINE_PYTHON
+        self.columnar_matcher = None
+        if self.engine == columnar.ENGINE_COLUMNAR:
+            self.columnar_matcher = columnar.ColumnarMatcher(self.matcher)
+        self.catalogue = build_catalogue(
+            getattr(config, "metric_catalogue", None))
+        flow_ids = flow_metric_ids(
+            config.flow_definitions, self.catalogue,
+            getattr(config, "default_metrics", DEFAULT_METRICS))
+        # metrics exported as per-flow histograms are not exported per socket
+        histograms = flow_histograms(config.flow_definitions, self.catalogue)
+        flow_ids = [tuple(x for x in ids if x not in dict(hists))
+                    for ids, hists in zip(flow_ids, histograms)]
+        self.metric_definitions = {}
+        self.metric_names = []
+        for ids in flow_ids:
+            for metric_id in ids:
+                if metric_id not in self.metric_definitions:
+                    entry = self.catalogue[metric_id]
+                    self.metric_definitions[metric_id] = TCPMetric(
+                        entry["path"], entry["name"], entry["type"],
+                        entry["help"], self.extra_labels)
+                    self.metric_names.append(metric_id)
+        # the quantile settings of each flow, see sockpuppet.quantiles
+        self.flow_quantiles = flow_quantiles(config.flow_definitions,
+                                             self.catalogue)
+        # the enabled metric ids, histograms and an extractor for their
+        # values, then the values of the quantile metrics and the tracked
+        # counters, for each flow
+        counter_paths = [".".join(path) for _, path in TRACKED_COUNTERS]
+        extractors = {}
+        self.flow_extractors = []
+        for ids, hists, quants in zip(flow_ids, histograms,
+                                      self.flow_quantiles):
+            key = (ids, hists, tuple(x[0] for x in quants))
+            if key not in extractors:
+                extractors[key] = (ids, hists, FieldExtractor(
+                    [self.catalogue[x]["path"] for x in ids] +
+                    [self.catalogue[x]["path"] for x, _ in hists] +
+                    [self.catalogue[x[0]]["path"] for x in quants] +
+                    counter_paths))
+            self.flow_extractors.append(extractors[key])
+        self.udp_metric_names = sorted(UDP_METRICS)
+        self.udp_metric_definitions = dict(
+            (x, UDPMetric(UDP_METRICS[x]["path"], UDP_METRICS[x]["name"],
+                          UDP_METRICS[x]["type"], UDP_METRICS[x]["help"],
+                          self.extra_labels))
+            for x in self.udp_metric_names)
+        self.udp_extractor = FieldExtractor(
+            [UDP_METRICS[x]["path"] for x in self.udp_metric_names])
+        label_names = Metric.base_label_names + list(self.extra_labels) + \
+            TCPMetric.tcp_label_names
+        self.aggregations = flow_aggregations(config.flow_definitions,
+                                              label_names)
+        self.tops = flow_tops(config.flow_definitions, self.catalogue,
+                              label_names)
+        # flow index to the SpaceSaving sketch ranking its sockets
+        self.top_sketches = {}
+        # the columnar engine matches the whole table at once rather than
+        # each socket while parsing
+        if self.engine != columnar.ENGINE_COLUMNAR:
+            self.context.flow_filter = self.wants_flow
+        self.context.udp_flow_filter = self.wants_udp_flow
+        self.context.fields = projection(
+            [(x,) for x in TCPMetric.tcp_label_names] +
+            [(x,) for x in self.extra_labels] +
+            [("inode",), ("flow_index",), ("tcp_info", "state"),
+             ("usr_ctxt", WILDCARD, WILDCARD, "cmd")] +
+            [dotted_keys(path) for _, _, extractor in self.flow_extractors
+             for path in extractor.paths] +
+            [dotted_keys(path) for path in self.udp_extractor.paths] +
+            [dotted_keys(self.catalogue[x.by]["path"]) for x in self.tops
+             if x is not None and x.search is not None])
+        workers = getattr(config, "workers", 0)
+        if workers and self.context.backend != BACKEND_NETLINK:
+            _logger.warning("Worker processes are only supported by the "
+                            "netlink backend, not using them")
+        elif workers:
+            self.context.shards = ShardPool(
+                ShardSpec(config.flow_definitions,
+                          [x[2].paths for x in self.flow_extractors],
+                          self.context.fields),
+                workers, getattr(config, "shard_size", DEFAULT_SHARD_SIZE),
+                getattr(config, "shard_timeout", DEFAULT_SHARD_TIMEOUT))
+        self.state = SocketStateTable(
+            max_sockets=getattr(config, "max_tracked_sockets",
+                                DEFAULT_MAX_SOCKETS))
+        # (class, flow) to the running totals of the tracked counters
+        self.flow_totals = {}
+        self.quantiles = FlowQuantiles()
+        self.lock = threading.Lock()
+        self.stage_seconds = Histogram(
+            "sockpuppet_scrape_stage_seconds",
+            "Time spent in each stage of a scrape: fetch is waiting for "
+            "the socket statistics backend (ss2 or netlink) and /proc, parse "
+            "is decoding its output, match is flow matching and extract is "
+            "metric creation",
+            ["stage"], buckets=STAGE_BUCKETS, registry=None)
+        # TCP state to the number of sockets not matching any flow, for the
+        # scrape in progress
+        self.unmatched = {}
+
+    def inherit(self, previous):
+        """Take over the state of the collector this one replaces
+
+        Used when the config is reloaded. Counters, open sockets and caches
+        are carried over; socket state and flow totals only for the flows
+        that did not change.
+        """
+        old, new = previous.context, self.context
+        self.stage_seconds = previous.stage_seconds
+        new.errors = old.errors
+        new.process_fallbacks = old.process_fallbacks
+        new.sock_diag, old.sock_diag = old.sock_diag, new.sock_diag
+        if old.process_cache is not None and new.process_cache is not None:
+            old.process_cache.ttl = new.process_cache.ttl
+            new.process_cache = old.process_cache
+        if old.shards is not None:
+            old.shards.close()
+        if old.namespaces is not None:
+            if new.namespaces is not None and \
+                    new.namespaces.namespaces == old.namespaces.namespaces:
+                new.namespaces = old.namespaces
+            else:
+                old.namespaces.close()
+        flow_indexes = unchanged_flows(previous.matcher.flows,
+                                       self.matcher.flows)
+        previous.state.max_sockets = self.state.max_sockets
+        previous.state.renumber(flow_indexes)
+        self.state = previous.state
+        kept = set((self.matcher.flows[x][0]["class"],
+                    self.matcher.flows[x][1]["flow"])
+                   for x in flow_indexes.values())
+        self.flow_totals = dict((key, totals) for key, totals in
+                                previous.flow_totals.items() if key in kept)
+        self.quantiles = previous.quantiles
+        self.quantiles.retain(
+            lambda metric_id, flow_class, flow: (flow_class, flow) in kept)
+        for old_index, sketch in previous.top_sketches.items():
+            index = flow_indexes.get(old_index)
+            top = self.tops[index] if index is not None else None
+            if top is not None and sketch.capacity == top.capacity:
+                sketch.decay = top.decay
+                self.top_sketches[index] = sketch
 
     def metrics(self):
-        metrics = {
-            "rtt": GaugeMetricFamily(
-                "sockpuppet_tcp_rtt",
-                "The smooth round trip time of delays between sent packets "
-                "and received ACK",
-                labels=self.metric_definitions["rtt"].label_names),
-
-            "rcv_rtt": GaugeMetricFamily(
-                "sockpuppet_tcp_rcv_rtt",
-                "Time to receive one full window",
-                labels=self.metric_definitions["rcv_rtt"].label_names),
-
-            "bytes_acked": CounterMetricFamily(
-                "sockpuppet_tcp_bytes_acked",
-                "Number of bytes that have been sent and acknowledged",
-                labels=self.metric_definitions["bytes_acked"].label_names),
-
-            "bytes_received": CounterMetricFamily(
-                "sockpuppet_tcp_bytes_received",
-                "Number of bytes that have been received",
-                labels=self.metric_definitions["bytes_received"].label_names),
-
-            # https://github.com/torvalds/linux/commit/cd9b266095f422267bddbec88f9098b48ea548fc,  # noqa
-            "notsent_bytes": GaugeMetricFamily(
-                "sockpuppet_tcp_notsent_bytes",
-                "the amount of bytes in the write queue that were not yet "
-                "sent. This is only likely to work with a linux >= 4.6.",
-                labels=self.metric_definitions["notsent_bytes"].label_names),
-
-            # idiag_tmem, see: man sock_diag
-            "tmem": GaugeMetricFamily(
-                "sockpuppet_tcp_tmem_bytes",
-                "The amount of data in send queue",
-                labels=self.metric_definitions["tmem"].label_names),
-
-            # idiag_wmem
-            "wmem": GaugeMetricFamily(
-                "sockpuppet_tcp_wmem_bytes",
-                "The amount of data that is queued by TCP"
-                "but not yet sent.",
-                labels=self.metric_definitions["wmem"].label_names),
-        }
+        return dict((name, self.metric_definitions[name].family())
+                    for name in self.metric_names)
+
+    def udp_metrics(self):
+        return dict((name, self.udp_metric_definitions[name].family())
+                    for name in self.udp_metric_names)
+
+    def flow_metrics(self):
+        """Return a (delta, rate) pair of families per tracked counter"""
+        metrics = []
+        for name, _ in TRACKED_COUNTERS:
+            metrics.append((
+                GaugeMetricFamily(
+                    "sockpuppet_tcp_flow_{}_delta".format(name),
+                    "Increase of {} summed over the sockets of a flow "
+                    "during the last sample interval".format(name),
+                    labels=["class", "flow"]),
+                GaugeMetricFamily(
+                    "sockpuppet_tcp_flow_{}_rate".format(name),
+                    "Per second rate of {} summed over the sockets of a "
+                    "flow during the last sample interval".format(name),
+                    labels=["class", "flow"]),
+            ))
         return metrics
 
     def collect(self):
+        # the state table and instrumentation assume one scrape at a time
+        with self.lock:
+            metrics = list(self.collect_locked())
+        for metric in metrics:
+            yield metric
+
+    def collect_locked(self):
+        start = default_timer()
+        self.unmatched = {}
+        self.context.fetch_seconds = 0.0
+        self.context.filter_seconds = 0.0
         stats = get_socket_stats(self.context)
+        fetched = default_timer()
+        # the backend parses while it fetches, and the flow filters match
+        # while it parses
+        fetch = self.context.fetch_seconds
+        filtering = self.context.filter_seconds
+        self.stage_seconds.labels("fetch").observe(fetch)
+        self.stage_seconds.labels("parse").observe(
+            max(fetched - start - fetch - filtering, 0.0))
+        matched = 0
         if stats:
-            for flow in stats["TCP"]["flows"]:
-                for metric in self.process_tcp_flow(flow):
+            if "matches" in stats["TCP"]:
+                # matched and extracted by the shard pool
+                contexts = [
+                    TCPFlowContext(self.matcher, flow, flow_index,
+                                   self.extra_labels, values)
+                    for flow, (flow_index, values) in zip(
+                        stats["TCP"]["flows"], stats["TCP"]["matches"])]
+                for state, count in stats["TCP"]["unmatched"].items():
+                    self.unmatched[state] = \
+                        self.unmatched.get(state, 0) + count
+            elif self.engine == columnar.ENGINE_COLUMNAR:
+                contexts = self.match_columnar(stats["TCP"]["flows"])
+            else:
+                contexts = []
+                for flow in stats["TCP"]["flows"]:
+                    context = TCPFlowContext(self.matcher, flow,
+                                             flow.get("flow_index"),
+                                             self.extra_labels)
+                    if context.should_collect():
+                        contexts.append(context)
+                    else:
+                        self.count_unmatched(flow)
+            udp = stats.get("UDP", {})
+            udp_contexts = []
+            for flow, (flow_index, _) in zip(
+                    udp.get("flows", []),
+                    udp.get("matches", itertools.repeat((None, None)))):
+                if flow_index is None:
+                    flow_index = flow.get("flow_index")
+                context = UDPFlowContext(self.udp_matcher, flow, flow_index,
+                                         self.extra_labels)
+                if context.should_collect():
+                    udp_contexts.append(context)
+            matched = len(contexts) + len(udp_contexts)
+            extract = default_timer()
+            self.stage_seconds.labels("match").observe(
+                filtering + extract - fetched)
+
+            scrape = ScrapeContext(self.metrics(), self.udp_metrics())
+            self.state.begin(time.time())
+            self.quantiles.begin()
+            if self.engine == columnar.ENGINE_COLUMNAR:
+                self.process_columnar(contexts, scrape)
+            else:
+                for context in contexts:
+                    self.process_tcp_context(context, scrape)
+            self.state.end()
+            self.quantiles.end()
+            self.add_top_values(scrape)
+            for context in udp_contexts:
+                self.process_udp_context(context, scrape)
+            scrape.aggregator.flush()
+            for metric in scrape.metrics.values():
+                if metric.samples:
                     yield metric
-
-    def process_tcp_flow(self, flow):
-        context = TCPFlowContext(self.config, flow)
-        metrics = self.metrics()
-        for name, definition in self.metric_definitions.items():
-            metric = metrics[name]
-            if context.should_collect():
-                definition.create(context, metric)
+            for metric in scrape.udp_metrics.values():
+                if metric.samples:
+                    yield metric
+            for metric in scrape.histograms.families(self.catalogue):
+                yield metric
+            for metric in self.quantiles.families(self.catalogue):
+                yield metric
+            for metric in self.collect_flow_rates(scrape):
                 yield metric
+            for metric in self.collect_flow_totals(scrape):
+                yield metric
+            self.stage_seconds.labels("extract").observe(
+                default_timer() - extract)
+        self.stage_seconds.labels("total").observe(default_timer() - start)
+        for metric in self.collect_self_metrics(matched):
+            yield metric
+
+    def collect_self_metrics(self, matched):
+        for metric in self.stage_seconds.collect():
+            yield metric
+        unmatched = sum(self.unmatched.values())
+        yield GaugeMetricFamily(
+            "sockpuppet_scrape_sockets",
+            "Number of sockets examined by the last scrape, not counting "
+            "sockets removed by the kernel side filter",
+            value=matched + unmatched)
+        yield GaugeMetricFamily(
+            "sockpuppet_scrape_matched_sockets",
+            "Number of sockets matching a flow in the last scrape",
+            value=matched)
+        metric = GaugeMetricFamily(
+            "sockpuppet_scrape_unmatched_sockets",
+            "Number of sockets not matching any flow in the last scrape, by "
+            "TCP state",
+            labels=["state"])
+        for state, count in sorted(self.unmatched.items()):
+            metric.add_metric([state], count)
+        yield metric
+        metric = CounterMetricFamily(
+            "sockpuppet_backend_errors",
+            "Number of failed socket statistics queries, by backend",
+            labels=["backend"])
+        for backend in (BACKEND_NETLINK, BACKEND_SS2):
+            metric.add_metric([backend], self.context.errors.get(backend, 0))
+        yield metric
+        yield CounterMetricFamily(
+            "sockpuppet_process_fallbacks",
+            "Number of times process gathering was disabled because it "
+            "failed",
+            value=self.context.process_fallbacks)
+        namespaces = self.context.namespaces
+        if namespaces is not None:
+            metric = CounterMetricFamily(
+                "sockpuppet_namespace_errors",
+                "Number of failed socket statistics queries, by network "
+                "namespace",
+                labels=["netns"])
+            for name, count in sorted(namespaces.errors.items()):
+                metric.add_metric([name], count)
+            yield metric
+
+    def collect_flow_rates(self, scrape):
+        elapsed = self.state.elapsed
+        if not scrape.flow_deltas or not elapsed:
+            return []
+        metrics = self.flow_metrics()
+        for labels, deltas in sorted(scrape.flow_deltas.items()):
+            for (delta_metric, rate_metric), delta in zip(metrics, deltas):
+                delta_metric.add_metric(list(labels), delta)
+                rate_metric.add_metric(list(labels), delta / elapsed)
+        return [metric for pair in metrics for metric in pair]
+
+    def collect_flow_totals(self, scrape):
+        for key, deltas in scrape.flow_deltas.items():
+            totals = self.flow_totals.get(key)
+            if totals is None:
+                self.flow_totals[key] = deltas
+            else:
+                self.flow_totals[key] = tuple(
+                    a + b for a, b in zip(totals, deltas))
+        metrics = []
+        for name, _ in TRACKED_COUNTERS:
+            metrics.append(CounterMetricFamily(
+                "sockpuppet_tcp_flow_{}".format(name),
+                "Total {} of all sockets of a flow, including sockets that "
+                "have since been closed".format(name),
+                labels=["class", "flow"]))
+        for labels, totals in sorted(self.flow_totals.items()):
+            for metric, total in zip(metrics, totals):
+                metric.add_metric(list(labels), total)
+        sockets = GaugeMetricFamily(
+            "sockpuppet_tracked_sockets",
+            "Number of sockets whose counters are tracked between samples",
+            value=len(self.state.entries))
+        untracked = CounterMetricFamily(
+            "sockpuppet_untracked_sockets",
+            "Number of times a socket could not be tracked because "
+            "max_tracked_sockets was reached",
+            value=self.state.untracked)
+        if self.flow_totals:
+            metrics.append(sockets)
+            metrics.append(untracked)
+            return metrics
+        return []
+
+    def count_unmatched(self, flow):
+        state = flow.get("tcp_info", {}).get("state", "unknown")
+        self.unmatched[state] = self.unmatched.get(state, 0) + 1
+
+    def wants_flow(self, flow):
+        """Flow filter matching each socket while it is parsed
+
+        The index of the matching flow is kept in the socket's
+        ``flow_index``, so that it is not matched again.
+        """
+        start = default_timer()
+        labels = dict(zip(TCPMetric.tcp_label_names,
+                          TCPMetric.get_label_values(flow)))
+        flow_index = self.matcher.match_index(labels)
+        self.context.filter_seconds += default_timer() - start
+        if flow_index is None:
+            self.count_unmatched(flow)
+            return False
+        flow["flow_index"] = flow_index
+        return True
+
+    def wants_udp_flow(self, flow):
+        start = default_timer()
+        labels = dict(zip(UDPMetric.udp_label_names,
+                          TCPMetric.get_label_values(flow)))
+        flow_index = self.udp_matcher.match_index(labels)
+        self.context.filter_seconds += default_timer() - start
+        if flow_index is None:
+            return False
+        flow["flow_index"] = flow_index
+        return True
+
+    def extract(self, context):
+        """Return the values of the metrics enabled for a flow, followed by
+        the tracked counters
+        """
+        if context.values is not None:
+            return context.values
+        return self.flow_extractors[context.flow_index][2](context.flow)
+
+    def process_tcp_context(self, context, scrape):
+        values = self.extract(context)
+        deltas = self.update_state(context, scrape, values)
+        if self.tops[context.flow_index] is not None:
+            self.add_top_candidate(context, scrape, values, deltas)
+        else:
+            self.add_metric_values(context, scrape, values)
+        self.add_histogram_values(context, scrape, values)
+        self.add_quantile_values(context, values)
+
+    def process_udp_context(self, context, scrape):
+        aggregation = self.aggregations[context.flow_index]
+        labels = context.all_labels
+        for name, value in zip(self.udp_metric_names,
+                               self.udp_extractor(context.flow)):
+            if value is None:
+                continue
+            if aggregation:
+                scrape.aggregator.add(scrape.udp_metrics[name], aggregation,
+                                      labels, value)
+            else:
+                scrape.udp_metrics[name].add_metric(labels, value)
+
+    def add_metric_values(self, context, scrape, values):
+        aggregation = self.aggregations[context.flow_index]
+        ids = self.flow_extractors[context.flow_index][0]
+        labels = context.all_labels
+        for name, value in zip(ids, values):
+            if value is None:
+                continue
+            if aggregation:
+                scrape.aggregator.add(scrape.metrics[name], aggregation,
+                                      labels, value)
+            else:
+                scrape.metrics[name].add_metric(labels, value)
+
+    def add_histogram_values(self, context, scrape, values):
+        ids, histograms, _ = self.flow_extractors[context.flow_index]
+        for (name, buckets), value in zip(histograms, values[len(ids):]):
+            if value is not None:
+                scrape.histograms.add(name, buckets, context.flow_class,
+                                      context.flow_name, value)
+
+    def add_quantile_values(self, context, values):
+        ids, histograms, _ = self.flow_extractors[context.flow_index]
+        offset = len(ids) + len(histograms)
+        for settings, value in zip(self.flow_quantiles[context.flow_index],
+                                   values[offset:]):
+            if value is not None:
+                self.quantiles.add(settings, context.flow_class,
+                                   context.flow_name, value)
+
+    def update_state(self, context, scrape, values):
+        """Track the counters of a socket, returning their increase"""
+        counters = values[-len(TRACKED_COUNTERS):]
+        if None in counters:
+            return None
+        deltas = self.state.update(socket_key(context.flow),
+                                   context.flow_index, tuple(counters))
+        if deltas is not None:
+            scrape.add_flow_deltas(context, deltas)
+        return deltas
+
+    def add_top_candidate(self, context, scrape, values, deltas):
+        """Rank a socket of a top-k flow, see :mod:`sockpuppet.topk`"""
+        flow_index = context.flow_index
+        top = self.tops[flow_index]
+        sketch = self.top_sketches.get(flow_index)
+        if sketch is None:
+            sketch = self.top_sketches[flow_index] = top.sketch()
+        elif flow_index not in scrape.top.candidates:
+            # the first socket of the flow in this sample
+            sketch.age()
+        key = socket_key(context.flow)
+        sketch.add(key, top.weight(context.flow, deltas))
+        scrape.top.add(flow_index, key, context, values)
+
+    def add_top_values(self, scrape):
+        """Export the top sockets of each flow and combine the rest"""
+        for flow_index in scrape.top.candidates:
+            top = self.tops[flow_index]
+            ids = self.flow_extractors[flow_index][0]
+            for is_top, context, values in scrape.top.split(
+                    flow_index, top, self.top_sketches[flow_index]):
+                for name, value in zip(ids, values):
+                    if value is None:
+                        continue
+                    if is_top:
+                        scrape.metrics[name].add_metric(context.all_labels,
+                                                        value)
+                    else:
+                        scrape.aggregator.add(scrape.metrics[name],
+                                              top.other, context.all_labels,
+                                              value)
+
+    def match_columnar(self, flows):
+        """Match a socket table in bulk, see :mod:`sockpuppet.columnar`"""
+        contexts = []
+        indexes = self.columnar_matcher.match(flows)
+        for flow, flow_index in zip(flows, indexes.tolist()):
+            if flow_index < 0:
+                self.count_unmatched(flow)
+            else:
+                contexts.append(TCPFlowContext(
+                    self.matcher, flow, flow_index, self.extra_labels))
+        return contexts
+
+    def process_columnar(self, contexts, scrape):
+        """Like :meth:`process_tcp_context` for all sockets at once, with
+        the aggregated flows reduced in bulk
+        """
+        # (extractor, aggregation) to the aggregated contexts and values
+        groups = {}
+        for context in contexts:
+            values = self.extract(context)
+            deltas = self.update_state(context, scrape, values)
+            aggregation = self.aggregations[context.flow_index]
+            if aggregation:
+                extractor = self.flow_extractors[context.flow_index]
+                group = groups.setdefault(
+                    (id(extractor), id(aggregation)),
+                    (extractor[0], aggregation, [], []))
+                group[2].append(context)
+                group[3].append(values)
+            elif self.tops[context.flow_index] is not None:
+                self.add_top_candidate(context, scrape, values, deltas)
+            else:
+                self.add_metric_values(context, scrape, values)
+            self.add_histogram_values(context, scrape, values)
+            self.add_quantile_values(context, values)
+        for ids, aggregation, group_contexts, rows in groups.values():
+            keys = {}
+            positions = [keys.setdefault(aggregation.key(x.all_labels),
+                                         len(keys))
+                         for x in group_contexts]
+            positions = columnar.numpy.array(positions)
+            matrix = columnar.value_matrix(rows, len(ids))
+            for column, name in enumerate(ids):
+                total, maximum, count = columnar.group_reduce(
+                    positions, len(keys), matrix[:, column])
+                for key, position in keys.items():
+                    if count[position]:
+                        scrape.aggregator.merge(
+                            scrape.metrics[name], aggregation, key,
+                            total[position], maximum[position],
+                            int(count[position]))
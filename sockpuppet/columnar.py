@@ -0,0 +1,189 @@
+"""Optional columnar processing of socket tables with NumPy
+
+Instead of matching sockets one dict at a time, the label columns of the
+whole socket table are loaded into arrays. Each selector is evaluated once
+per distinct label value, using the indexes of a
+:class:`~sockpuppet.matcher.FlowMatcher`, and the resulting flow masks are
+combined as vectors. Masks are split into 64 bit words so that any number of
+flows can be matched; the first matching flow is the lowest set bit of the
+first non-zero word.
+
+Aggregated flows are reduced in bulk with :func:`group_reduce`.
+
+Set ``engine = "columnar"`` in the config file to use it. Without NumPy the
+per-dict code path is used.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from sockpuppet.matcher import PORT_SELECTORS, SELECTORS
+
+ENGINE_PYTHON = "python"
+ENGINE_COLUMNAR = "columnar"
+
+_WORD_BITS = 64
+_WORD_MASK = (1 << _WORD_BITS) - 1
+_PORTS = 65536
+
+
+def available():
+    return numpy is not None
+
+
+def _factorize(values):
+    """Return the distinct values and the position of each value in them"""
+    column = numpy.array(values)
+    if column.dtype.kind in "iu":
+        distinct, inverse = numpy.unique(column, return_inverse=True)
+        return distinct.tolist(), inverse.reshape(-1)
+    # labels of mixed types (e.g. missing ones) are not orderable
+    positions = {}
+    inverse = numpy.fromiter(
+        (positions.setdefault(x, len(positions)) for x in values),
+        dtype=numpy.int64, count=len(values))
+    return list(positions), inverse
+
+
+def label_columns(flows, selectors=SELECTORS):
+    """Return the selector label values of each flow, one list per selector
+    """
+    return dict((item, [flow.get(item) for flow in flows])
+                for item in selectors)
+
+
+class ColumnarMatcher(object):
+    """Matches whole socket tables against a :class:`FlowMatcher`
+
+    The flow masks of every port number are computed once, so matching a
+    port column is a single table lookup. The masks of other label values
+    are cached as they are seen.
+    """
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.words = (len(matcher.flows) + _WORD_BITS - 1) // _WORD_BITS
+        # selector to the masks of each port, the last entry for no port
+        self.port_tables = {}
+        # selector to a dict of label value to masks
+        self.cache = dict((index.item, {}) for index in matcher.indexes)
+
+    def _split(self, mask):
+        words = numpy.zeros(self.words, dtype=numpy.uint64)
+        word = 0
+        while mask:
+            words[word] = mask & _WORD_MASK
+            mask >>= _WORD_BITS
+            word += 1
+        return words
+
+    def _words(self, index, value):
+        return self._split(index.lookup({index.item: value}))
+
+    def _port_table(self, index):
+        """Build the masks of every port from the selector index"""
+        table = self.port_tables.get(index.item)
+        if table is not None:
+            return table
+        table = numpy.empty((self.words, _PORTS + 1), dtype=numpy.uint64)
+        table[:] = self._split(index.wildcard)[:, None]
+        if index.intervals is not None:
+            bounds = index.intervals.bounds
+            for start, end, mask in zip(bounds, bounds[1:] + [_PORTS],
+                                        index.intervals.masks):
+                start, end = max(start, 0), min(end, _PORTS)
+                if mask and start < end:
+                    table[:, start:end] |= self._split(mask)[:, None]
+        for value, mask in index.exact.items():
+            if isinstance(value, int) and 0 <= value < _PORTS:
+                table[:, value] |= self._split(mask)
+        for predicate, bit in index.slow:
+            words = self._split(bit)
+            for port in range(_PORTS):
+                if predicate(port):
+                    table[:, port] |= words
+        table[:, _PORTS] = self._words(index, None)
+        self.port_tables[index.item] = table
+        return table
+
+    def selector_masks(self, index, values):
+        """Return the flow masks accepting each value, as (words, n)"""
+        if index.item in PORT_SELECTORS:
+            ports = numpy.array([_PORTS if x is None else x for x in values])
+            if ports.dtype.kind in "iu" and (
+                    not len(ports) or
+                    (ports.min() >= 0 and ports.max() <= _PORTS)):
+                # _PORTS itself is the entry for sockets without a port
+                return self._port_table(index)[:, ports]
+        cache = self.cache[index.item]
+        distinct, inverse = _factorize(values)
+        table = numpy.empty((self.words, len(distinct)), dtype=numpy.uint64)
+        for i, value in enumerate(distinct):
+            words = cache.get(value)
+            if words is None:
+                words = cache[value] = self._words(index, value)
+            table[:, i] = words
+        return table[:, inverse]
+
+    def match(self, flows):
+        """Return the index of the first flow matching each socket, or -1"""
+        count = len(flows)
+        result = numpy.full(count, -1, dtype=numpy.int64)
+        if not count or not self.words:
+            return result
+        # selectors that no flow uses accept every socket
+        indexes = [x for x in self.matcher.indexes
+                   if x.wildcard & self.matcher.all != self.matcher.all]
+        columns = label_columns(flows, [x.item for x in indexes])
+        masks = numpy.empty((self.words, count), dtype=numpy.uint64)
+        masks[:] = self._split(self.matcher.all)[:, None]
+        for index in indexes:
+            masks &= self.selector_masks(index, columns[index.item])
+        for word in range(self.words):
+            mask = masks[word]
+            todo = (result < 0) & (mask != 0)
+            if not todo.any():
+                continue
+            mask = mask[todo]
+            lowest = mask & (~mask + numpy.uint64(1))
+            result[todo] = word * _WORD_BITS + numpy.log2(
+                lowest.astype(numpy.float64)).astype(numpy.int64)
+        return result
+
+
+def match_flows(matcher, flows):
+    """Return the index of the first flow matching each socket, or -1"""
+    return ColumnarMatcher(matcher).match(flows)
+
+
+def value_matrix(rows, columns):
+    """Return the given columns of the extracted rows as a float array
+
+    Missing values become NaN.
+    """
+    if not rows or not columns:
+        return numpy.zeros((len(rows), columns))
+    return numpy.array([row[:columns] for row in rows],
+                       dtype=numpy.float64).reshape(len(rows), columns)
+
+
+def group_reduce(groups, count, values):
+    """Reduce the values of each group in bulk
+
+    Args:
+      groups: int array with the group of each row
+      count (int): number of groups
+      values: float array of the same length, NaN values are ignored
+
+    Returns:
+      tuple: (total, maximum, count) arrays indexed by group
+    """
+    present = ~numpy.isnan(values)
+    groups = groups[present]
+    values = values[present]
+    total = numpy.bincount(groups, weights=values, minlength=count)
+    counts = numpy.bincount(groups, minlength=count)
+    maximum = numpy.full(count, -numpy.inf)
+    numpy.maximum.at(maximum, groups, values)
+    return total, maximum, counts
@@ -0,0 +1,126 @@
+"""Per-flow histograms of per-socket values
+
+A flow definition, or an individual flow, may export some of its metrics as
+one histogram per flow instead of one series per socket. ``histograms``
+maps metric ids from the catalogue to their bucket upper bounds, or to None
+for the default buckets::
+
+    {
+        "class": "ceph",
+        "histograms": {
+            "rtt": None,
+            "snd_cwnd": [1, 2, 4, 8, 16, 32, 64, 128],
+        },
+        "flows": [...],
+    }
+
+A list of metric ids is accepted as a shorthand for the default buckets.
+Only gauges can be histogrammed.
+The histograms describe the sockets of the flow at the time of the sample,
+so they are exported as gauge histograms named
+``sockpuppet_tcp_flow_<id>``.
+"""
+from bisect import bisect_right
+
+from prometheus_client.metrics_core import GaugeHistogramMetricFamily
+
+_RTT_BUCKETS = (.1, .25, .5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000,
+                2500)
+
+# default bucket upper bounds, in the units of the flow dict
+DEFAULT_BUCKETS = {
+    "rtt": _RTT_BUCKETS,
+    "rcv_rtt": _RTT_BUCKETS,
+    # microseconds
+    "min_rtt": (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000,
+                100000, 250000, 500000, 1000000),
+    "snd_cwnd": (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048),
+}
+
+_LABEL_NAMES = ["class", "flow"]
+
+
+def _parse_spec(spec, catalogue):
+    if isinstance(spec, dict):
+        items = sorted(spec.items())
+    else:
+        items = [(x, None) for x in spec]
+    result = []
+    for metric_id, buckets in items:
+        if metric_id not in catalogue:
+            raise ValueError("unknown histogram metric: {}".format(metric_id))
+        # counters only grow over a socket's lifetime, and the flow totals
+        # of the tracked counters are already named sockpuppet_tcp_flow_<id>
+        if catalogue[metric_id]["type"] == "counter":
+            raise ValueError("histogram of counter {} is not supported"
+                             .format(metric_id))
+        if buckets is None:
+            if metric_id not in DEFAULT_BUCKETS:
+                raise ValueError("histogram of {} needs buckets".format(
+                    metric_id))
+            buckets = DEFAULT_BUCKETS[metric_id]
+        buckets = tuple(float(x) for x in buckets)
+        if not buckets or list(buckets) != sorted(set(buckets)):
+            raise ValueError("histogram buckets of {} must be increasing"
+                             .format(metric_id))
+        result.append((metric_id, buckets))
+    return tuple(result)
+
+
+def flow_histograms(definitions, catalogue):
+    """Return the (metric id, buckets) histograms of each flow, in
+    definition order
+    """
+    result = []
+    for flow_definition in definitions:
+        default = flow_definition.get("histograms", ())
+        for flow in flow_definition["flows"]:
+            spec = flow.get("histograms", default)
+            result.append(_parse_spec(spec, catalogue))
+    return result
+
+
+def bucket_counts(values, buckets):
+    """Return the cumulative count of values at or below each bound
+
+    The values are sorted once and every bound is found by bisection, so a
+    flow costs O(n log n) regardless of the number of buckets.
+    """
+    values = sorted(values)
+    return [bisect_right(values, bound) for bound in buckets]
+
+
+class FlowHistograms(object):
+    """Collects the values of each flow's histograms during a scrape"""
+
+    def __init__(self):
+        # (metric id, class, flow) to (buckets, values)
+        self.series = {}
+
+    def add(self, metric_id, buckets, flow_class, flow_name, value):
+        key = (metric_id, flow_class, flow_name)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = (buckets, [])
+        series[1].append(value)
+
+    def families(self, catalogue):
+        families = {}
+        for key in sorted(self.series):
+            metric_id, flow_class, flow_name = key
+            buckets, values = self.series[key]
+            family = families.get(metric_id)
+            if family is None:
+                family = families[metric_id] = GaugeHistogramMetricFamily(
+                    "sockpuppet_tcp_flow_{}".format(metric_id),
+                    "Distribution over the sockets of a flow: {}".format(
+                        catalogue[metric_id]["help"]),
+                    labels=_LABEL_NAMES)
+            counts = bucket_counts(values, buckets)
+            family.add_metric(
+                [flow_class, flow_name],
+                [(repr(bound), count)
+                 for bound, count in zip(buckets, counts)] +
+                [("+Inf", len(values))],
+                sum(values))
+        return [families[x] for x in sorted(families)]
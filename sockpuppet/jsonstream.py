@@ -0,0 +1,124 @@
+"""Incremental parsing of ``ss2`` output
+
+``ss2`` prints a single JSON document of the form::
+
+    {"TCP": {"flows": [{...}, {...}]}, "UDP": {"flows": [...]}}
+
+Rather than building the whole document in memory, :func:`iter_flows`
+reads it in chunks and decodes the elements of each ``flows`` array one at
+a time, so the caller can throw away sockets it is not interested in as it
+goes.
+"""
+import codecs
+import json
+import re
+
+CHUNK_SIZE = 65536
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class _Reader(object):
+
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            self.buf += self.decoder.decode(b"", final=True)
+            return False
+        # drop everything that has already been consumed
+        self.buf = self.buf[self.pos:] + self.decoder.decode(chunk)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("unexpected end of ss2 output")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("expected {!r} at offset {} of ss2 output"
+                             .format(char, self.pos))
+        self.pos += 1
+
+    def separator(self, close):
+        """Consume a comma or closing bracket, returning True on the latter"""
+        char = self.peek()
+        self.pos += 1
+        if char == close:
+            return True
+        if char != ",":
+            raise ValueError("expected ',' or {!r} in ss2 output"
+                             .format(close))
+        return False
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.json.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer may continue in the next
+            # chunk
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_flows(stream, chunk_size=CHUNK_SIZE):
+    """Yield (protocol, flow) for each socket in a stream of ss2 output
+
+    Args:
+      stream: binary file like object holding the ss2 JSON output
+      chunk_size (int): number of bytes to read at a time
+    """
+    reader = _Reader(stream, chunk_size)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        protocol = reader.value()
+        reader.expect(":")
+        if reader.peek() == "{":
+            reader.expect("{")
+            while reader.peek() != "}":
+                key = reader.value()
+                reader.expect(":")
+                if key == "flows" and reader.peek() == "[":
+                    reader.expect("[")
+                    if reader.peek() == "]":
+                        reader.expect("]")
+                    else:
+                        while True:
+                            yield protocol, reader.value()
+                            if reader.separator("]"):
+                                break
+                else:
+                    reader.value()
+                if reader.separator("}"):
+                    break
+            else:
+                reader.expect("}")
+        else:
+            reader.value()
+        if reader.separator("}"):
+            return
@@ -0,0 +1,220 @@
+"""Compiled flow matching
+
+:class:`FlowMatcher` compiles ``flow_definitions`` once so that finding the
+flow a socket belongs to does not depend on the number of configured
+flows. Every flow is assigned a bit, in definition order. For each selector
+we build an index that maps a label value to the set of flows accepting it,
+and the flows matching a socket are the intersection of those sets. The
+lowest set bit is the first matching flow, which preserves the first match
+wins semantics of :func:`sockpuppet.collector.find_flow`.
+
+Address selectors may be CIDR prefixes, which are indexed in a
+:class:`~sockpuppet.prefixes.PrefixTree`.
+
+A flow applies to TCP sockets unless it has a ``protocol`` of ``"udp"``, or
+a list of protocols. A matcher only matches flows of its own protocol, but
+flows keep their definition order index.
+"""
+import bisect
+
+from sockpuppet.prefixes import PrefixTree, parse_address, parse_prefix
+
+try:
+    xrange = xrange
+except NameError:  # python3
+    xrange = range
+
+SELECTORS = ["src_port", "dst_port", "src", "dst"]
+PORT_SELECTORS = ["src_port", "dst_port"]
+ADDRESS_SELECTORS = ["src", "dst"]
+
+PROTOCOL_TCP = "tcp"
+PROTOCOL_UDP = "udp"
+PROTOCOLS = (PROTOCOL_TCP, PROTOCOL_UDP)
+
+
+def flow_protocols(flow):
+    """Return the set of protocols a flow applies to"""
+    value = flow.get("protocol", PROTOCOL_TCP)
+    protocols = set([value] if isinstance(value, str) else value)
+    for protocol in protocols:
+        if protocol not in PROTOCOLS:
+            raise ValueError("unknown protocol: {}, expected one of "
+                             "{}".format(protocol, PROTOCOLS))
+    return protocols
+
+
+def parse_port_range(value):
+    """Parse a ``"min:max"`` port range selector"""
+    split = value.split(":")
+    return int(split[0]), int(split[1])
+
+
+class _Intervals(object):
+    """Maps integers to the union of the masks of the intervals holding them
+
+    The intervals are split into non-overlapping segments, so a lookup is a
+    single bisection.
+    """
+
+    def __init__(self, intervals):
+        points = set()
+        for lo, hi, _ in intervals:
+            points.add(lo)
+            points.add(hi + 1)
+        self.bounds = sorted(points)
+        self.masks = []
+        for start in self.bounds:
+            mask = 0
+            for lo, hi, bit in intervals:
+                if lo <= start <= hi:
+                    mask |= bit
+            self.masks.append(mask)
+
+    def lookup(self, value):
+        index = bisect.bisect_right(self.bounds, value) - 1
+        if index < 0:
+            return 0
+        return self.masks[index]
+
+
+class _SelectorIndex(object):
+
+    def __init__(self, item):
+        self.item = item
+        # flows that do not use this selector
+        self.wildcard = 0
+        self.exact = {}
+        self.intervals = []
+        self.prefixes = None
+        # (predicate, bit) for selectors that cannot be indexed
+        self.slow = []
+
+    def _add_exact(self, value, bit):
+        try:
+            self.exact[value] = self.exact.get(value, 0) | bit
+        except TypeError:
+            self.slow.append((lambda x, v=value: x == v, bit))
+
+    def _add_address(self, value, bit):
+        prefix = parse_prefix(value)
+        if prefix is None:
+            self._add_exact(value, bit)
+            return
+        if self.prefixes is None:
+            self.prefixes = PrefixTree()
+        self.prefixes.add(prefix[0], prefix[1], prefix[2], bit)
+
+    def add(self, flow, bit):
+        if self.item not in flow:
+            self.wildcard |= bit
+            return
+        value = flow[self.item]
+        add = self._add_address if self.item in ADDRESS_SELECTORS \
+            else self._add_exact
+        if isinstance(value, int):
+            self._add_exact(value, bit)
+        elif isinstance(value, set):
+            for x in value:
+                add(x, bit)
+        elif isinstance(value, xrange):
+            if value.step == 1:
+                if len(value):
+                    self.intervals.append((value[0], value[-1], bit))
+            else:
+                self.slow.append((lambda x, v=value: x in v, bit))
+        elif self.item in PORT_SELECTORS and ":" in value:
+            minimum, maximum = parse_port_range(value)
+            self.intervals.append((minimum, maximum, bit))
+        else:
+            add(value, bit)
+
+    def freeze(self):
+        self.intervals = _Intervals(self.intervals) \
+            if self.intervals else None
+
+    def lookup(self, labels):
+        if self.item not in labels:
+            return self.wildcard
+        value = labels[self.item]
+        mask = self.wildcard
+        try:
+            mask |= self.exact.get(value, 0)
+        except TypeError:
+            pass
+        if self.intervals is not None and isinstance(value, int):
+            mask |= self.intervals.lookup(value)
+        if self.prefixes is not None:
+            address = parse_address(value)
+            if address is not None:
+                mask |= self.prefixes.lookup(*address)
+        for predicate, bit in self.slow:
+            if predicate(value):
+                mask |= bit
+        return mask
+
+
+class FlowMatcher(object):
+    """Finds the first flow definition matching a set of socket labels"""
+
+    def __init__(self, definitions, protocol=PROTOCOL_TCP):
+        self.flows = []
+        self.indexes = [_SelectorIndex(item) for item in SELECTORS]
+        # the flows of our protocol
+        self.all = 0
+        for flow_definition in definitions:
+            for flow in flow_definition["flows"]:
+                bit = 1 << len(self.flows)
+                self.flows.append((flow_definition, flow))
+                for index in self.indexes:
+                    index.add(flow, bit)
+                if protocol in flow_protocols(flow):
+                    self.all |= bit
+        for index in self.indexes:
+            index.freeze()
+
+    def match_index(self, labels):
+        """Return the definition order index of the first matching flow
+
+        Args:
+          labels (dict): selector name to socket label value
+
+        Returns:
+          int: index of the matching flow, or None if no flow matches
+        """
+        mask = self.all
+        for index in self.indexes:
+            mask &= index.lookup(labels)
+            if not mask:
+                return None
+        return (mask & -mask).bit_length() - 1
+
+    def match(self, labels):
+        """Return the first (flow_definition, flow) matching the labels"""
+        index = self.match_index(labels)
+        if index is None:
+            return None, None
+        return self.flows[index]
+
+
+def unchanged_flows(old, new):
+    """Map the index of each flow of ``old`` to its index in ``new``
+
+    Only flows with the same class and an identical flow dict are mapped.
+
+    Args:
+      old: the ``flows`` of a :class:`FlowMatcher`
+      new: the ``flows`` of another :class:`FlowMatcher`
+
+    Returns:
+      dict: old index to new index
+    """
+    positions = {}
+    for index, (flow_definition, flow) in enumerate(new):
+        positions.setdefault((flow_definition["class"], flow["flow"]), index)
+    result = {}
+    for index, (flow_definition, flow) in enumerate(old):
+        position = positions.get((flow_definition["class"], flow["flow"]))
+        if position is not None and new[position][1] == flow:
+            result[index] = position
+    return result
@@ -0,0 +1,426 @@
+"""In-process NETLINK_SOCK_DIAG socket statistics backend
+
+Talks to the kernel inet_diag interface directly over a long lived netlink
+socket and decodes the replies into the same flow dicts that ``ss2``
+produces, so that no process has to be forked on every scrape.
+"""
+import errno
+import logging
+import os
+import socket
+import struct
+
+from sockpuppet.process import scan_socket_owners
+
+_logger = logging.getLogger(__name__)
+
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+
+NLM_F_REQUEST = 0x1
+NLM_F_ROOT = 0x100
+NLM_F_MATCH = 0x200
+NLM_F_DUMP = NLM_F_ROOT | NLM_F_MATCH
+
+NLMSG_NOOP = 1
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+# inet_diag extensions (attribute types in the reply)
+INET_DIAG_MEMINFO = 1
+INET_DIAG_INFO = 2
+INET_DIAG_CONG = 4
+INET_DIAG_SKMEMINFO = 7
+
+# inet_diag request attributes
+INET_DIAG_REQ_BYTECODE = 1
+
+ALL_STATES = 0xffffffff
+
+TCP_STATES = {
+    1: "established",
+    2: "syn-sent",
+    3: "syn-recv",
+    4: "fin-wait-1",
+    5: "fin-wait-2",
+    6: "time-wait",
+    7: "unconnected",
+    8: "close-wait",
+    9: "last-ack",
+    10: "listening",
+    11: "closing",
+}
+
+TCPI_OPTS = (
+    (0x01, "ts"),
+    (0x02, "sack"),
+    (0x04, "wscale"),
+    (0x08, "ecn"),
+    (0x10, "ecnseen"),
+    (0x20, "fastopen"),
+)
+
+_NLMSGHDR = struct.Struct("=IHHII")
+_RTATTR = struct.Struct("=HH")
+_NLMSGERR = struct.Struct("=i")
+# struct inet_diag_req_v2 followed by struct inet_diag_sockid
+_INET_DIAG_REQ_V2 = struct.Struct("=BBBxI48x")
+# struct inet_diag_msg, ports are big endian and swapped after unpacking
+_INET_DIAG_MSG = struct.Struct("=BBBBHH16s16sIQIIIII")
+_INET_DIAG_MEMINFO = struct.Struct("=IIII")
+
+# the u32 array of SK_MEMINFO_* values, in order. Older kernels send fewer.
+SK_MEMINFO_FIELDS = ("rmem_alloc", "rcvbuf", "wmem_alloc", "sndbuf",
+                     "fwd_alloc", "wmem_queued", "optmem", "backlog", "drops")
+
+# struct tcp_info from linux/tcp.h. The kernel only sends as much of the
+# struct as it knows about, so fields are decoded up to the reply length.
+_TCP_INFO_FIELDS = (
+    ("state", "B"),
+    ("ca_state", "B"),
+    ("retransmits", "B"),
+    ("probes", "B"),
+    ("backoff", "B"),
+    ("options", "B"),
+    ("wscale", "B"),
+    ("app_limited", "B"),
+    ("rto", "I"),
+    ("ato", "I"),
+    ("snd_mss", "I"),
+    ("rcv_mss", "I"),
+    ("unacked", "I"),
+    ("sacked", "I"),
+    ("lost", "I"),
+    ("retrans", "I"),
+    ("fackets", "I"),
+    ("last_data_sent", "I"),
+    ("last_ack_sent", "I"),
+    ("last_data_recv", "I"),
+    ("last_ack_recv", "I"),
+    ("pmtu", "I"),
+    ("rcv_ssthresh", "I"),
+    ("rtt", "I"),
+    ("rttvar", "I"),
+    ("snd_ssthresh", "I"),
+    ("snd_cwnd", "I"),
+    ("advmss", "I"),
+    ("reordering", "I"),
+    ("rcv_rtt", "I"),
+    ("rcv_space", "I"),
+    ("total_retrans", "I"),
+    ("pacing_rate", "Q"),
+    ("max_pacing_rate", "Q"),
+    ("bytes_acked", "Q"),
+    ("bytes_received", "Q"),
+    ("segs_out", "I"),
+    ("segs_in", "I"),
+    ("notsent_bytes", "I"),
+    ("min_rtt", "I"),
+    ("data_segs_in", "I"),
+    ("data_segs_out", "I"),
+    ("delivery_rate", "Q"),
+    ("busy_time", "Q"),
+    ("rwnd_limited", "Q"),
+    ("sndbuf_limited", "Q"),
+    ("delivered", "I"),
+    ("delivered_ce", "I"),
+    ("bytes_sent", "Q"),
+    ("bytes_retrans", "Q"),
+    ("dsack_dups", "I"),
+    ("reord_seen", "I"),
+    ("rcv_ooopack", "I"),
+    ("snd_wnd", "I"),
+)
+
+# fields reported in milliseconds by ss2, the kernel uses microseconds
+_TCP_INFO_USEC_FIELDS = ("rto", "ato", "rtt", "rttvar", "rcv_rtt")
+
+_TCP_INFINITE_SSTHRESH = 0xFFFF
+
+
+def _build_tcp_info_structs():
+    structs = []
+    fmt = "="
+    for _, code in _TCP_INFO_FIELDS:
+        fmt += code
+        structs.append(struct.Struct(fmt))
+    return structs
+
+
+# _TCP_INFO_STRUCTS[n - 1] decodes the first n fields
+_TCP_INFO_STRUCTS = _build_tcp_info_structs()
+
+
+def decode_tcp_info(data):
+    """Decode a raw ``struct tcp_info`` into an ss2 style dict"""
+    n = 0
+    for s in _TCP_INFO_STRUCTS:
+        if s.size > len(data):
+            break
+        n += 1
+    if n == 0:
+        return None
+    values = _TCP_INFO_STRUCTS[n - 1].unpack_from(data)
+    raw = dict(zip((name for name, _ in _TCP_INFO_FIELDS), values))
+    info = {}
+    for name, value in raw.items():
+        if name in ("wscale", "app_limited", "options", "state"):
+            continue
+        info[name] = value
+    info["state"] = TCP_STATES.get(raw["state"], "unknown")
+    info["opts"] = [name for bit, name in TCPI_OPTS if raw["options"] & bit]
+    info["snd_wscale"] = raw["wscale"] & 0x0f
+    info["rcv_wscale"] = raw["wscale"] >> 4
+    info["delivery_rate_app_limited"] = raw["app_limited"] & 0x01
+    for name in _TCP_INFO_USEC_FIELDS:
+        if name in info:
+            info[name] = info[name] / 1000.0
+    if info.get("snd_ssthresh", 0) >= _TCP_INFINITE_SSTHRESH:
+        info["snd_ssthresh"] = None
+    return info
+
+
+def _format_address(family, raw):
+    if family == socket.AF_INET:
+        return socket.inet_ntop(family, raw[:4])
+    return socket.inet_ntop(family, raw)
+
+
+def _iter_attributes(data, offset):
+    end = len(data)
+    while offset + _RTATTR.size <= end:
+        length, kind = _RTATTR.unpack_from(data, offset)
+        if length < _RTATTR.size:
+            break
+        yield kind, data[offset + _RTATTR.size:offset + length]
+        offset += (length + 3) & ~3
+
+
+def decode_skmeminfo(data):
+    count = min(len(data) // 4, len(SK_MEMINFO_FIELDS))
+    values = struct.unpack_from("={}I".format(count), data)
+    return dict(zip(SK_MEMINFO_FIELDS, values))
+
+
+def decode_inet_diag_msg(data, protocol=socket.IPPROTO_TCP):
+    """Decode the payload of a SOCK_DIAG_BY_FAMILY reply into a flow dict"""
+    (family, state, _timer, retrans, sport, dport, src, dst, iface,
+     _cookie, _expires, rqueue, wqueue, _uid,
+     inode) = _INET_DIAG_MSG.unpack_from(data)
+    flow = {
+        "src": _format_address(family, src),
+        "dst": _format_address(family, dst),
+        "src_port": socket.ntohs(sport),
+        "dst_port": socket.ntohs(dport),
+        "inode": inode,
+        "iface_idx": iface,
+        "retrans": retrans,
+    }
+    for kind, payload in _iter_attributes(data, _INET_DIAG_MSG.size):
+        if kind == INET_DIAG_MEMINFO:
+            r, w, f, t = _INET_DIAG_MEMINFO.unpack_from(payload)
+            flow["meminfo"] = {"r": r, "w": w, "f": f, "t": t}
+        elif kind == INET_DIAG_INFO:
+            tcp_info = decode_tcp_info(payload)
+            if tcp_info is not None:
+                flow["tcp_info"] = tcp_info
+        elif kind == INET_DIAG_CONG:
+            flow["cong_algo"] = payload.rstrip(b"\0").decode("ascii")
+        elif kind == INET_DIAG_SKMEMINFO:
+            flow["skmeminfo"] = decode_skmeminfo(payload)
+    if protocol == socket.IPPROTO_UDP:
+        flow["rqueue"] = rqueue
+        flow["wqueue"] = wqueue
+        flow["state"] = TCP_STATES.get(state, "unknown")
+    elif "tcp_info" not in flow:
+        flow["tcp_info"] = {"state": TCP_STATES.get(state, "unknown")}
+    return flow
+
+
+def _ext_mask(*extensions):
+    mask = 0
+    for ext in extensions:
+        mask |= 1 << (ext - 1)
+    return mask
+
+
+class SockDiag(object):
+    """A long lived NETLINK_SOCK_DIAG socket
+
+    The socket is opened lazily and kept open between scrapes. It is
+    reopened if the kernel reports an error that leaves it unusable.
+    """
+
+    def __init__(self, bufsize=65536):
+        self.bufsize = bufsize
+        self.sock = None
+        self.seq = 0
+
+    def open(self):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                      NETLINK_SOCK_DIAG)
+            self.sock.bind((0, 0))
+        return self.sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _request(self, family, protocol, ext, states, bytecode):
+        self.seq += 1
+        payload = _INET_DIAG_REQ_V2.pack(family, protocol, ext, states)
+        if bytecode:
+            length = _RTATTR.size + len(bytecode)
+            payload += _RTATTR.pack(length, INET_DIAG_REQ_BYTECODE)
+            payload += bytecode + b"\0" * (-length % 4)
+        header = _NLMSGHDR.pack(_NLMSGHDR.size + len(payload),
+                                SOCK_DIAG_BY_FAMILY,
+                                NLM_F_REQUEST | NLM_F_DUMP, self.seq, 0)
+        return header + payload
+
+    def dump(self, family, protocol, ext, states=ALL_STATES, bytecode=None):
+        """Dump sockets, yielding the raw payload of each reply message"""
+        sock = self.open()
+        try:
+            sock.send(self._request(family, protocol, ext, states, bytecode))
+            while True:
+                data = sock.recv(self.bufsize)
+                offset = 0
+                while offset + _NLMSGHDR.size <= len(data):
+                    length, kind, _flags, seq, _pid = \
+                        _NLMSGHDR.unpack_from(data, offset)
+                    if length < _NLMSGHDR.size:
+                        raise IOError(errno.EIO, "truncated netlink message")
+                    body = data[offset + _NLMSGHDR.size:offset + length]
+                    offset += (length + 3) & ~3
+                    if seq != self.seq or kind == NLMSG_NOOP:
+                        continue
+                    if kind == NLMSG_DONE:
+                        return
+                    if kind == NLMSG_ERROR:
+                        code, = _NLMSGERR.unpack_from(body)
+                        if code == 0:
+                            continue
+                        raise OSError(-code, os.strerror(-code))
+                    if kind == SOCK_DIAG_BY_FAMILY:
+                        yield body
+        except (IOError, OSError):
+            # the reply stream is out of sync, start afresh next time
+            self.close()
+            raise
+
+    def dump_tcp(self, bytecode=None):
+        """Dump the TCP sockets of both address families"""
+        ext = _ext_mask(INET_DIAG_MEMINFO, INET_DIAG_INFO, INET_DIAG_CONG)
+        for family in (socket.AF_INET, socket.AF_INET6):
+            for body in self.dump(family, socket.IPPROTO_TCP, ext,
+                                  bytecode=bytecode):
+                yield body
+
+    def dump_udp(self, bytecode=None):
+        """Dump the UDP sockets of both address families"""
+        ext = _ext_mask(INET_DIAG_MEMINFO, INET_DIAG_SKMEMINFO)
+        for family in (socket.AF_INET, socket.AF_INET6):
+            for body in self.dump(family, socket.IPPROTO_UDP, ext,
+                                  bytecode=bytecode):
+                yield body
+
+    def dump_replies(self, tcp=True, udp=False, bytecode=None,
+                     udp_bytecode=None, namespaces=None):
+        """Yield the raw TCP and UDP replies of each network namespace
+
+        Yields (netns, tcp bodies, udp bodies), our own namespace first and
+        while the others are still being dumped. netns is None without
+        namespaces, "" for our own namespace otherwise.
+        """
+        def dump(sock_diag):
+            return (list(sock_diag.dump_tcp(bytecode)) if tcp else [],
+                    list(sock_diag.dump_udp(udp_bytecode)) if udp else [])
+
+        pending = None
+        if namespaces is not None and (tcp or udp):
+            # the namespaces are dumped while we dump our own
+            pending = namespaces.submit(dump)
+        tcp_bodies, udp_bodies = dump(self)
+        yield None if pending is None else "", tcp_bodies, udp_bodies
+        if pending is not None:
+            for name, (tcp_bodies, udp_bodies) in namespaces.wait(pending):
+                yield name, tcp_bodies, udp_bodies
+
+    def get_socket_stats(self, tcp=True, process=False, bytecode=None,
+                         flow_filter=None, process_cache=None,
+                         namespaces=None, udp=False, udp_bytecode=None,
+                         udp_flow_filter=None):
+        """Return socket statistics in the same format as ``ss2``
+
+        Args:
+          tcp (bool): collect TCP sockets
+          process (bool): fill in the processes owning each socket
+          bytecode (bytes): inet_diag filter to run in the kernel
+          flow_filter (callable): only keep flows for which this is True
+          process_cache (ProcessCache): where to look up the processes
+          namespaces (NamespacePool): also collect the sockets of these
+            network namespaces, setting ``netns`` in every flow
+          udp (bool): collect UDP sockets
+          udp_bytecode (bytes): like bytecode, for UDP sockets
+          udp_flow_filter (callable): like flow_filter, for UDP sockets
+        """
+        tcp_flows, udp_flows = [], []
+        for netns, tcp_bodies, udp_bodies in self.dump_replies(
+                tcp, udp, bytecode, udp_bytecode, namespaces):
+            tcp_flows.extend(decode_flows(tcp_bodies, flow_filter, netns))
+            udp_flows.extend(decode_flows(udp_bodies, udp_flow_filter,
+                                          netns, socket.IPPROTO_UDP))
+        stats = {}
+        if tcp:
+            stats["TCP"] = {"flows": tcp_flows}
+        if udp:
+            stats["UDP"] = {"flows": udp_flows}
+        if process:
+            add_process_info(stats, process_cache)
+        return stats
+
+
+def decode_flows(bodies, flow_filter=None, netns=None,
+                 protocol=socket.IPPROTO_TCP):
+    """Decode sock_diag replies into flows
+
+    Args:
+      bodies: raw payloads of the reply messages
+      flow_filter (callable): only keep flows for which this is True
+      netns (str): network namespace to record in each flow, if any
+      protocol (int): IPPROTO_TCP or IPPROTO_UDP
+    """
+    flows = []
+    for body in bodies:
+        flow = decode_inet_diag_msg(body, protocol)
+        if netns is not None:
+            flow["netns"] = netns
+        if flow_filter is None or flow_filter(flow):
+            flows.append(flow)
+    return flows
+
+
+def add_process_info(stats, process_cache=None):
+    """Fill in ``usr_ctxt`` for each flow, as ``ss2 -p`` would
+
+    Args:
+      process_cache (ProcessCache): resolve the owners through this cache
+        rather than walking ``/proc``
+    """
+    inodes = set()
+    for protocol in stats.values():
+        inodes.update(flow["inode"] for flow in protocol["flows"])
+    if process_cache is not None:
+        owners = process_cache.resolve(inodes)
+    elif inodes:
+        owners = scan_socket_owners(inodes)
+    else:
+        return
+    for protocol in stats.values():
+        for flow in protocol["flows"]:
+            usr_ctxt = owners.get(flow["inode"])
+            if usr_ctxt:
+                flow["usr_ctxt"] = usr_ctxt
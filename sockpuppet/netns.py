@@ -0,0 +1,197 @@
+"""Collecting the sockets of other network namespaces
+
+A netlink socket reports on the network namespace it was created in. Each
+namespace is served by a :class:`NamespaceWorker`, a thread that enters the
+namespace with ``setns(2)`` once and then keeps its own
+:class:`~sockpuppet.netlink.SockDiag` open between scrapes. The workers of a
+:class:`NamespacePool` dump their namespaces in parallel; the replies are
+decoded by the collecting thread.
+
+Set ``namespaces`` in the config file to a list of names in
+``/var/run/netns`` (as created by ``ip netns``), or to ``"all"`` to follow
+every namespace there. Entering a namespace requires ``CAP_SYS_ADMIN``.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import threading
+
+try:
+    import queue
+except ImportError:  # python2
+    import Queue as queue
+
+from sockpuppet.netlink import SockDiag
+
+_logger = logging.getLogger(__name__)
+
+NETNS_DIR = "/var/run/netns"
+ALL_NAMESPACES = "all"
+
+CLONE_NEWNET = 0x40000000
+
+# seconds to wait for a namespace to be dumped
+DEFAULT_TIMEOUT = 30.0
+
+_libc = None
+
+
+def enter_namespace(path):
+    """Move the calling thread into the network namespace at path"""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _libc.setns(fd, CLONE_NEWNET) != 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), path)
+    finally:
+        os.close(fd)
+
+
+def check_namespaces(namespaces):
+    """Validate the ``namespaces`` config option"""
+    if namespaces == ALL_NAMESPACES:
+        return namespaces
+    if not isinstance(namespaces, (list, tuple)) or \
+            not all(isinstance(x, str) and x for x in namespaces):
+        raise ValueError("namespaces must be a list of names or {!r}"
+                         .format(ALL_NAMESPACES))
+    return list(namespaces)
+
+
+class NamespaceWorker(object):
+    """A thread dumping the sockets of one network namespace"""
+
+    def __init__(self, name, path, enter=enter_namespace):
+        self.name = name
+        self.path = path
+        self.enter = enter
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(
+            target=self._run, name="sockpuppet-netns-{}".format(name))
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.requests.put(None)
+
+    def submit(self, dump, replies):
+        """Call dump with our SockDiag, putting (name, error, result) on
+        replies
+        """
+        self.requests.put((dump, replies))
+
+    def _run(self):
+        try:
+            self.enter(self.path)
+            error = None
+        except (IOError, OSError) as e:
+            error = e
+        sock_diag = SockDiag()
+        try:
+            while True:
+                request = self.requests.get()
+                if request is None:
+                    break
+                dump, replies = request
+                if error is not None:
+                    # never dump the namespace we were started in instead
+                    replies.put((self.name, error, None))
+                    continue
+                try:
+                    replies.put((self.name, None, dump(sock_diag)))
+                except (IOError, OSError) as e:
+                    replies.put((self.name, e, None))
+        finally:
+            sock_diag.close()
+
+
+class NamespacePool(object):
+    """One :class:`NamespaceWorker` per configured network namespace
+
+    Args:
+      namespaces: list of namespace names, or ``"all"``
+      netns_dir (str): where the named namespaces are found
+    """
+
+    def __init__(self, namespaces, netns_dir=NETNS_DIR,
+                 enter=enter_namespace, timeout=DEFAULT_TIMEOUT):
+        self.namespaces = check_namespaces(namespaces)
+        self.netns_dir = netns_dir
+        self.enter = enter
+        self.timeout = timeout
+        self.workers = {}
+        # namespace name to the number of failed dumps
+        self.errors = {}
+
+    def names(self):
+        if self.namespaces != ALL_NAMESPACES:
+            return self.namespaces
+        try:
+            return sorted(os.listdir(self.netns_dir))
+        except OSError as e:
+            _logger.warning("Failed to list network namespaces in {}: {}"
+                            .format(self.netns_dir, e))
+            return []
+
+    def refresh(self):
+        """Start workers for new namespaces and stop the rest"""
+        names = self.names()
+        for name in set(self.workers) - set(names):
+            self.workers.pop(name).stop()
+        for name in names:
+            if name not in self.workers:
+                worker = NamespaceWorker(
+                    name, os.path.join(self.netns_dir, name), self.enter)
+                worker.start()
+                self.workers[name] = worker
+
+    def submit(self, dump):
+        """Call dump with the SockDiag of every namespace, see :meth:`wait`
+        """
+        self.refresh()
+        replies = queue.Queue()
+        for worker in self.workers.values():
+            worker.submit(dump, replies)
+        return replies, set(self.workers)
+
+    def wait(self, pending):
+        """Yield (name, result) for each namespace dumped successfully
+
+        Workers that failed, or did not answer in time, are replaced on the
+        next scrape.
+        """
+        replies, names = pending
+        waiting = set(names)
+        while waiting:
+            try:
+                name, error, result = replies.get(timeout=self.timeout)
+            except queue.Empty:
+                _logger.error("Timed out waiting for network namespaces {}"
+                              .format(", ".join(sorted(waiting))))
+                for name in waiting:
+                    self._failed(name)
+                return
+            waiting.discard(name)
+            if error is None:
+                yield name, result
+                continue
+            _logger.error("Failed to collect network namespace {}: {}"
+                          .format(name, error))
+            self._failed(name)
+
+    def _failed(self, name):
+        self.errors[name] = self.errors.get(name, 0) + 1
+        worker = self.workers.pop(name, None)
+        if worker is not None:
+            worker.stop()
+
+    def close(self):
+        for worker in self.workers.values():
+            worker.stop()
+        self.workers = {}
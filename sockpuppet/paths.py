@@ -0,0 +1,145 @@
+"""Helpers for the field paths used to pull values out of flow dicts"""
+import re
+
+import jmespath
+
+_DOTTED = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+# matches any key when used in a projection
+WILDCARD = "*"
+
+
+def dotted_keys(path):
+    """Split a simple ``a.b.c`` path into its keys
+
+    Returns:
+      tuple: the keys, or None if the path is a more complex expression
+    """
+    if not _DOTTED.match(path):
+        return None
+    return tuple(path.split("."))
+
+
+def projection(key_paths):
+    """Build a projection keeping only the given key paths
+
+    Args:
+      key_paths: iterable of key tuples, as returned by :func:`dotted_keys`,
+        which may contain :data:`WILDCARD`. None means the whole flow is
+        needed.
+
+    Returns:
+      dict: nested dict of the keys to keep, a value of True keeps the whole
+      subtree. None if nothing can be dropped.
+    """
+    spec = {}
+    for keys in key_paths:
+        if keys is None:
+            return None
+        node = spec
+        for key in keys[:-1]:
+            child = node.get(key)
+            if child is True:
+                break
+            if child is None:
+                child = node[key] = {}
+            node = child
+        else:
+            node[keys[-1]] = True
+    return spec
+
+
+def project(value, spec):
+    """Return a copy of value holding only the fields listed in spec"""
+    if spec is True or not isinstance(value, dict):
+        return value
+    if WILDCARD in spec:
+        sub = spec[WILDCARD]
+        return dict((k, project(v, sub)) for k, v in value.items())
+    return dict((k, project(value[k], sub)) for k, sub in spec.items()
+                if k in value)
+
+
+def accessor(path):
+    """Compile a path into a function returning its value in a flow
+
+    Simple dotted paths become plain dict lookups, anything else is handed
+    to jmespath. Missing values are returned as None.
+    """
+    keys = dotted_keys(path)
+    if keys is None:
+        return jmespath.compile(path).search
+    return _key_getter(keys)
+
+
+def _key_getter(keys):
+    if len(keys) == 1:
+        key, = keys
+
+        def get(value):
+            return value.get(key) if isinstance(value, dict) else None
+        return get
+
+    def get_path(value):
+        for key in keys:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+    return get_path
+
+
+class FieldExtractor(object):
+    """Extract the values of several paths from a flow in a single pass
+
+    The dotted paths are merged into a tree so that shared prefixes such as
+    ``tcp_info`` are only looked up once per flow. Paths that are not
+    simple dotted paths fall back to jmespath.
+
+    Args:
+      paths: the path expressions, values are returned in the same order
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.tree = {}
+        self.searches = []
+        for index, path in enumerate(self.paths):
+            keys = dotted_keys(path)
+            if keys is None:
+                self.searches.append(
+                    (index, jmespath.compile(path).search))
+                continue
+            node = self.tree
+            for key in keys[:-1]:
+                child = node.get(key)
+                if not isinstance(child, dict):
+                    child = node[key] = {}
+                node = child
+            # a path may be both a leaf and a prefix of another path
+            node.setdefault(None, {}).setdefault(keys[-1], []).append(index)
+        self.walk = _tree_walker(self.tree)
+
+    def __call__(self, flow):
+        values = [None] * len(self.paths)
+        self.walk(flow, values)
+        for index, search in self.searches:
+            values[index] = search(flow)
+        return values
+
+
+def _tree_walker(tree):
+    leaves = list(tree.get(None, {}).items())
+    children = [(key, _tree_walker(child)) for key, child in tree.items()
+                if key is not None]
+
+    def walk(value, values):
+        if not isinstance(value, dict):
+            return
+        for key, indexes in leaves:
+            leaf = value.get(key)
+            for index in indexes:
+                values[index] = leaf
+        for key, child in children:
+            child(value.get(key), values)
+    return walk
@@ -0,0 +1,170 @@
+"""CIDR prefix selectors for socket addresses
+
+The ``src`` and ``dst`` selectors of a flow accept addresses and CIDR
+prefixes, alone or in a set::
+
+    {
+        "flow": "storage",
+        "dst": {"10.42.0.0/16", "2001:db8::/32", "192.168.246.128"},
+    }
+
+Addresses are normalised before they are compared, so IPv4-mapped IPv6
+addresses such as ``::ffff:10.42.0.4``, which dual-stack sockets report,
+match IPv4 prefixes, and equivalent spellings of an IPv6 address match each
+other. Values that are not addresses are compared as strings.
+
+:class:`PrefixTree` holds the prefixes of all flows in a path-compressed
+binary radix (patricia) tree per address family, so a lookup visits at
+most one node per prefix length, however many prefixes are configured.
+"""
+import socket
+import struct
+
+try:
+    _TEXT_TYPES = (str, unicode)
+except NameError:  # python3
+    _TEXT_TYPES = (str,)
+
+_MAPPED_PREFIX = b"\0" * 10 + b"\xff\xff"
+
+# address family to the number of bits of its addresses
+WIDTHS = {socket.AF_INET: 32, socket.AF_INET6: 128}
+
+
+def _to_int(packed):
+    high, low = struct.unpack("!QQ", packed.rjust(16, b"\0"))
+    return high << 64 | low
+
+
+def parse_address(value):
+    """Return the (family, packed address) of a textual address
+
+    IPv4-mapped IPv6 addresses are returned as IPv4 addresses.
+
+    Returns:
+      tuple: (family, packed), or None if value is not an address
+    """
+    if not isinstance(value, _TEXT_TYPES):
+        return None
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            packed = socket.inet_pton(family, value)
+        except (socket.error, ValueError):
+            continue
+        if family == socket.AF_INET6 and packed.startswith(_MAPPED_PREFIX):
+            return socket.AF_INET, packed[12:]
+        return family, packed
+    return None
+
+
+def parse_prefix(value):
+    """Parse an ``"address[/length]"`` selector
+
+    Returns:
+      tuple: (family, packed network address, prefix length), or None if
+      value is not an address or prefix
+    """
+    if not isinstance(value, _TEXT_TYPES):
+        return None
+    address, _, length = value.partition("/")
+    parsed = parse_address(address)
+    if parsed is None:
+        return None
+    family, packed = parsed
+    width = WIDTHS[family]
+    if not length:
+        return family, packed, width
+    try:
+        length = int(length)
+    except ValueError:
+        raise ValueError("invalid prefix length: {}".format(value))
+    if family == socket.AF_INET and ":" in address:
+        # a prefix of ::ffff:0:0/96
+        length -= 96
+    if not 0 <= length <= width:
+        raise ValueError("invalid prefix length: {}".format(value))
+    network = _to_int(packed) >> (width - length) << (width - length)
+    packed = struct.pack("!QQ", network >> 64,
+                         network & 0xffffffffffffffff)[-width // 8:]
+    return family, packed, length
+
+
+class _Node(object):
+
+    __slots__ = ("key", "length", "mask", "children")
+
+    def __init__(self, key, length, mask=0):
+        # the prefix, left aligned in the address width
+        self.key = key
+        self.length = length
+        self.mask = mask
+        self.children = [None, None]
+
+
+class PrefixTree(object):
+    """Maps addresses to the union of the masks of the prefixes holding them
+    """
+
+    def __init__(self):
+        self.roots = dict((family, _Node(0, 0)) for family in WIDTHS)
+        self.size = 0
+
+    def add(self, family, packed, length, mask):
+        width = WIDTHS[family]
+        key = _to_int(packed)
+        node = self.roots[family]
+        self.size += 1
+        while True:
+            if length == node.length:
+                node.mask |= mask
+                return
+            branch = key >> (width - node.length - 1) & 1
+            child = node.children[branch]
+            if child is None:
+                node.children[branch] = _Node(key, length, mask)
+                return
+            common = min(width - (key ^ child.key).bit_length(), length,
+                         child.length)
+            if common < child.length:
+                # split the edge to the child at the common prefix
+                shift = width - common
+                middle = _Node(key >> shift << shift, common)
+                middle.children[child.key >> (shift - 1) & 1] = child
+                node.children[branch] = middle
+                child = middle
+            node = child
+
+    def lookup(self, family, packed):
+        width = WIDTHS[family]
+        key = _to_int(packed)
+        node = self.roots[family]
+        mask = 0
+        while node is not None:
+            if (key ^ node.key) >> (width - node.length):
+                break
+            mask |= node.mask
+            if node.length == width:
+                break
+            node = node.children[key >> (width - node.length - 1) & 1]
+        return mask
+
+
+def address_matches(selector, value):
+    """Linear reference for an address selector, see find_flow"""
+    values = selector if isinstance(selector, (set, frozenset)) \
+        else [selector]
+    address = parse_address(value)
+    for item in values:
+        prefix = parse_prefix(item)
+        if prefix is None or address is None:
+            if item == value:
+                return True
+            continue
+        family, network, length = prefix
+        if family != address[0]:
+            continue
+        width = WIDTHS[family]
+        if _to_int(address[1]) >> (width - length) == \
+                _to_int(network) >> (width - length):
+            return True
+    return False
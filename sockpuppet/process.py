@@ -0,0 +1,151 @@
+"""Finding the processes that own sockets"""
+import logging
+import os
+import pwd
+import time
+
+_logger = logging.getLogger(__name__)
+
+_PROC = "/proc"
+_SOCKET_LINK_PREFIX = "socket:["
+
+# seconds for which the owner of a socket is remembered
+DEFAULT_CACHE_TTL = 60
+DEFAULT_CACHE_SIZE = 200000
+
+
+def _user_name(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+
+def _read_cmdline(pid):
+    with open(os.path.join(_PROC, pid, "cmdline"), "rb") as f:
+        raw = f.read()
+    return [x.decode("utf-8", "replace") for x in raw.split(b"\0") if x]
+
+
+def _read_comm(pid):
+    with open(os.path.join(_PROC, pid, "comm"), "rb") as f:
+        return f.read().rstrip(b"\n").decode("utf-8", "replace")
+
+
+def scan_socket_owners(inodes=None):
+    """Map socket inodes to the processes holding them open
+
+    This walks ``/proc/<pid>/fd`` in the same way as ``ss -p``. Processes
+    that we do not have permission to inspect are silently skipped.
+
+    Args:
+      inodes (set): only report these inodes, or all sockets if None
+
+    Returns:
+      dict: inode to ``usr_ctxt`` dict, in the format produced by ``ss2``
+    """
+    owners = {}
+    try:
+        pids = [x for x in os.listdir(_PROC) if x.isdigit()]
+    except OSError as e:
+        _logger.error("Failed to list {}: {}".format(_PROC, e))
+        return owners
+    for pid in pids:
+        fd_dir = os.path.join(_PROC, pid, "fd")
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        found = []
+        for fd in fds:
+            try:
+                link = os.readlink(os.path.join(fd_dir, fd))
+            except OSError:
+                continue
+            if not link.startswith(_SOCKET_LINK_PREFIX):
+                continue
+            inode = int(link[len(_SOCKET_LINK_PREFIX):-1])
+            if inodes is None or inode in inodes:
+                found.append((inode, int(fd)))
+        if not found:
+            continue
+        try:
+            uid = os.stat(os.path.join(_PROC, pid)).st_uid
+            full_cmd = _read_cmdline(pid)
+            # the cmdline is empty for kernel threads, zombies and
+            # processes that blanked their argv
+            cmd = full_cmd[0] if full_cmd else _read_comm(pid)
+        except (IOError, OSError):
+            # process exited while we were looking at it
+            continue
+        user = _user_name(uid)
+        for inode, fd in found:
+            usr_ctxt = owners.setdefault(inode, {})
+            entry = usr_ctxt.setdefault(user, {}).setdefault(pid, {
+                "full_cmd": full_cmd,
+                "cmd": cmd,
+                "fds": [],
+            })
+            entry["fds"].append(fd)
+    return owners
+
+
+class ProcessCache(object):
+    """Remembers the owners of socket inodes across scrapes
+
+    Only inodes that are not cached, or whose entry has expired, are looked
+    up in ``/proc``, so a scrape of long lived sockets does not walk
+    ``/proc`` at all. Sockets without an owner are cached too. Inodes that
+    are no longer reported are evicted.
+
+    Args:
+      ttl (float): seconds after which an owner is looked up again, in case
+        the socket was passed to another process
+      max_entries (int): at most this many inodes are cached, further
+        inodes are looked up on every scrape
+    """
+
+    def __init__(self, ttl=DEFAULT_CACHE_TTL, max_entries=DEFAULT_CACHE_SIZE,
+                 clock=time.time, scan=scan_socket_owners):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.scan = scan
+        # inode to (usr_ctxt or None, expiry time)
+        self.entries = {}
+        # number of times /proc was walked
+        self.scans = 0
+
+    def resolve(self, inodes):
+        """Return the ``usr_ctxt`` of the given inodes that have an owner
+
+        Args:
+          inodes (set): the inodes of all the sockets of this scrape
+        """
+        now = self.clock()
+        owners = {}
+        missing = set()
+        for inode in inodes:
+            # sockets without a file, e.g. in time-wait
+            if not inode:
+                continue
+            entry = self.entries.get(inode)
+            if entry is None or entry[1] <= now:
+                missing.add(inode)
+            elif entry[0]:
+                owners[inode] = entry[0]
+        for inode in [x for x in self.entries if x not in inodes]:
+            del self.entries[inode]
+        if not missing:
+            return owners
+        self.scans += 1
+        found = self.scan(missing)
+        expires = now + self.ttl
+        for inode in missing:
+            usr_ctxt = found.get(inode)
+            if usr_ctxt:
+                owners[inode] = usr_ctxt
+            if inode in self.entries or \
+                    len(self.entries) < self.max_entries:
+                self.entries[inode] = (usr_ctxt, expires)
+        return owners
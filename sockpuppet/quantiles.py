@@ -0,0 +1,251 @@
+"""Per-flow quantiles of per-socket values
+
+A flow definition, or an individual flow, may export quantiles of some of
+its metrics over all of its sockets. ``quantiles`` maps metric ids from the
+catalogue to their settings, or to None for the defaults::
+
+    {
+        "class": "ceph",
+        "quantiles": {
+            "rtt": {"quantiles": [0.5, 0.99], "window": 10},
+            "notsent_bytes": None,
+        },
+        "flows": [...],
+    }
+
+A list of metric ids is accepted as a shorthand for the defaults. Every
+sample of every socket of the flow is added to a :class:`DDSketch`, one per
+sampling interval, and the sketches of the last ``window`` intervals (5 by
+default) are merged and exported as a summary named
+``sockpuppet_tcp_flow_<id>_quantiles``. Its ``_count`` and ``_sum`` are
+those of all the samples since the flow appeared, not just of the window,
+so that they can be used as counters. Quantiles are accurate to within
+``accuracy`` (1% by default) of the true value. A sketch holds at most
+:data:`DEFAULT_MAX_BINS` counters, so the memory used by a flow does not
+depend on its number of sockets.
+"""
+import collections
+import math
+
+from prometheus_client.metrics_core import SummaryMetricFamily
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+DEFAULT_WINDOW = 5
+DEFAULT_ACCURACY = 0.01
+DEFAULT_MAX_BINS = 2048
+
+# values at or below this are counted as zero
+_MIN_VALUE = 1e-9
+
+_LABEL_NAMES = ["class", "flow"]
+
+
+class DDSketch(object):
+    """A mergeable quantile sketch with relative accuracy guarantees
+
+    Values are counted in logarithmically sized bins. When there are more
+    than ``max_bins`` bins, the lowest ones are collapsed, which only
+    affects the accuracy of the lowest quantiles.
+    """
+
+    def __init__(self, accuracy=DEFAULT_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        if not 0 < accuracy < 1:
+            raise ValueError("accuracy must be between 0 and 1")
+        self.accuracy = accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # bin index to count, bin i holds (gamma^(i-1), gamma^i]
+        self.bins = {}
+        self.zero = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def add(self, value):
+        if value > _MIN_VALUE:
+            index = int(math.ceil(math.log(value) / self.log_gamma))
+            self.bins[index] = self.bins.get(index, 0) + 1
+            if len(self.bins) > self.max_bins:
+                self._collapse()
+        else:
+            self.zero += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def _collapse(self):
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.bins[target] += self.bins.pop(index)
+
+    def merge(self, other):
+        """Add the values counted by another sketch of the same accuracy"""
+        if other.gamma != self.gamma:
+            raise ValueError("cannot merge sketches of different accuracy")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+        self.zero += other.zero
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Return the estimated q-quantile, NaN if the sketch is empty"""
+        if not self.count:
+            return float("nan")
+        rank = q * (self.count - 1)
+        if rank < self.zero:
+            return min(max(0.0, self.min), self.max)
+        total = self.zero
+        for index in sorted(self.bins):
+            total += self.bins[index]
+            if total > rank:
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+
+class QuantileWindow(object):
+    """The sketches of a flow's metric over the last ``window`` intervals
+
+    Also counts and sums every value ever added, as the ``_count`` and
+    ``_sum`` of a summary must not decrease when intervals leave the window.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, accuracy=DEFAULT_ACCURACY):
+        self.window = window
+        self.accuracy = accuracy
+        self.intervals = collections.deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def begin(self):
+        """Start a new sampling interval, forgetting the oldest"""
+        self.intervals.append(DDSketch(self.accuracy))
+
+    def add(self, value):
+        self.intervals[-1].add(value)
+        self.count += 1
+        self.sum += value
+
+    def merged(self):
+        result = DDSketch(self.accuracy)
+        for sketch in self.intervals:
+            result.merge(sketch)
+        return result
+
+
+def _parse_settings(metric_id, settings):
+    settings = settings or {}
+    quantiles = tuple(float(x) for x in
+                      settings.get("quantiles", DEFAULT_QUANTILES))
+    if not quantiles or not all(0 <= x <= 1 for x in quantiles):
+        raise ValueError("quantiles of {} must be between 0 and 1".format(
+            metric_id))
+    window = int(settings.get("window", DEFAULT_WINDOW))
+    if window < 1:
+        raise ValueError("quantile window of {} must be positive".format(
+            metric_id))
+    accuracy = float(settings.get("accuracy", DEFAULT_ACCURACY))
+    if not 0 < accuracy < 1:
+        raise ValueError("quantile accuracy of {} must be between 0 and "
+                         "1".format(metric_id))
+    return (metric_id, quantiles, window, accuracy)
+
+
+def flow_quantiles(definitions, catalogue):
+    """Return the (metric id, quantiles, window, accuracy) of each flow, in
+    definition order
+    """
+    result = []
+    for flow_definition in definitions:
+        default = flow_definition.get("quantiles", ())
+        for flow in flow_definition["flows"]:
+            spec = flow.get("quantiles", default)
+            if isinstance(spec, dict):
+                items = sorted(spec.items())
+            else:
+                items = [(x, None) for x in spec]
+            for metric_id, _ in items:
+                if metric_id not in catalogue:
+                    raise ValueError("unknown quantile metric: {}".format(
+                        metric_id))
+            result.append(tuple(_parse_settings(metric_id, settings)
+                                for metric_id, settings in items))
+    return result
+
+
+class FlowQuantiles(object):
+    """The quantile windows of every flow, kept across scrapes"""
+
+    def __init__(self):
+        # (metric id, class, flow) to (settings, QuantileWindow)
+        self.windows = {}
+        # windows that were started in the current scrape
+        self.current = set()
+
+    def begin(self):
+        self.current = set()
+
+    def add(self, settings, flow_class, flow_name, value):
+        metric_id, _, window, accuracy = settings
+        key = (metric_id, flow_class, flow_name)
+        if key not in self.current:
+            entry = self.windows.get(key)
+            if entry is None or entry[0][2:] != (window, accuracy):
+                window = QuantileWindow(window, accuracy)
+            else:
+                window = entry[1]
+            window.begin()
+            self.windows[key] = (settings, window)
+            self.current.add(key)
+        self.windows[key][1].add(value)
+
+    def end(self):
+        """Close the intervals of the flows without sockets this scrape"""
+        for key, (_, window) in list(self.windows.items()):
+            if key in self.current:
+                continue
+            window.begin()
+            if not any(x.count for x in window.intervals):
+                del self.windows[key]
+
+    def retain(self, keep):
+        """Forget the windows for which keep(metric id, class, flow) is
+        False
+        """
+        for key in list(self.windows):
+            if not keep(*key):
+                del self.windows[key]
+
+    def families(self, catalogue):
+        families = {}
+        for key in sorted(self.windows):
+            metric_id, flow_class, flow_name = key
+            (_, quantiles, _, _), window = self.windows[key]
+            family = families.get(metric_id)
+            if family is None:
+                family = families[metric_id] = SummaryMetricFamily(
+                    "sockpuppet_tcp_flow_{}_quantiles".format(metric_id),
+                    "Quantiles over the sockets of a flow and the last "
+                    "sample intervals: {}".format(
+                        catalogue[metric_id]["help"]),
+                    labels=_LABEL_NAMES)
+            sketch = window.merged()
+            for q in quantiles:
+                family.add_sample(
+                    family.name,
+                    {"class": flow_class, "flow": flow_name,
+                     "quantile": repr(q)},
+                    sketch.quantile(q))
+            family.add_metric([flow_class, flow_name], window.count,
+                              window.sum)
+        return [families[x] for x in sorted(families)]
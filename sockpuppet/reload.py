@@ -0,0 +1,138 @@
+"""Reloading the config file without restarting
+
+A :class:`ReloadingCollector` is registered in place of the
+:class:`~sockpuppet.collector.SockPuppetCollector`. When the config file
+changes, or on ``SIGHUP``, a :class:`ConfigReloader` loads it and builds a
+new collector in its own thread, which also validates the config. The new
+collector takes over the state of the old one (see
+:meth:`~sockpuppet.collector.SockPuppetCollector.inherit`) and replaces it
+between two scrapes. A config that fails to load is logged and the old one
+stays in use.
+"""
+import logging
+import os
+import signal
+import threading
+
+from prometheus_client.metrics_core import CounterMetricFamily
+
+from sockpuppet.collector import SockPuppetCollector
+
+_logger = logging.getLogger(__name__)
+
+
+class ReloadingCollector(object):
+    """Delegates to a collector that can be replaced between scrapes"""
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.lock = threading.Lock()
+        # result to the number of config reloads
+        self.reloads = {"success": 0, "failure": 0}
+
+    def collect(self):
+        with self.lock:
+            metrics = list(self.collector.collect())
+        for metric in metrics:
+            yield metric
+        metric = CounterMetricFamily(
+            "sockpuppet_config_reloads",
+            "Number of attempts to reload the config file, by result",
+            labels=["result"])
+        for result, count in sorted(self.reloads.items()):
+            metric.add_metric([result], count)
+        yield metric
+
+    def replace(self, collector):
+        """Swap in a new collector, carrying over the state of the old one
+        """
+        with self.lock:
+            collector.inherit(self.collector)
+            self.collector = collector
+            self.reloads["success"] += 1
+
+    def failed(self):
+        self.reloads["failure"] += 1
+
+
+class ConfigReloader(object):
+    """Reloads the config file on request, or when it is modified
+
+    Args:
+      path (str): the config file
+      target (ReloadingCollector): where to swap in the new collector
+      load (callable): loads the config module from a path
+      interval (float): seconds between checks of the modification time
+        of the file, 0 to only reload on request
+    """
+
+    def __init__(self, path, target, load, interval=0,
+                 factory=SockPuppetCollector):
+        self.path = path
+        self.target = target
+        self.load = load
+        self.interval = interval
+        self.factory = factory
+        self.requested = threading.Event()
+        self.stopped = threading.Event()
+        self.mtime = self._mtime()
+        self.thread = None
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def request(self, *_):
+        """Ask for a reload, usable as a signal handler"""
+        self.requested.set()
+
+    def install_signal_handler(self, signum=signal.SIGHUP):
+        signal.signal(signum, self.request)
+
+    def reload(self):
+        """Load the config and swap in a collector built from it
+
+        Returns:
+          bool: True if the config was reloaded
+        """
+        self.mtime = self._mtime()
+        try:
+            config = self.load(self.path)
+            collector = self.factory(config)
+        except Exception as e:
+            self.target.failed()
+            _logger.error("Failed to reload {}, keeping the current config: "
+                          "{}".format(self.path, e))
+            return False
+        self.target.replace(collector)
+        _logger.info("Reloaded {}".format(self.path))
+        return True
+
+    def poll(self):
+        """Reload if requested or if the file was modified"""
+        if self.requested.is_set():
+            self.requested.clear()
+            return self.reload()
+        if self.interval and self._mtime() != self.mtime:
+            return self.reload()
+        return False
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.requested.wait(self.interval or None)
+            if not self.stopped.is_set():
+                self.poll()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run,
+                                       name="sockpuppet-reload")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.requested.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,442 @@
+"""Pushing metrics with the Prometheus remote-write protocol
+
+For nodes that Prometheus cannot scrape, e.g. behind NAT, a
+:class:`RemoteWriter` pushes the samples to a remote-write endpoint
+(Prometheus with ``--web.enable-remote-write-receiver``, Thanos receive,
+Mimir, ...) on a fixed interval. It does not collect the registry itself:
+collecting updates the per-interval state of the collector, so it pushes
+the latest snapshot of the :class:`~sockpuppet.sampler.Sampler` that also
+serves scrapes, and skips snapshots it has already pushed. Every snapshot
+is split into batches of at most ``batch_size`` samples, each sent as a
+snappy compressed protobuf ``WriteRequest``.
+
+Batches wait in a bounded in-memory queue; when it is full the oldest batch
+is dropped, so that a long outage of the endpoint does not grow memory.
+Requests that fail with a server error, 429 or a connection error are
+retried with exponential backoff, up to ``max_retries`` times. Other
+client errors are not retried. Every dropped sample is counted in
+``sockpuppet_remote_write_dropped_samples`` by reason.
+
+The protobuf messages are encoded by hand, and python-snappy is used if it
+is installed, with a pure Python compressor otherwise.
+"""
+import collections
+import logging
+import struct
+import threading
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:  # python2
+    from urllib2 import HTTPError, Request, urlopen
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+from prometheus_client.metrics_core import CounterMetricFamily, \
+    GaugeMetricFamily
+
+from sockpuppet import __version__
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 15.0
+# samples per request
+DEFAULT_BATCH_SIZE = 2000
+# batches waiting to be sent
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_MIN_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30.0
+DEFAULT_TIMEOUT = 10.0
+
+DROP_QUEUE_FULL = "queue_full"
+DROP_REJECTED = "rejected"
+DROP_RETRIES = "retries_exhausted"
+DROP_REASONS = (DROP_QUEUE_FULL, DROP_REJECTED, DROP_RETRIES)
+
+_HEADERS = {
+    "Content-Encoding": "snappy",
+    "Content-Type": "application/x-protobuf",
+    "X-Prometheus-Remote-Write-Version": "0.1.0",
+    "User-Agent": "sockpuppet/{}".format(__version__),
+}
+
+_DOUBLE = struct.Struct("<d")
+
+
+# protobuf encoding
+
+def _varint(value):
+    if value < 0:
+        # int64 fields encode negative values in ten bytes
+        value += 1 << 64
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _bytes_field(number, payload):
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def encode_timeseries(labels, samples):
+    """Encode a prometheus.TimeSeries message
+
+    Args:
+      labels: (name, value) pairs, sorted by name
+      samples: (value, timestamp in milliseconds) pairs
+    """
+    parts = []
+    for name, value in labels:
+        parts.append(_bytes_field(1, _bytes_field(1, name.encode("utf-8")) +
+                                  _bytes_field(2, value.encode("utf-8"))))
+    for value, timestamp in samples:
+        parts.append(_bytes_field(2, b"\x09" + _DOUBLE.pack(value) +
+                                  b"\x10" + _varint(timestamp)))
+    return b"".join(parts)
+
+
+def encode_write_request(timeseries):
+    """Encode a prometheus.WriteRequest from encoded TimeSeries messages"""
+    return b"".join(_bytes_field(1, x) for x in timeseries)
+
+
+# snappy block format
+
+def _snappy_literal(data, start, end):
+    length = end - start - 1
+    if length < 60:
+        return bytes(bytearray([length << 2])) + data[start:end]
+    # the length follows the tag in 1 to 4 little endian bytes
+    size = (length.bit_length() + 7) // 8
+    tag = bytearray([(59 + size) << 2])
+    tag += struct.pack("<I", length)[:size]
+    return bytes(tag) + data[start:end]
+
+
+def _snappy_copy(offset, length):
+    out = []
+    while length > 0:
+        # copies with a two byte offset hold at most 64 bytes
+        chunk = min(length, 64)
+        out.append(struct.pack("<BH", (chunk - 1) << 2 | 2, offset))
+        length -= chunk
+    return b"".join(out)
+
+
+def _compress(data):
+    out = [_varint(len(data))]
+    # four byte sequence to its last position
+    table = {}
+    literal = 0
+    position = 0
+    end = len(data) - 4
+    while position <= end:
+        key = data[position:position + 4]
+        candidate = table.get(key)
+        table[key] = position
+        if candidate is None or position - candidate > 0xffff:
+            position += 1
+            continue
+        length = 4
+        while position + length < len(data) and \
+                data[candidate + length] == data[position + length]:
+            length += 1
+        if literal < position:
+            out.append(_snappy_literal(data, literal, position))
+        out.append(_snappy_copy(position - candidate, length))
+        position += length
+        literal = position
+    if literal < len(data):
+        out.append(_snappy_literal(data, literal, len(data)))
+    return b"".join(out)
+
+
+def _decompress(data):
+    data = bytearray(data)
+    length = shift = position = 0
+    while True:
+        byte = data[position]
+        position += 1
+        length |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    out = bytearray()
+    while position < len(data):
+        tag = data[position]
+        position += 1
+        kind = tag & 3
+        if kind == 0:
+            size = tag >> 2
+            if size >= 60:
+                extra = size - 59
+                size = 0
+                for i in range(extra):
+                    size |= data[position + i] << (8 * i)
+                position += extra
+            size += 1
+            out += data[position:position + size]
+            position += size
+            continue
+        if kind == 1:
+            size = (tag >> 2 & 7) + 4
+            offset = (tag >> 5) << 8 | data[position]
+            position += 1
+        elif kind == 2:
+            size = (tag >> 2) + 1
+            offset, = struct.unpack_from("<H", data, position)
+            position += 2
+        else:
+            size = (tag >> 2) + 1
+            offset, = struct.unpack_from("<I", data, position)
+            position += 4
+        if not 0 < offset <= len(out):
+            raise ValueError("invalid snappy copy offset")
+        for _ in range(size):
+            out.append(out[-offset])
+    if len(out) != length:
+        raise ValueError("snappy data is truncated")
+    return bytes(out)
+
+
+def compress(data):
+    """Compress data in the snappy block format"""
+    if snappy is not None:
+        return snappy.compress(data)
+    return _compress(data)
+
+
+def decompress(data):
+    """Decompress data in the snappy block format"""
+    if snappy is not None:
+        return snappy.decompress(data)
+    return _decompress(data)
+
+
+def families_timeseries(families, timestamp):
+    """Return the encoded TimeSeries of every sample of metric families
+
+    Args:
+      timestamp (int): milliseconds, for samples without a timestamp
+    """
+    timeseries = []
+    for family in families:
+        for sample in family.samples:
+            labels = dict(sample.labels)
+            labels["__name__"] = sample.name
+            if sample.timestamp is not None:
+                sample_time = int(float(sample.timestamp) * 1000)
+            else:
+                sample_time = timestamp
+            timeseries.append(encode_timeseries(
+                sorted(labels.items()), [(float(sample.value), sample_time)]))
+    return timeseries
+
+
+class _RetryableError(Exception):
+    pass
+
+
+class RemoteWriter(object):
+    """Periodically pushes the snapshots of a sampler to a remote-write
+    endpoint
+
+    Also a collector of its own metrics, register it to export them.
+
+    Args:
+      url (str): the remote-write endpoint
+      sampler (Sampler): the sampler whose snapshots are pushed
+      interval (float): seconds between pushes
+      batch_size (int): maximum number of samples per request
+      queue_size (int): maximum number of batches waiting to be sent
+      max_retries (int): attempts to resend a batch before dropping it
+      min_backoff (float): seconds before the first retry, doubled for
+        every further retry up to max_backoff
+      timeout (float): seconds to wait for the endpoint to answer
+    """
+
+    def __init__(self, url, sampler, interval=DEFAULT_INTERVAL,
+                 batch_size=DEFAULT_BATCH_SIZE, queue_size=DEFAULT_QUEUE_SIZE,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 min_backoff=DEFAULT_MIN_BACKOFF,
+                 max_backoff=DEFAULT_MAX_BACKOFF, timeout=DEFAULT_TIMEOUT):
+        if batch_size < 1 or queue_size < 1:
+            raise ValueError("batch_size and queue_size must be positive")
+        self.url = url
+        self.sampler = sampler
+        self.interval = interval
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        # batches of encoded TimeSeries, oldest first
+        self.queue = collections.deque()
+        # time of the last snapshot queued
+        self.timestamp = None
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.threads = []
+        self.sent_samples = 0
+        self.sent_bytes = 0
+        self.retries = 0
+        self.dropped = dict((x, 0) for x in DROP_REASONS)
+
+    def _drop(self, reason, count):
+        self.dropped[reason] += count
+        _logger.warning("Dropped {} samples: {}".format(count, reason))
+
+    def enqueue(self, timeseries):
+        """Split samples into batches and queue them for sending"""
+        with self.condition:
+            for start in range(0, len(timeseries), self.batch_size):
+                if len(self.queue) >= self.queue_size:
+                    self._drop(DROP_QUEUE_FULL, len(self.queue.popleft()))
+                self.queue.append(timeseries[start:start + self.batch_size])
+            self.condition.notify()
+
+    def sample(self):
+        """Queue the samples of the sampler's latest snapshot
+
+        Returns:
+          bool: False if there is no snapshot that was not already queued
+        """
+        latest = self.sampler.latest()
+        if latest is None or latest[1] == self.timestamp:
+            return False
+        families, self.timestamp = latest
+        self.enqueue(families_timeseries(families,
+                                         int(self.timestamp * 1000)))
+        return True
+
+    def post(self, body):
+        """Send one compressed WriteRequest
+
+        Raises:
+          _RetryableError: if the request may succeed later
+          HTTPError: if the endpoint rejected the request
+        """
+        request = Request(self.url, data=body, headers=_HEADERS)
+        try:
+            response = urlopen(request, timeout=self.timeout)
+        except HTTPError as e:
+            if e.code >= 500 or e.code == 429:
+                raise _RetryableError("HTTP {}".format(e.code))
+            raise
+        except (IOError, OSError) as e:
+            raise _RetryableError(str(e))
+        response.read()
+        response.close()
+
+    def send(self, batch):
+        """Send a batch, retrying with backoff
+
+        Returns:
+          bool: True if the batch was accepted
+        """
+        body = compress(encode_write_request(batch))
+        backoff = self.min_backoff
+        attempt = 0
+        while True:
+            try:
+                self.post(body)
+            except HTTPError as e:
+                _logger.error("Remote write rejected by {}: HTTP {}".format(
+                    self.url, e.code))
+                self._drop(DROP_REJECTED, len(batch))
+                return False
+            except _RetryableError as e:
+                if attempt >= self.max_retries or self.stopped.is_set():
+                    _logger.error("Remote write to {} failed: {}".format(
+                        self.url, e))
+                    self._drop(DROP_RETRIES, len(batch))
+                    return False
+                attempt += 1
+                self.retries += 1
+                _logger.info("Remote write to {} failed, retrying in {}s: "
+                             "{}".format(self.url, backoff, e))
+                self.stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            self.sent_samples += len(batch)
+            self.sent_bytes += len(body)
+            return True
+
+    def flush(self):
+        """Send every queued batch"""
+        while True:
+            with self.condition:
+                if not self.queue:
+                    return
+                batch = self.queue.popleft()
+            self.send(batch)
+
+    def _run_sampler(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                _logger.exception("Failed to queue metrics to push")
+
+    def _run_sender(self):
+        while not self.stopped.is_set():
+            with self.condition:
+                while not self.queue and not self.stopped.is_set():
+                    self.condition.wait()
+            self.flush()
+
+    def start(self):
+        """Queue the latest snapshot and keep pushing in the background"""
+        self.sample()
+        for target, name in ((self._run_sender, "sender"),
+                             (self._run_sampler, "sampler")):
+            thread = threading.Thread(
+                target=target, name="sockpuppet-remote-write-" + name)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def collect(self):
+        sent = CounterMetricFamily(
+            "sockpuppet_remote_write_samples",
+            "Number of samples accepted by the remote-write endpoint")
+        sent.add_metric([], self.sent_samples)
+        yield sent
+        sent_bytes = CounterMetricFamily(
+            "sockpuppet_remote_write_bytes",
+            "Compressed bytes of the accepted remote-write requests")
+        sent_bytes.add_metric([], self.sent_bytes)
+        yield sent_bytes
+        retries = CounterMetricFamily(
+            "sockpuppet_remote_write_retries",
+            "Number of remote-write requests that were retried")
+        retries.add_metric([], self.retries)
+        yield retries
+        dropped = CounterMetricFamily(
+            "sockpuppet_remote_write_dropped_samples",
+            "Number of samples that were never sent, by reason",
+            labels=["reason"])
+        for reason in DROP_REASONS:
+            dropped.add_metric([reason], self.dropped[reason])
+        yield dropped
+        queued = GaugeMetricFamily(
+            "sockpuppet_remote_write_queued_batches",
+            "Number of batches waiting to be sent")
+        queued.add_metric([], len(self.queue))
+        yield queued
@@ -0,0 +1,150 @@
+"""Background sampling with a cached exposition
+
+Instead of collecting socket statistics for every HTTP scrape, a
+:class:`Sampler` collects and renders the registry on a fixed interval in a
+background thread. Scrapes are served the most recent snapshot, so their
+cost no longer depends on the number of sockets or on how many Prometheus
+servers are scraping the node. The collected metric families are kept
+too, so that the remote writer pushes the same samples as scrapes are
+served.
+"""
+import logging
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from prometheus_client.exposition import CONTENT_TYPE_LATEST, \
+    generate_latest
+
+_logger = logging.getLogger(__name__)
+
+_AGE_METRIC = (
+    "# HELP sockpuppet_snapshot_age_seconds Time since the served metrics "
+    "were collected\n"
+    "# TYPE sockpuppet_snapshot_age_seconds gauge\n"
+    "sockpuppet_snapshot_age_seconds {}\n"
+)
+
+
+class _Families(object):
+    """A collector of already collected metric families"""
+
+    def __init__(self, families):
+        self.families = families
+
+    def collect(self):
+        return self.families
+
+
+class Sampler(object):
+    """Periodically renders a registry in the background
+
+    Args:
+      registry: the registry to collect from
+      interval (float): seconds between samples
+      max_staleness (float): snapshots older than this are not served
+    """
+
+    def __init__(self, registry, interval, max_staleness=None,
+                 clock=time.time):
+        self.registry = registry
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.families = None
+        self.timestamp = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def refresh(self):
+        families = list(self.registry.collect())
+        timestamp = self.clock()
+        output = generate_latest(_Families(families))
+        with self.lock:
+            self.snapshot = output
+            self.families = families
+            self.timestamp = timestamp
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                _logger.exception("Failed to refresh the metrics snapshot")
+
+    def start(self):
+        """Take the first snapshot and start sampling in the background"""
+        self.refresh()
+        self.thread = threading.Thread(target=self._run,
+                                       name="sockpuppet-sampler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def latest(self):
+        """Return the (metric families, timestamp) of the latest snapshot
+
+        Returns None before the first snapshot.
+        """
+        with self.lock:
+            if self.families is None:
+                return None
+            return self.families, self.timestamp
+
+    def render(self):
+        """Return the latest snapshot, or None if it is too stale to serve"""
+        with self.lock:
+            snapshot, timestamp = self.snapshot, self.timestamp
+        if snapshot is None:
+            return None
+        age = max(self.clock() - timestamp, 0.0)
+        if self.max_staleness is not None and age > self.max_staleness:
+            return None
+        return snapshot + _AGE_METRIC.format(age).encode("utf-8")
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _handler(sampler):
+
+    class SnapshotHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            output = sampler.render()
+            if output is None:
+                self.send_error(503, "Metrics snapshot is stale")
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE_LATEST)
+            self.send_header("Content-Length", str(len(output)))
+            self.end_headers()
+            self.wfile.write(output)
+
+        def log_message(self, format, *args):
+            _logger.debug(format, *args)
+
+    return SnapshotHandler
+
+
+def start_snapshot_server(sampler, port, addr=""):
+    """Serve the sampler's snapshot over HTTP from a daemon thread"""
+    server = _ThreadingHTTPServer((addr, port), _handler(sampler))
+    thread = threading.Thread(target=server.serve_forever,
+                              name="sockpuppet-http")
+    thread.daemon = True
+    thread.start()
+    return server
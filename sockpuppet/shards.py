@@ -0,0 +1,204 @@
+"""Decoding and matching large socket tables in worker processes
+
+Decoding the sock_diag replies, matching sockets against the flows and
+extracting their metric values runs on a single core. With ``workers = N``
+in the config file, the replies of a scrape are split into shards of
+``shard_size`` sockets (5000 by default) and a pool of N processes decodes,
+matches and extracts them. Only the sockets that belong to a flow are sent
+back, projected onto the fields sockpuppet uses, along with their flow and
+metric values.
+
+Shards are merged in the order of the dump, so a scrape produces the same
+metrics as without workers. Process names, the socket state, aggregation
+and the export stay in the scraping process. Scrapes with a single shard
+are processed in the scraping process. If the pool does not answer
+within ``shard_timeout`` seconds, e.g. because a worker was killed, it is
+replaced and the scrape is processed in the scraping process. Only the
+netlink backend is supported.
+"""
+import logging
+import multiprocessing
+import socket
+
+from sockpuppet.matcher import FlowMatcher, PROTOCOL_TCP, PROTOCOL_UDP, \
+    SELECTORS
+from sockpuppet.netlink import decode_inet_diag_msg
+from sockpuppet.paths import FieldExtractor, project
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_SHARD_SIZE = 5000
+# seconds to wait for the shards of a scrape
+DEFAULT_SHARD_TIMEOUT = 60
+
+_PROTOCOLS = {
+    socket.IPPROTO_TCP: PROTOCOL_TCP,
+    socket.IPPROTO_UDP: PROTOCOL_UDP,
+}
+
+# the _ShardWorker of a worker process
+_worker = None
+
+
+class ShardSpec(object):
+    """What a worker needs to match and extract sockets
+
+    Args:
+      definitions: the ``flow_definitions`` of the config
+      extractor_paths: for each flow, the paths of the values to extract
+        from its TCP sockets
+      fields: projection of the flow fields to send back, see
+        :func:`sockpuppet.paths.projection`
+    """
+
+    def __init__(self, definitions, extractor_paths, fields=None):
+        self.definitions = definitions
+        self.extractor_paths = extractor_paths
+        self.fields = fields
+
+
+class _ShardWorker(object):
+
+    def __init__(self, spec):
+        self.matchers = dict(
+            (protocol, FlowMatcher(spec.definitions, name))
+            for protocol, name in _PROTOCOLS.items())
+        extractors = {}
+        self.extractors = []
+        for paths in spec.extractor_paths:
+            paths = tuple(paths)
+            if paths not in extractors:
+                extractors[paths] = FieldExtractor(paths)
+            self.extractors.append(extractors[paths])
+        self.fields = spec.fields
+
+    def run(self, protocol, netns, bodies):
+        """Decode and match the replies of one shard
+
+        Returns:
+          tuple: a list of (flow index, flow, values) for the matching
+          sockets, values being None for UDP sockets, and TCP state to the
+          number of sockets that did not match
+        """
+        matcher = self.matchers[protocol]
+        rows = []
+        unmatched = {}
+        for body in bodies:
+            flow = decode_inet_diag_msg(body, protocol)
+            if netns is not None:
+                flow["netns"] = netns
+            index = matcher.match_index(
+                dict((x, flow.get(x)) for x in SELECTORS))
+            if index is None:
+                if protocol == socket.IPPROTO_TCP:
+                    state = flow.get("tcp_info", {}).get("state", "unknown")
+                    unmatched[state] = unmatched.get(state, 0) + 1
+                continue
+            values = None
+            if protocol == socket.IPPROTO_TCP:
+                values = self.extractors[index](flow)
+            if self.fields is not None:
+                flow = project(flow, self.fields)
+            rows.append((index, flow, values))
+        return rows, unmatched
+
+
+def _initialize(spec):
+    global _worker
+    _worker = _ShardWorker(spec)
+
+
+def _run_shard(job):
+    return _worker.run(*job)
+
+
+class ShardPool(object):
+    """A pool of worker processes, started on first use
+
+    Args:
+      spec (ShardSpec): the flows the workers match against
+      workers (int): number of worker processes
+      shard_size (int): number of sockets per shard
+      timeout (float): seconds to wait for the pool, after which it is
+        replaced and the shards are processed locally
+    """
+
+    def __init__(self, spec, workers, shard_size=DEFAULT_SHARD_SIZE,
+                 timeout=DEFAULT_SHARD_TIMEOUT):
+        if workers < 1:
+            raise ValueError("workers must be positive")
+        if shard_size < 1:
+            raise ValueError("shard_size must be positive")
+        if timeout <= 0:
+            raise ValueError("timeout must be positive")
+        self.spec = spec
+        self.workers = workers
+        self.shard_size = shard_size
+        self.timeout = timeout
+        self.pool = None
+        self.local = None
+        # number of shards processed by the pool and locally
+        self.shards = {"pool": 0, "local": 0}
+        # number of times the pool did not answer in time
+        self.timeouts = 0
+
+    def jobs(self, replies):
+        """Split (netns, tcp bodies, udp bodies) replies into shards"""
+        jobs = []
+        for netns, tcp_bodies, udp_bodies in replies:
+            for protocol, bodies in ((socket.IPPROTO_TCP, tcp_bodies),
+                                     (socket.IPPROTO_UDP, udp_bodies)):
+                for start in range(0, len(bodies), self.shard_size):
+                    jobs.append((protocol, netns,
+                                 bodies[start:start + self.shard_size]))
+        return jobs
+
+    def _run_locally(self, jobs):
+        if self.local is None:
+            self.local = _ShardWorker(self.spec)
+        self.shards["local"] += len(jobs)
+        return [self.local.run(*job) for job in jobs]
+
+    def _map(self, jobs):
+        if len(jobs) <= 1:
+            return self._run_locally(jobs)
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers, _initialize,
+                                             (self.spec,))
+        # the results are in the order of the jobs
+        result = self.pool.map_async(_run_shard, jobs, chunksize=1)
+        try:
+            results = result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            # the task of a worker that died is never completed
+            _logger.error("Worker processes did not answer within {}s, "
+                          "restarting them".format(self.timeout))
+            self.timeouts += 1
+            self.close()
+            return self._run_locally(jobs)
+        self.shards["pool"] += len(jobs)
+        return results
+
+    def run(self, replies):
+        """Decode and match the replies of a scrape
+
+        Returns:
+          tuple: the (flow index, flow, values) of the matching TCP and UDP
+          sockets, in dump order, and TCP state to the number of sockets
+          that did not match
+        """
+        jobs = self.jobs(replies)
+        results = {socket.IPPROTO_TCP: [], socket.IPPROTO_UDP: []}
+        unmatched = {}
+        for (protocol, _, _), (rows, counts) in zip(jobs, self._map(jobs)):
+            results[protocol].extend(rows)
+            for state, count in counts.items():
+                unmatched[state] = unmatched.get(state, 0) + count
+        return (results[socket.IPPROTO_TCP], results[socket.IPPROTO_UDP],
+                unmatched)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,104 @@
+"""Per-socket state carried between samples
+
+The kernel only reports cumulative byte counters per socket. To derive
+per-interval deltas, throughput and per-flow totals, the last seen counter
+values of every tracked socket are kept in a :class:`SocketStateTable`.
+Sockets that are no longer reported are evicted at the end of each sample;
+their traffic up to the last sample has already been accounted for.
+"""
+
+# upper bound on the number of sockets tracked at once
+DEFAULT_MAX_SOCKETS = 200000
+
+# counters tracked per socket, as (name, key path into the flow dict)
+TRACKED_COUNTERS = (
+    ("bytes_acked", ("tcp_info", "bytes_acked")),
+    ("bytes_received", ("tcp_info", "bytes_received")),
+)
+
+
+def socket_key(flow):
+    """Identify a socket across samples
+
+    The inode alone is not enough: it is zero for sockets without a file
+    (e.g. time-wait), and may be reused by a later socket. The same
+    addresses and ports may be in use in several network namespaces.
+    """
+    return (flow.get("netns"), flow.get("inode"), flow.get("src"),
+            flow.get("src_port"), flow.get("dst"), flow.get("dst_port"))
+
+
+class _Entry(object):
+    __slots__ = ("flow_index", "values", "generation")
+
+    def __init__(self, flow_index, values, generation):
+        self.flow_index = flow_index
+        self.values = values
+        self.generation = generation
+
+
+class SocketStateTable(object):
+    """Last seen counter values of each socket, keyed by :func:`socket_key`
+
+    Call :meth:`begin` before and :meth:`end` after each sample, and
+    :meth:`update` for every socket in between.
+    """
+
+    def __init__(self, max_sockets=DEFAULT_MAX_SOCKETS):
+        self.max_sockets = max_sockets
+        self.entries = {}
+        self.generation = 0
+        self.timestamp = None
+        self.elapsed = None
+        # sockets that could not be tracked because the table was full
+        self.untracked = 0
+
+    def begin(self, now):
+        self.generation += 1
+        if self.timestamp is not None:
+            self.elapsed = now - self.timestamp
+        self.timestamp = now
+
+    def update(self, key, flow_index, values):
+        """Record a socket's counters, returning the increase since last seen
+
+        A socket that was not seen in the previous sample, or whose counters
+        went backwards because the key was reused by a new socket, counts
+        from zero. Returns None if the socket cannot be tracked because the
+        table is full; it then counts from zero once it can be tracked,
+        rather than risk being counted twice.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            if len(self.entries) >= self.max_sockets:
+                self.untracked += 1
+                return None
+            self.entries[key] = _Entry(flow_index, values, self.generation)
+            return values
+        previous = entry.values
+        entry.flow_index = flow_index
+        entry.values = values
+        entry.generation = self.generation
+        if any(new < old for new, old in zip(values, previous)):
+            return values
+        return tuple(new - old for new, old in zip(values, previous))
+
+    def end(self):
+        """Evict the sockets that were not seen in this sample"""
+        vanished = [key for key, entry in self.entries.items()
+                    if entry.generation != self.generation]
+        for key in vanished:
+            del self.entries[key]
+        return len(vanished)
+
+    def renumber(self, flow_indexes):
+        """Carry the table over to new flow definitions
+
+        Args:
+          flow_indexes (dict): old flow index to new flow index, for the
+            flows that did not change. The sockets of other flows keep their
+            last counter values as a baseline, so that traffic accounted for
+            before the reload is not counted again.
+        """
+        for entry in self.entries.values():
+            entry.flow_index = flow_indexes.get(entry.flow_index)
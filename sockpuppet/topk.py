@@ -0,0 +1,182 @@
+"""Per-socket series for the heaviest sockets of a flow only
+
+A flow definition, or an individual flow, may ask for per-socket series of
+only its ``k`` heaviest sockets. The other sockets of the flow are combined
+into a single series whose labels other than class and flow are ``other``::
+
+    {
+        "class": "ceph",
+        "top": {
+            # number of sockets exported individually
+            "k": 10,
+            # bytes (acked plus received), bytes_acked, bytes_received or
+            # the id of a gauge in the metric catalogue, e.g. rtt
+            "by": "bytes",
+            # how to combine the gauges of the other sockets: sum, max,
+            # mean or count
+            "gauge": "sum",
+        },
+        "flows": [...],
+    }
+
+Sockets are ranked with a :class:`SpaceSaving` sketch kept across samples:
+every sample adds each socket's weight, the increase of its byte counters
+or the value of the gauge, to its estimate, and the estimates decay by
+``decay`` (0.5 by default) per sample so that the ranking follows changes
+in traffic. The sketch holds at most ``capacity`` sockets, four times ``k``
+by default, however many sockets the flow has.
+"""
+from sockpuppet.aggregation import Aggregation
+from sockpuppet.paths import accessor
+from sockpuppet.state import TRACKED_COUNTERS
+
+RANK_BYTES = "bytes"
+
+DEFAULT_DECAY = 0.5
+# sketch capacity as a multiple of k
+DEFAULT_CAPACITY_FACTOR = 4
+
+OTHER = "other"
+
+
+class SpaceSaving(object):
+    """Space-saving heavy hitter sketch with weighted, decaying counts
+
+    At most ``capacity`` keys are tracked. A new key replaces the key with
+    the lowest estimate, inheriting that estimate, so estimates are upper
+    bounds that overestimate by at most the recorded error.
+    """
+
+    def __init__(self, capacity, decay=1.0):
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.decay = decay
+        # key to [estimate, error]
+        self.counters = {}
+
+    def age(self):
+        """Decay every estimate, call once per sample"""
+        if self.decay == 1.0:
+            return
+        for counter in self.counters.values():
+            counter[0] *= self.decay
+            counter[1] *= self.decay
+
+    def add(self, key, weight):
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[key] = [weight, 0.0]
+        else:
+            victim = min(self.counters, key=lambda x: self.counters[x][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[key] = [floor + weight, floor]
+
+    def estimate(self, key):
+        """Return the estimated weight of a key, 0 if it is not tracked"""
+        counter = self.counters.get(key)
+        return counter[0] if counter is not None else 0
+
+    def top(self, n):
+        """Return the n keys with the highest estimates, heaviest first"""
+        return sorted(self.counters, key=lambda x: -self.counters[x][0])[:n]
+
+
+class _OtherAggregation(Aggregation):
+    """Combines sockets into a series with ``other`` for every label but
+    class and flow
+    """
+
+    def key(self, label_values):
+        return tuple(value if keep else OTHER
+                     for value, keep in zip(label_values, self.keep))
+
+
+class Top(object):
+    """The top-k settings of a flow"""
+
+    def __init__(self, spec, catalogue, label_names):
+        self.k = int(spec.get("k", 10))
+        if self.k < 1:
+            raise ValueError("top k must be positive")
+        self.by = spec.get("by", RANK_BYTES)
+        counters = [name for name, _ in TRACKED_COUNTERS]
+        if self.by == RANK_BYTES:
+            self.counters = list(range(len(counters)))
+            self.search = None
+        elif self.by in counters:
+            self.counters = [counters.index(self.by)]
+            self.search = None
+        elif self.by in catalogue and catalogue[self.by]["type"] == "gauge":
+            self.counters = None
+            self.search = accessor(catalogue[self.by]["path"])
+        else:
+            raise ValueError("cannot rank sockets by {}, expected {}, a "
+                             "tracked counter or a gauge".format(
+                                 self.by, RANK_BYTES))
+        self.capacity = int(spec.get("capacity",
+                                     DEFAULT_CAPACITY_FACTOR * self.k))
+        if self.capacity < self.k:
+            raise ValueError("top capacity must be at least k")
+        self.decay = float(spec.get("decay", DEFAULT_DECAY))
+        if not 0 < self.decay <= 1:
+            raise ValueError("top decay must be in (0, 1]")
+        self.other = _OtherAggregation(
+            {"gauge": spec.get("gauge", "sum")}, label_names)
+
+    def sketch(self):
+        return SpaceSaving(self.capacity, self.decay)
+
+    def weight(self, flow, deltas):
+        """Return the weight of a socket in this sample
+
+        Args:
+          deltas (tuple): increase of the tracked counters, or None if the
+            socket is not tracked
+        """
+        if self.search is not None:
+            value = self.search(flow)
+            return value if value is not None else 0
+        if deltas is None:
+            return 0
+        return sum(deltas[x] for x in self.counters)
+
+
+def flow_tops(definitions, catalogue, label_names):
+    """Return the :class:`Top` of each flow, in definition order
+
+    Flows without top-k have an entry of None.
+    """
+    result = []
+    for flow_definition in definitions:
+        default = flow_definition.get("top")
+        for flow in flow_definition["flows"]:
+            spec = flow.get("top", default)
+            if spec and flow.get("aggregate",
+                                 flow_definition.get("aggregate")):
+                raise ValueError("flow {} cannot both aggregate and export "
+                                 "its top sockets".format(flow["flow"]))
+            result.append(Top(spec, catalogue, label_names) if spec
+                          else None)
+    return result
+
+
+class TopSockets(object):
+    """The sockets of the top-k flows seen during one sample"""
+
+    def __init__(self):
+        # flow index to a list of (key, context, values)
+        self.candidates = {}
+
+    def add(self, flow_index, key, context, values):
+        self.candidates.setdefault(flow_index, []).append(
+            (key, context, values))
+
+    def split(self, flow_index, top, sketch):
+        """Yield (is_top, context, values) for the sockets of a flow"""
+        candidates = self.candidates.get(flow_index, ())
+        ranked = sorted(candidates, key=lambda x: -sketch.estimate(x[0]))
+        for position, (_, context, values) in enumerate(ranked):
+            yield position < top.k, context, values
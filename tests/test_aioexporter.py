@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import gzip
+import threading
+
+import pytest
+
+try:
+    from http.client import HTTPConnection
+except ImportError:  # python2
+    from httplib import HTTPConnection
+
+from sockpuppet import aioexporter
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+
+class SlowRender(object):
+
+    def __init__(self, body=b"metric 1\n"):
+        self.body = body
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(10)
+        if isinstance(self.body, Exception):
+            raise self.body
+        return self.body
+
+
+class CountingExporter(aioexporter.AsyncExporter):
+
+    waiting = 0
+
+    async def output(self):
+        self.waiting += 1
+        return await super(CountingExporter, self).output()
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(render, **kwargs):
+        exporter = CountingExporter(render, **kwargs)
+        server = aioexporter.start_async_server(exporter, 0, "127.0.0.1")
+        servers.append(server)
+        return exporter, server.server_address[1]
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def get(port, headers=None, connection=None):
+    connection = connection or HTTPConnection("127.0.0.1", port, timeout=10)
+    connection.request("GET", "/metrics", headers=headers or {})
+    response = connection.getresponse()
+    return response, response.read()
+
+
+def test_concurrent_scrapes_share_a_collection(serve):
+    render = SlowRender()
+    render.release.clear()
+    exporter, port = serve(render)
+    results = []
+
+    def scrape():
+        results.append(get(port)[1])
+
+    threads = [threading.Thread(target=scrape) for _ in range(5)]
+    threads[0].start()
+    assert render.started.wait(10)
+    for thread in threads[1:]:
+        thread.start()
+    # wait until every scrape is waiting on the in-flight collection
+    while exporter.waiting < 5:
+        threading.Event().wait(0.01)
+    render.release.set()
+    for thread in threads:
+        thread.join()
+    assert results == [b"metric 1\n"] * 5
+    assert render.calls == 1
+    # once finished, the next scrape collects again
+    assert get(port)[1] == b"metric 1\n"
+    assert render.calls == 2
+
+
+def test_coalesce_window(serve):
+    render = SlowRender()
+    clock = Clock()
+    _, port = serve(render, window=5, clock=clock)
+    get(port)
+    clock.now += 4
+    get(port)
+    assert render.calls == 1
+    clock.now += 1
+    get(port)
+    assert render.calls == 2
+
+
+def test_gzip(serve):
+    render = SlowRender(b"metric 1\n" * 100)
+    _, port = serve(render)
+    response, body = get(port, {"Accept-Encoding": "deflate, gzip;q=1.0"})
+    assert response.getheader("Content-Encoding") == "gzip"
+    assert gzip.decompress(body) == render.body
+    response, body = get(port)
+    assert response.getheader("Content-Encoding") is None
+    assert body == render.body
+
+
+def test_keep_alive(serve):
+    _, port = serve(SlowRender())
+    connection = HTTPConnection("127.0.0.1", port, timeout=10)
+    get(port, connection=connection)
+    sock = connection.sock
+    response, body = get(port, connection=connection)
+    assert connection.sock is sock
+    assert response.getheader("Connection") == "keep-alive"
+    response, body = get(port, {"Connection": "close"}, connection)
+    assert response.getheader("Connection") == "close"
+    assert body == b"metric 1\n"
+
+
+@pytest.mark.parametrize("body,status", [
+    (None, 503),
+    (RuntimeError("boom"), 500),
+])
+def test_errors(serve, body, status):
+    _, port = serve(SlowRender(body))
+    assert get(port)[0].status == status
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+BENCHMARK = os.path.join(os.path.dirname(__file__), "..", "benchmarks",
+                         "bench_collect.py")
+
+
+def test_benchmark_smoke(tmpdir):
+    output = tmpdir.join("results.json")
+    subprocess.check_call([sys.executable, BENCHMARK, "--flows", "50",
+                           "--rules", "example", "many:5", "--repeat", "1",
+                           "--output", str(output)])
+    results = json.loads(output.read())["results"]
+    assert len(results) == 2
+    for result in results:
+        assert set(result["seconds"]) == {"fetch", "parse", "match",
+                                          "extract", "render", "scrape"}
+        if sys.version_info >= (3, 4):
+            assert result["peak_memory_bytes"] > 0
+        else:
+            # without tracemalloc
+            assert result["peak_memory_bytes"] is None
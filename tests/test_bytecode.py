@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import socket
+import struct
+
+import pytest
+
+from sockpuppet import bytecode, cli, netlink
+from sockpuppet.collector import find_flow
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+
+def run_bytecode(code, entry):
+    """A python port of inet_diag_bc_run, for IPv4 sockets"""
+    length = len(code)
+    offset = 0
+    while length > 0:
+        op, yes, no = struct.unpack_from("=BBH", code, offset)
+        if op == bytecode.INET_DIAG_BC_JMP:
+            result = False
+        elif op in (bytecode.INET_DIAG_BC_S_GE, bytecode.INET_DIAG_BC_S_LE,
+                    bytecode.INET_DIAG_BC_D_GE, bytecode.INET_DIAG_BC_D_LE):
+            port, = struct.unpack_from("=H", code, offset + 6)
+            actual = entry["src_port"] if op in (
+                bytecode.INET_DIAG_BC_S_GE, bytecode.INET_DIAG_BC_S_LE) \
+                else entry["dst_port"]
+            if op in (bytecode.INET_DIAG_BC_S_GE, bytecode.INET_DIAG_BC_D_GE):
+                result = actual >= port
+            else:
+                result = actual <= port
+        elif op in (bytecode.INET_DIAG_BC_S_COND,
+                    bytecode.INET_DIAG_BC_D_COND):
+            family, prefix_len, port = struct.unpack_from(
+                "=BBxxi", code, offset + 4)
+            assert family == socket.AF_INET and prefix_len <= 32
+            address, = struct.unpack_from("!I", code, offset + 12)
+            key = "src" if op == bytecode.INET_DIAG_BC_S_COND else "dst"
+            actual, = struct.unpack("!I", socket.inet_aton(entry[key]))
+            shift = 32 - prefix_len
+            result = actual >> shift == address >> shift
+        else:
+            raise AssertionError("unexpected op {}".format(op))
+        assert yes % 4 == 0 and no % 4 == 0
+        step = yes if result else no
+        assert step <= length + 4
+        length -= step
+        offset += step
+    return length == 0
+
+
+def entries():
+    for src in ("10.42.0.4", "192.168.1.1"):
+        for dst in ("10.42.0.4", "192.168.246.128", "192.168.1.2"):
+            for src_port in (1, 443, 1194, 6789, 6800, 7000, 7300, 7301):
+                for dst_port in (1, 443, 1194, 6789, 6800, 6801, 7301):
+                    yield {
+                        "src": src,
+                        "dst": dst,
+                        "src_port": src_port,
+                        "dst_port": dst_port,
+                    }
+
+
+@pytest.mark.parametrize("path", [
+    "../config/config_example.py",
+    "../config/config_sample_1.py",
+])
+def test_bytecode_matches_find_flow(path):
+    definitions = cli.load_config(path).flow_definitions
+    code = bytecode.compile_flow_definitions(definitions)
+    assert code is not None
+    for entry in entries():
+        matched, _ = find_flow(definitions, entry)
+        assert run_bytecode(code, entry) == (matched is not None), entry
+
+
+def test_prefix_selector():
+    definitions = [{"class": "a", "flows": [
+        {"flow": "b", "dst": {"10.42.0.0/16", "::ffff:192.168.0.0/112"}},
+    ]}]
+    code = bytecode.compile_flow_definitions(definitions)
+    for entry in entries():
+        matched, _ = find_flow(definitions, entry)
+        assert run_bytecode(code, entry) == (matched is not None), entry
+
+
+def test_unsupported_selector_is_not_filtered():
+    definitions = [{"class": "a", "flows": [{"flow": "b", "dst": 42}]}]
+    assert bytecode.compile_flow_definitions(definitions) is None
+
+
+def test_unsupported_selector_relaxes_flow():
+    definitions = [{"class": "a", "flows": [
+        {"flow": "b", "dst": 42, "dst_port": 80},
+    ]}]
+    code = bytecode.compile_flow_definitions(definitions)
+    assert run_bytecode(code, {"src_port": 1, "dst_port": 80,
+                               "src": "1.1.1.1", "dst": "2.2.2.2"})
+    assert not run_bytecode(code, {"src_port": 1, "dst_port": 81,
+                                   "src": "1.1.1.1", "dst": "2.2.2.2"})
+
+
+def test_no_flows_rejects_everything():
+    code = bytecode.compile_flow_definitions([])
+    assert not run_bytecode(code, {"src_port": 1, "dst_port": 1,
+                                   "src": "1.1.1.1", "dst": "2.2.2.2"})
+
+
+def test_kernel_accepts_bytecode():
+    diag = netlink.SockDiag()
+    try:
+        diag.open()
+    except (IOError, OSError):
+        pytest.skip("NETLINK_SOCK_DIAG is not available")
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(2)
+    port = listener.getsockname()[1]
+    clients = [socket.create_connection(("127.0.0.1", port))
+               for _ in range(2)]
+    definitions = [{"class": "a", "flows": [
+        {"flow": "b", "dst_port": port, "src": {"127.0.0.1", "::1"}},
+    ]}]
+    try:
+        stats = diag.get_socket_stats(
+            bytecode=bytecode.compile_flow_definitions(definitions))
+        flows = stats["TCP"]["flows"]
+        assert len(flows) == 2
+        assert all(f["dst_port"] == port for f in flows)
+    finally:
+        for client in clients:
+            client.close()
+        listener.close()
+        diag.close()
+
+
+def test_kernel_prefix_matches_mapped_addresses():
+    diag = netlink.SockDiag()
+    try:
+        diag.open()
+        listener = socket.socket(socket.AF_INET6)
+        listener.bind(("::", 0))
+    except (IOError, OSError):
+        pytest.skip("NETLINK_SOCK_DIAG or IPv6 is not available")
+    listener.listen(2)
+    port = listener.getsockname()[1]
+    client = socket.create_connection(("::ffff:127.0.0.1", port))
+    definitions = [{"class": "a", "flows": [
+        {"flow": "b", "dst_port": port, "dst": "127.0.0.0/8"},
+    ]}]
+    try:
+        stats = diag.get_socket_stats(
+            bytecode=bytecode.compile_flow_definitions(definitions))
+        flows = stats["TCP"]["flows"]
+        assert [f["dst"] for f in flows] == ["::ffff:127.0.0.1"]
+        assert find_flow(definitions, flows[0])[1] is not None
+    finally:
+        client.close()
+        listener.close()
+        diag.close()
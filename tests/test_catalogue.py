@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock as mock
+
+from sockpuppet import netlink
+from sockpuppet.catalogue import DEFAULT_METRICS, build_catalogue
+from sockpuppet.collector import SockPuppetCollector
+
+from test_collector import make_flow, make_tcp_flows, mock_module, \
+    socket_families
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+CONFIG = """
+metric_catalogue = {
+    "cwnd": {
+        "name": "sockpuppet_tcp_cwnd_segments",
+        "path": "tcp_info.snd_cwnd",
+        "type": "gauge",
+        "help": "Congestion window",
+    },
+}
+flow_definitions = [
+    {
+        "class": "https",
+        "metrics": ["cwnd", "total_retrans"],
+        "flows": [
+            {
+                "flow": "https-inbound",
+                "src_port": 443
+            },
+        ]
+    },
+    {
+        "class": "ssh",
+        "flows": [
+            {
+                "flow": "ssh-inbound",
+                "src_port": 22
+            },
+        ]
+    },
+]
+"""
+
+
+def test_builtin_catalogue_covers_tcp_info():
+    catalogue = build_catalogue()
+    paths = set(entry["path"] for entry in catalogue.values())
+    decoded = netlink.decode_tcp_info(b"\0" * 512)
+    for field, value in decoded.items():
+        if isinstance(value, (int, float)):
+            assert "tcp_info." + field in paths
+    for metric_id in DEFAULT_METRICS:
+        assert metric_id in catalogue
+
+
+def test_invalid_catalogue():
+    with pytest.raises(ValueError):
+        build_catalogue({"x": {"path": "tcp_info.rtt", "type": "summary",
+                               "help": ""}})
+    with pytest.raises(ValueError):
+        build_catalogue({"x": {"path": "tcp_info.rtt", "type": "gauge"}})
+    with pytest.raises(ValueError):
+        build_catalogue({"x": {"name": "sockpuppet_tcp_rtt",
+                               "path": "tcp_info.rtt", "type": "gauge",
+                               "help": ""}})
+
+
+def test_unknown_metric_id():
+    config = mock_module(CONFIG.replace('"total_retrans"', '"nope"'))
+    with pytest.raises(ValueError):
+        SockPuppetCollector(config)
+
+
+def test_metrics_per_flow_class():
+    config = mock_module(CONFIG)
+    collector = SockPuppetCollector(config)
+    assert set(collector.metric_definitions) == \
+        set(DEFAULT_METRICS) | set(["cwnd", "total_retrans"])
+    flows = [make_flow(src_port=443), make_flow(src_port=22)]
+    with mock.patch('sockpuppet.collector.get_socket_stats',
+                    side_effect=lambda _: make_tcp_flows(flows)):
+        items = dict((i.name, i) for i in
+                     socket_families(collector, collector.collect()))
+    cwnd = items["sockpuppet_tcp_cwnd_segments"]
+    assert cwnd.type == "gauge"
+    assert [(s.labels["flow"], s.value) for s in cwnd.samples] == \
+        [("https-inbound", 10)]
+    retrans = items["sockpuppet_tcp_total_retrans"]
+    assert retrans.type == "counter"
+    assert [s.labels["flow"] for s in retrans.samples] == ["https-inbound"]
+    rtt = items["sockpuppet_tcp_rtt"]
+    assert [s.labels["flow"] for s in rtt.samples] == ["ssh-inbound"]
+
+
+def test_only_enabled_fields_extracted():
+    config = mock_module(CONFIG.replace("    {\n        \"class\": \"ssh\"",
+                                        "    {\n        \"metrics\": [],\n"
+                                        "        \"class\": \"ssh\""))
+    collector = SockPuppetCollector(config)
+    ids, _, extractor = collector.flow_extractors[0]
+    assert ids == ("cwnd", "total_retrans")
+    assert extractor.paths == ["tcp_info.snd_cwnd", "tcp_info.total_retrans",
+                               "tcp_info.bytes_acked",
+                               "tcp_info.bytes_received"]
+    assert "rtt" not in collector.context.fields["tcp_info"]
+    assert "meminfo" not in collector.context.fields
@@ -183,6 +183,12 @@ def flow_sample1():
     }
 
 
+def socket_families(collector, items):
+    """Filter out everything but the per-socket metric families"""
+    names = set(m.name for m in collector.metrics().values())
+    return [i for i in items if i.name in names]
+
+
 def make_tcp_flows(flows):
     return {"TCP": {
         "flows": flows
@@ -395,7 +401,7 @@ flow_definitions = [
 """
     config = mock_module(config_basic)
     collector = SockPuppetCollector(config)
-    items = list(collector.collect())
+    items = socket_families(collector, collector.collect())
     assert len(items) == len(collector.metric_definitions)
 
 
@@ -418,7 +424,7 @@ flow_definitions = [
 """
     config = mock_module(config_basic)
     collector = SockPuppetCollector(config)
-    items = list(collector.collect())
+    items = socket_families(collector, collector.collect())
     assert len(items) == len(collector.metric_definitions)
 
 
@@ -428,7 +434,7 @@ flow_definitions = [
 def test_end_to_end_sample_1(_mock):
     config = cli.load_config("../config/config_sample_1.py")
     collector = SockPuppetCollector(config)
-    items = list(collector.collect())
+    items = socket_families(collector, collector.collect())
     for i in items:
         for sample in i.samples:
             assert sample.labels["flow"] == "ceph-mds"
@@ -452,7 +458,7 @@ flow_definitions = [
 """
     config = mock_module(config_basic)
     collector = SockPuppetCollector(config)
-    items = list(collector.collect())
+    items = socket_families(collector, collector.collect())
     assert len(items) == 0
 
 
@@ -479,7 +485,7 @@ flow_definitions = [
 """
     config = mock_module(config_basic)
     collector = SockPuppetCollector(config)
-    items = list(collector.collect())
+    items = socket_families(collector, collector.collect())
     for i in items:
         for sample in i.samples:
             assert sample.labels["process"] == "/usr/bin/python"
@@ -505,7 +511,7 @@ flow_definitions = [
 """
     config = mock_module(config_basic)
     collector = SockPuppetCollector(config)
-    items = list(collector.collect())
+    items = socket_families(collector, collector.collect())
     for i in items:
         for sample in i.samples:
             assert sample.labels["process"] == "None"
@@ -533,3 +539,171 @@ flow_definitions = [
     config = mock_module(config_basic)
     collector = SockPuppetCollector(config)
     collector.collect()
+
+
+@mock.patch('sockpuppet.collector.get_socket_stats',
+            side_effect=lambda _: make_tcp_flows(
+                [make_flow(src_port=443, dst_port=x) for x in range(10)] +
+                [make_flow(src_port=1, dst_port=443)]))
+def test_one_family_per_metric(_mock):
+    config_basic = """
+flow_definitions = [
+    {
+        "class": "https",
+        "flows": [
+            {
+                "flow": "https-inbound",
+                "src_port": 443
+            },
+            {
+                "flow": "https-outbound",
+                "dst_port": 443
+            },
+        ],
+    },
+]
+"""
+    config = mock_module(config_basic)
+    collector = SockPuppetCollector(config)
+    items = socket_families(collector, collector.collect())
+    names = [i.name for i in items]
+    assert len(names) == len(set(names))
+    assert len(items) == len(collector.metric_definitions)
+    for i in items:
+        assert len(i.samples) == 11
+
+
+def aggregated_collect(aggregate, flows):
+    config_basic = """
+flow_definitions = [
+    {
+        "class": "ceph",
+        "aggregate": %s,
+        "flows": [
+            {
+                "flow": "ceph-osd-outbound",
+                "dst_port": "6800:7300",
+            },
+        ],
+    },
+]
+""" % aggregate
+    config = mock_module(config_basic)
+    collector = SockPuppetCollector(config)
+    with mock.patch('sockpuppet.collector.get_socket_stats',
+                    side_effect=lambda _: make_tcp_flows(flows)):
+        return dict((i.name, i) for i in
+                    socket_families(collector, collector.collect()))
+
+
+def osd_flows():
+    flows = []
+    for i, dst in enumerate(["10.0.0.1", "10.0.0.1", "10.0.0.2"]):
+        flow = make_flow(src_port=40000 + i, dst=dst, dst_port=6800 + i)
+        flow["tcp_info"]["rtt"] = 10.0 * (i + 1)
+        flows.append(flow)
+    return flows
+
+
+def test_aggregate_flow_sum():
+    items = aggregated_collect('{"gauge": "sum"}', osd_flows())
+    assert len(items) == 7
+    rtt = items["sockpuppet_tcp_rtt"].samples
+    assert len(rtt) == 1
+    assert rtt[0].value == 60.0
+    assert rtt[0].labels["flow"] == "ceph-osd-outbound"
+    assert rtt[0].labels["src_port"] == ""
+    acked = items["sockpuppet_tcp_bytes_acked"].samples
+    assert len(acked) == 1
+    assert acked[0].value == 3 * 20540
+
+
+def test_aggregate_flow_max_mean_count():
+    rtt = aggregated_collect('{"gauge": "max"}', osd_flows())
+    assert rtt["sockpuppet_tcp_rtt"].samples[0].value == 30.0
+    rtt = aggregated_collect('{"gauge": "mean"}', osd_flows())
+    assert rtt["sockpuppet_tcp_rtt"].samples[0].value == 20.0
+    items = aggregated_collect('{"gauge": "count"}', osd_flows())
+    assert items["sockpuppet_tcp_rtt"].samples[0].value == 3
+    # counters are always summed
+    acked = items["sockpuppet_tcp_bytes_acked"].samples
+    assert acked[0].value == 3 * 20540
+
+
+def test_aggregate_by_label():
+    items = aggregated_collect('{"labels": ["dst"], "gauge": "max"}',
+                               osd_flows())
+    rtt = dict((s.labels["dst"], s.value)
+               for s in items["sockpuppet_tcp_rtt"].samples)
+    assert rtt == {"10.0.0.1": 20.0, "10.0.0.2": 30.0}
+
+
+def test_aggregate_invalid():
+    for aggregate in ('{"labels": ["nope"]}', '{"gauge": "median"}'):
+        try:
+            aggregated_collect(aggregate, [])
+        except ValueError:
+            continue
+        raise AssertionError("{} was accepted".format(aggregate))
+
+
+def self_metrics(collector):
+    names = set(m.name for m in collector.metrics().values())
+    return dict((i.name, i) for i in collector.collect()
+                if i.name.startswith("sockpuppet_") and i.name not in names)
+
+
+def test_self_instrumentation():
+    config = mock_module("""
+flow_definitions = [
+    {
+        "class": "https",
+        "flows": [
+            {
+                "flow": "https-inbound",
+                "src_port": 443
+            },
+        ]
+    },
+]
+""")
+    listening = make_flow(src_port=22)
+    listening["tcp_info"]["state"] = "listening"
+    flows = [make_flow(src_port=443), make_flow(src_port=443),
+             make_flow(src_port=22), listening]
+    collector = SockPuppetCollector(config)
+    with mock.patch('sockpuppet.collector.get_socket_stats',
+                    side_effect=lambda _: make_tcp_flows(flows)):
+        items = self_metrics(collector)
+    assert items["sockpuppet_scrape_sockets"].samples[0].value == 4
+    assert items["sockpuppet_scrape_matched_sockets"].samples[0].value == 2
+    unmatched = dict((s.labels["state"], s.value) for s in
+                     items["sockpuppet_scrape_unmatched_sockets"].samples)
+    assert unmatched == {"established": 1, "listening": 1}
+    counts = dict((s.labels["stage"], s.value) for s in
+                  items["sockpuppet_scrape_stage_seconds"].samples
+                  if s.name.endswith("_count"))
+    assert counts == {"fetch": 1, "parse": 1, "match": 1, "extract": 1,
+                      "total": 1}
+
+
+def test_self_instrumentation_errors():
+    config = mock_module("""
+flow_definitions = []
+""")
+    collector = SockPuppetCollector(config)
+    collector.context.process = True
+
+    def failing_query(context):
+        context.record_error("netlink")
+        context.process_fallbacks += 1
+
+    with mock.patch('sockpuppet.collector.get_socket_stats',
+                    side_effect=failing_query):
+        items = self_metrics(collector)
+    errors = dict((s.labels["backend"], s.value) for s in
+                  items["sockpuppet_backend_errors"].samples)
+    assert errors == {"netlink": 1, "ss2": 0}
+    fallbacks = items["sockpuppet_process_fallbacks"].samples
+    assert fallbacks[0].value == 1
+    assert items["sockpuppet_scrape_sockets"].samples[0].value == 0
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock as mock
+
+from sockpuppet import columnar
+from sockpuppet.collector import SockPuppetCollector
+from sockpuppet.matcher import FlowMatcher
+
+from test_collector import make_flow, make_tcp_flows, mock_module
+from test_matcher import all_labels, mixed_definitions
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+numpy = pytest.importorskip("numpy")
+
+CONFIG = """
+engine = "columnar"
+flow_definitions = [
+    {
+        "class": "ceph",
+        "aggregate": {"labels": ["dst"], "gauge": "%s"},
+        "flows": [
+            {
+                "flow": "ceph-osd-outbound",
+                "dst_port": "6800:7300",
+            },
+        ],
+    },
+    {
+        "class": "ssh",
+        "flows": [
+            {
+                "flow": "ssh-inbound",
+                "src_port": 22,
+            },
+        ],
+    },
+]
+"""
+
+
+def test_match_flows_many_flows():
+    definitions = [{"class": "many", "flows": [
+        {"flow": str(port), "dst_port": port} for port in range(200)]}]
+    matcher = FlowMatcher(definitions)
+    flows = [make_flow(dst_port=port) for port in (0, 63, 64, 150, 199, 200)]
+    assert columnar.match_flows(matcher, flows).tolist() == \
+        [0, 63, 64, 150, 199, -1]
+
+
+@pytest.mark.parametrize("definitions", [
+    mixed_definitions(),
+    mixed_definitions()[:1],
+])
+def test_match_flows_agrees_with_matcher(definitions):
+    matcher = FlowMatcher(definitions)
+    flows = list(all_labels())
+    random.Random(42).shuffle(flows)
+    expected = [matcher.match_index(x) for x in flows]
+    expected = [-1 if x is None else x for x in expected]
+    assert columnar.match_flows(matcher, flows).tolist() == expected
+
+
+def test_match_flows_empty():
+    matcher = FlowMatcher([])
+    assert columnar.match_flows(matcher, [make_flow()]).tolist() == [-1]
+    matcher = FlowMatcher([{"class": "x", "flows": [{"flow": "y"}]}])
+    assert columnar.match_flows(matcher, []).tolist() == []
+
+
+def test_group_reduce():
+    groups = numpy.array([0, 1, 0, 1, 2])
+    values = numpy.array([1.0, 2.0, 3.0, numpy.nan, numpy.nan])
+    total, maximum, count = columnar.group_reduce(groups, 3, values)
+    assert total.tolist() == [4.0, 2.0, 0.0]
+    assert maximum[:2].tolist() == [3.0, 2.0]
+    assert count.tolist() == [2, 1, 0]
+
+
+def socket_table():
+    flows = []
+    for i in range(50):
+        flow = make_flow(src_port=40000 + i, dst="10.0.0.{}".format(i % 3),
+                         dst_port=6800 + i % 7)
+        flow["tcp_info"]["rtt"] = float(i)
+        flow["inode"] = i
+        if i % 5 == 0:
+            del flow["tcp_info"]["notsent_bytes"]
+        flows.append(flow)
+    flows.append(make_flow(src_port=22))
+    flows.append(make_flow(src_port=23))
+    return flows
+
+
+def collect(config, flows):
+    collector = SockPuppetCollector(config)
+    with mock.patch('sockpuppet.collector.get_socket_stats',
+                    side_effect=lambda _: make_tcp_flows(flows)):
+        result = {}
+        for family in collector.collect():
+            if family.name == "sockpuppet_scrape_stage_seconds":
+                continue
+            for sample in family.samples:
+                key = (sample.name, tuple(sorted(sample.labels.items())))
+                assert key not in result
+                result[key] = sample.value
+        return collector, result
+
+
+@pytest.mark.parametrize("gauge", ["sum", "max", "mean", "count"])
+def test_columnar_engine_matches_python(gauge):
+    flows = socket_table()
+    collector, expected = collect(
+        mock_module((CONFIG % gauge).replace('"columnar"', '"python"')),
+        flows)
+    assert collector.engine == "python"
+    collector, actual = collect(mock_module(CONFIG % gauge), flows)
+    assert collector.engine == "columnar"
+    assert sorted(actual) == sorted(expected)
+    for key, value in expected.items():
+        assert actual[key] == pytest.approx(value), key
+
+
+def test_columnar_engine_only_histograms():
+    # an aggregated flow without per-socket values to extract
+    config = CONFIG.replace(
+        '"aggregate"', '"metrics": ["rtt"], "histograms": {"rtt": None}, '
+        '"aggregate"') % "sum"
+    flows = socket_table()
+    _, expected = collect(
+        mock_module(config.replace('"columnar"', '"python"')), flows)
+    collector, actual = collect(mock_module(config), flows)
+    assert collector.engine == "columnar"
+    assert ("sockpuppet_tcp_flow_rtt_gcount", (
+        ("class", "ceph"), ("flow", "ceph-osd-outbound"))) in actual
+    assert actual == expected
+
+
+def test_columnar_engine_without_numpy(monkeypatch):
+    monkeypatch.setattr(columnar, "numpy", None)
+    collector = SockPuppetCollector(mock_module(CONFIG % "sum"))
+    assert collector.engine == "python"
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        SockPuppetCollector(mock_module(CONFIG.replace(
+            '"columnar"', '"fast"') % "sum"))
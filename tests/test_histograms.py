@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock as mock
+
+from sockpuppet.catalogue import build_catalogue
+from sockpuppet.collector import SockPuppetCollector
+from sockpuppet.histograms import DEFAULT_BUCKETS, bucket_counts, \
+    flow_histograms
+
+from test_collector import make_flow, make_tcp_flows, mock_module
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+CONFIG = """
+flow_definitions = [
+    {
+        "class": "ceph",
+        "histograms": {"rtt": [1, 10, 100], "snd_cwnd": None},
+        "flows": [
+            {
+                "flow": "ceph-osd-outbound",
+                "dst_port": "6800:7300",
+            },
+            {
+                "flow": "ceph-mon",
+                "dst_port": 6789,
+                "histograms": ["min_rtt"],
+            },
+        ],
+    },
+]
+"""
+
+
+def test_bucket_counts():
+    assert bucket_counts([5, 1, 10, 0.5, 200], (1, 10, 100)) == [2, 4, 4]
+    assert bucket_counts([], (1, 10)) == [0, 0]
+
+
+def test_flow_histograms():
+    catalogue = build_catalogue()
+    config = mock_module(CONFIG)
+    result = flow_histograms(config.flow_definitions, catalogue)
+    assert result == [
+        (("rtt", (1.0, 10.0, 100.0)),
+         ("snd_cwnd", tuple(float(x) for x in DEFAULT_BUCKETS["snd_cwnd"]))),
+        (("min_rtt", tuple(float(x) for x in DEFAULT_BUCKETS["min_rtt"])),),
+    ]
+
+
+def test_flow_histograms_invalid():
+    catalogue = build_catalogue()
+    for spec in ({"nope": None}, {"rtt": [10, 1]}, {"rtt": []},
+                 {"pmtu": None}, {"bytes_acked": [1, 10]}):
+        with pytest.raises(ValueError):
+            flow_histograms([{"class": "x", "histograms": spec,
+                              "flows": [{"flow": "y"}]}], catalogue)
+
+
+def test_histograms_replace_socket_series():
+    flows = []
+    for i, rtt in enumerate([0.5, 5.0, 50.0, 500.0]):
+        flow = make_flow(src_port=40000 + i, dst_port=6800 + i)
+        flow["tcp_info"]["rtt"] = rtt
+        flows.append(flow)
+    flows.append(make_flow(dst_port=6789))
+    collector = SockPuppetCollector(mock_module(CONFIG))
+    with mock.patch('sockpuppet.collector.get_socket_stats',
+                    side_effect=lambda _: make_tcp_flows(flows)):
+        items = dict((i.name, i) for i in collector.collect())
+
+    rtt = items["sockpuppet_tcp_flow_rtt"]
+    assert rtt.type == "gaugehistogram"
+    samples = dict((s.labels.get("le", s.name), s.value) for s in rtt.samples)
+    assert samples == {"1.0": 1, "10.0": 2, "100.0": 3, "+Inf": 4,
+                       "sockpuppet_tcp_flow_rtt_gcount": 4,
+                       "sockpuppet_tcp_flow_rtt_gsum": 555.5}
+    assert set(s.labels["flow"] for s in rtt.samples) == \
+        set(["ceph-osd-outbound"])
+    cwnd = items["sockpuppet_tcp_flow_snd_cwnd"]
+    assert set(s.labels["flow"] for s in cwnd.samples) == \
+        set(["ceph-osd-outbound"])
+    min_rtt = items["sockpuppet_tcp_flow_min_rtt"]
+    assert set(s.labels["flow"] for s in min_rtt.samples) == \
+        set(["ceph-mon"])
+    # the histogrammed metrics are not exported per socket
+    assert set(s.labels["flow"] for s in
+               items["sockpuppet_tcp_rtt"].samples) == set(["ceph-mon"])
+    assert "sockpuppet_tcp_min_rtt" not in items
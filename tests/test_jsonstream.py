@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import io
+import json
+import os
+import stat
+
+import pytest
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock as mock
+
+from sockpuppet import collector as collector_module
+from sockpuppet.collector import SSContext, SockPuppetCollector, \
+    get_ss2_socket_stats, read_ss2_output, BACKEND_SS2
+from sockpuppet.jsonstream import iter_flows
+
+from test_collector import make_flow, mock_module
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+CONFIG = """
+flow_definitions = [
+    {
+        "class": "example",
+        "flows": [
+            {
+                "flow": "in",
+                "src_port": "1:100"
+            },
+        ],
+    },
+]
+"""
+
+
+def ss2_output():
+    return {
+        "TCP": {"flows": [make_flow(src_port=x, cmd="/usr/bin/python")
+                          for x in range(95, 105)]},
+        "UDP": {"flows": []},
+    }
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_iter_flows(chunk_size):
+    raw = json.dumps(ss2_output(), indent=4).encode("utf-8")
+    flows = list(iter_flows(io.BytesIO(raw), chunk_size=chunk_size))
+    assert [f for _, f in flows] == ss2_output()["TCP"]["flows"]
+    assert all(protocol == "TCP" for protocol, _ in flows)
+
+
+def test_iter_flows_skips_other_keys():
+    raw = b'{"version": 12345, "TCP": {"x": [1, {"a": 2}], "flows": [{}]}}'
+    for chunk_size in (1, 3, 100):
+        flows = list(iter_flows(io.BytesIO(raw), chunk_size=chunk_size))
+        assert flows == [("TCP", {})]
+
+
+def test_iter_flows_truncated():
+    raw = json.dumps(ss2_output()).encode("utf-8")
+    with pytest.raises(ValueError):
+        list(iter_flows(io.BytesIO(raw[:len(raw) // 2])))
+    with pytest.raises(ValueError):
+        list(iter_flows(io.BytesIO(b"")))
+
+
+def test_read_ss2_output_filters_and_projects():
+    collector = SockPuppetCollector(mock_module(CONFIG))
+    raw = json.dumps(ss2_output()).encode("utf-8")
+    collector.context.udp = True
+    stats = read_ss2_output(io.BytesIO(raw), collector.context)
+    flows = stats["TCP"]["flows"]
+    assert [f["src_port"] for f in flows] == list(range(95, 101))
+    flow = flows[0]
+    assert "opts" not in flow["tcp_info"]
+    assert "rtt" in flow["tcp_info"]
+    assert flow["meminfo"] == {"t": 0, "w": 0}
+    assert flow["usr_ctxt"] == {"will": {"12044": {"cmd": "/usr/bin/python"}}}
+    assert stats["UDP"]["flows"] == []
+
+
+def test_sockets_are_matched_once():
+    collector = SockPuppetCollector(mock_module(CONFIG))
+    raw = json.dumps(ss2_output()).encode("utf-8")
+    match_index = mock.Mock(side_effect=collector.matcher.match_index)
+    collector.matcher.match_index = match_index
+    with mock.patch("sockpuppet.collector.get_socket_stats",
+                    side_effect=lambda context: read_ss2_output(
+                        io.BytesIO(raw), context)):
+        families = dict((x.name, x) for x in collector.collect())
+    assert len(families["sockpuppet_tcp_rtt"].samples) == 6
+    # by the flow filter while parsing
+    assert match_index.call_count == 10
+
+
+def test_stage_seconds(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr(collector_module, "default_timer", lambda: clock[0])
+    collector = SockPuppetCollector(mock_module(CONFIG))
+    raw = json.dumps(ss2_output()).encode("utf-8")
+    reads = []
+
+    class SlowStream(io.BytesIO):
+
+        def read(self, size=-1):
+            reads.append(size)
+            clock[0] += 1.0
+            return super(SlowStream, self).read(size)
+
+    match_index = collector.matcher.match_index
+
+    def slow_match_index(labels):
+        clock[0] += 0.5
+        return match_index(labels)
+
+    def parse(context):
+        clock[0] += 0.25
+        return read_ss2_output(SlowStream(raw), context)
+
+    collector.matcher.match_index = slow_match_index
+    with mock.patch("sockpuppet.collector.get_socket_stats",
+                    side_effect=parse):
+        families = dict((x.name, x) for x in collector.collect())
+    seconds = dict((x.labels["stage"], x.value) for x in
+                   families["sockpuppet_scrape_stage_seconds"].samples
+                   if x.name.endswith("_sum"))
+    assert seconds == {"fetch": len(reads), "parse": 0.25, "match": 5.0,
+                       "extract": 0.0, "total": len(reads) + 5.25}
+
+
+def test_get_ss2_socket_stats(tmpdir, monkeypatch):
+    output = tmpdir.join("output.json")
+    output.write(json.dumps(ss2_output()))
+    script = tmpdir.join("ss2")
+    script.write("#!/bin/sh\ncat {}\n".format(output))
+    os.chmod(str(script), stat.S_IRWXU)
+    monkeypatch.setenv("PATH", "{}:{}".format(tmpdir, os.environ["PATH"]))
+    context = SSContext(tcp=True, backend=BACKEND_SS2)
+    stats = get_ss2_socket_stats(context)
+    assert len(stats["TCP"]["flows"]) == 10
+
+
+def test_get_ss2_socket_stats_disables_process(tmpdir, monkeypatch):
+    script = tmpdir.join("ss2")
+    script.write("#!/bin/sh\ncase \"$*\" in *-p*) echo denied >&2; exit 1;;"
+                 " esac\necho '{\"TCP\": {\"flows\": []}}'\n")
+    os.chmod(str(script), stat.S_IRWXU)
+    monkeypatch.setenv("PATH", "{}:{}".format(tmpdir, os.environ["PATH"]))
+    context = SSContext(tcp=True, process=True, backend=BACKEND_SS2)
+    assert get_ss2_socket_stats(context) == {"TCP": {"flows": []}}
+    assert not context.process
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import itertools
+
+import pytest
+
+from sockpuppet import cli
+from sockpuppet.collector import find_flow, xrange
+from sockpuppet.matcher import FlowMatcher
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+
+def mixed_definitions():
+    return [
+        {
+            "class": "a",
+            "flows": [
+                {"flow": "exact", "src_port": 22, "dst": "10.0.0.1"},
+                {"flow": "range", "dst_port": "1000:2000"},
+                {"flow": "overlap", "dst_port": "1500:2500"},
+                {"flow": "xrange", "src_port": xrange(3000, 3010)},
+                {"flow": "stepped", "src_port": xrange(4000, 4010, 2)},
+            ],
+        },
+        {
+            "class": "b",
+            "flows": [
+                {"flow": "set", "src": {"10.0.0.1", "10.0.0.2"},
+                 "dst_port": {80, 443}},
+                {"flow": "string", "src_port": "22"},
+                {"flow": "cidr", "src": "10.0.0.2/31", "dst_port": 2500},
+                {"flow": "cidr-set", "dst": {"10.0.0.0/30", "2001:db8::/32",
+                                             "::ffff:10.0.4.0/120"}},
+                {"flow": "any"},
+            ],
+        },
+    ]
+
+
+def all_labels():
+    for src_port, dst_port, src, dst in itertools.product(
+            [1, 22, 999, 1000, 1499, 1500, 2000, 2001, 2500, 2501, 3000,
+             3009, 3010, 4000, 4001, 4008, None],
+            [22, 80, 443, 1000, 1750, 2500, 2501],
+            ["10.0.0.1", "10.0.0.2", "10.0.0.3", "::ffff:10.0.0.3"],
+            ["10.0.0.1", "10.0.0.4", "10.0.4.4", "2001:DB8:0::1"]):
+        labels = {"src_port": src_port, "dst_port": dst_port, "src": src,
+                  "dst": dst}
+        if src_port is None:
+            del labels["src_port"]
+        yield labels
+
+
+@pytest.mark.parametrize("definitions", [
+    mixed_definitions(),
+    mixed_definitions()[:1],
+    cli.load_config("../config/config_example.py").flow_definitions,
+    cli.load_config("../config/config_sample_1.py").flow_definitions,
+])
+def test_matcher_agrees_with_find_flow(definitions):
+    matcher = FlowMatcher(definitions)
+    for labels in all_labels():
+        expected = find_flow(definitions, labels)
+        actual = matcher.match(labels)
+        assert actual[0] is expected[0], labels
+        assert actual[1] is expected[1], labels
+
+
+def test_first_match_wins():
+    definitions = mixed_definitions()
+    matcher = FlowMatcher(definitions)
+    _, flow = matcher.match({"src_port": 22, "dst_port": 1600,
+                             "src": "10.0.0.1", "dst": "10.0.0.1"})
+    assert flow["flow"] == "exact"
+    _, flow = matcher.match({"src_port": 1, "dst_port": 1600,
+                             "src": "10.0.0.1", "dst": "10.0.0.4"})
+    assert flow["flow"] == "range"
+    _, flow = matcher.match({"src_port": 1, "dst_port": 2100,
+                             "src": "10.0.0.1", "dst": "10.0.0.4"})
+    assert flow["flow"] == "overlap"
+
+
+def test_unicode_labels():
+    # the ss2 backend yields unicode labels on python 2
+    matcher = FlowMatcher(mixed_definitions())
+    assert matcher.match_index({u"src_port": 22, u"dst_port": 1,
+                                u"src": u"10.0.0.3",
+                                u"dst": u"10.0.0.1"}) == 0
+    assert matcher.match_index({u"src_port": 1, u"dst_port": 1,
+                                u"src": u"10.0.0.3",
+                                u"dst": u"::ffff:10.0.0.2"}) == 8
+
+
+def test_no_definitions():
+    matcher = FlowMatcher([])
+    assert matcher.match({"src_port": 1}) == (None, None)
+
+
+def test_many_flows():
+    definitions = [{
+        "class": "many",
+        "flows": [{"flow": str(port), "dst_port": port}
+                  for port in range(1, 1001)],
+    }]
+    matcher = FlowMatcher(definitions)
+    _, flow = matcher.match({"dst_port": 777})
+    assert flow["flow"] == "777"
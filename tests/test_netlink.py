@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import socket
+import struct
+
+import pytest
+
+from sockpuppet import netlink
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock as mock
+
+from sockpuppet.collector import SSContext, get_socket_stats, \
+    BACKEND_NETLINK, BACKEND_SS2
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+
+def make_attr(kind, payload):
+    length = 4 + len(payload)
+    return struct.pack("=HH", length, kind) + payload + \
+        b"\0" * (-length % 4)
+
+
+def make_tcp_info(**overrides):
+    values = dict((name, 0) for name, _ in netlink._TCP_INFO_FIELDS)
+    values.update(overrides)
+    fmt = "=" + "".join(code for _, code in netlink._TCP_INFO_FIELDS)
+    return struct.pack(fmt, *[values[name] for name, _ in
+                              netlink._TCP_INFO_FIELDS])
+
+
+def make_diag_msg(src="192.168.1.1", dst="192.168.1.2", src_port=51056,
+                  dst_port=6800, inode=1823686, attrs=b""):
+    header = netlink._INET_DIAG_MSG.pack(
+        socket.AF_INET, 1, 0, 0,
+        socket.htons(src_port), socket.htons(dst_port),
+        socket.inet_aton(src) + b"\0" * 12,
+        socket.inet_aton(dst) + b"\0" * 12,
+        0, 0, 0, 0, 0, 0, inode)
+    return header + attrs
+
+
+def test_decode_inet_diag_msg():
+    tcp_info = make_tcp_info(state=1, options=0x3, wscale=0x87,
+                             rtt=34194, rcv_rtt=194250, snd_cwnd=7,
+                             bytes_acked=202480195, notsent_bytes=262154,
+                             snd_ssthresh=0x7fffffff)
+    attrs = make_attr(netlink.INET_DIAG_MEMINFO,
+                      struct.pack("=IIII", 1, 2, 3, 4)) + \
+        make_attr(netlink.INET_DIAG_INFO, tcp_info) + \
+        make_attr(netlink.INET_DIAG_CONG, b"cubic\0")
+    flow = netlink.decode_inet_diag_msg(make_diag_msg(attrs=attrs))
+    assert flow["src"] == "192.168.1.1"
+    assert flow["dst"] == "192.168.1.2"
+    assert flow["src_port"] == 51056
+    assert flow["dst_port"] == 6800
+    assert flow["inode"] == 1823686
+    assert flow["cong_algo"] == "cubic"
+    assert flow["meminfo"] == {"r": 1, "w": 2, "f": 3, "t": 4}
+    info = flow["tcp_info"]
+    assert info["state"] == "established"
+    assert info["opts"] == ["ts", "sack"]
+    assert info["snd_wscale"] == 7
+    assert info["rcv_wscale"] == 8
+    assert info["rtt"] == 34.194
+    assert info["rcv_rtt"] == 194.25
+    assert info["snd_cwnd"] == 7
+    assert info["bytes_acked"] == 202480195
+    assert info["notsent_bytes"] == 262154
+    assert info["snd_ssthresh"] is None
+
+
+def test_decode_truncated_tcp_info():
+    # older kernels send a shorter struct tcp_info
+    tcp_info = make_tcp_info(rtt=1000, bytes_acked=5)[:104]
+    info = netlink.decode_tcp_info(tcp_info)
+    assert info["rtt"] == 1.0
+    assert "bytes_acked" not in info
+
+
+def test_live_dump():
+    diag = netlink.SockDiag()
+    try:
+        diag.open()
+    except (IOError, OSError):
+        pytest.skip("NETLINK_SOCK_DIAG is not available")
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+    client = socket.create_connection(("127.0.0.1", port))
+    try:
+        stats = diag.get_socket_stats(tcp=True)
+        flows = [f for f in stats["TCP"]["flows"] if f["dst_port"] == port]
+        assert len(flows) == 1
+        assert flows[0]["tcp_info"]["state"] == "established"
+        assert flows[0]["src"] == "127.0.0.1"
+    finally:
+        client.close()
+        listener.close()
+        diag.close()
+
+
+@mock.patch("sockpuppet.collector.get_ss2_socket_stats",
+            return_value={"TCP": {"flows": []}})
+def test_netlink_falls_back_to_ss2(ss2):
+    context = SSContext(tcp=True)
+    assert context.backend == BACKEND_NETLINK
+    context.sock_diag = mock.Mock()
+    context.sock_diag.dump_replies.side_effect = OSError(
+        93, "Protocol not supported")
+    assert get_socket_stats(context) == {"TCP": {"flows": []}}
+    assert context.backend == BACKEND_SS2
+    assert ss2.call_count == 1
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import errno
+import os
+import socket
+import subprocess
+import threading
+
+import pytest
+
+from sockpuppet import netlink
+from sockpuppet.collector import SockPuppetCollector
+from sockpuppet.netns import NamespacePool, check_namespaces, \
+    enter_namespace
+
+from test_collector import mock_module
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+CONFIG = """
+process_cache_ttl = 0
+namespaces = ["a", "b"]
+flow_definitions = [
+    {
+        "class": "test",
+        "flows": [{"flow": "listener", "src_port": %d}],
+    },
+]
+"""
+
+
+def stay(path):
+    """Enter nothing, so that every worker dumps our own namespace"""
+
+
+@pytest.fixture
+def listener():
+    try:
+        netlink.SockDiag().open().close()
+    except (IOError, OSError):
+        pytest.skip("NETLINK_SOCK_DIAG is not available")
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(1)
+    yield sock
+    sock.close()
+
+
+@pytest.fixture
+def netns_dir(tmpdir):
+    for name in ("a", "b"):
+        tmpdir.join(name).write("")
+    return str(tmpdir)
+
+
+def listener_flows(stats, port):
+    return sorted(x["netns"] for x in stats["TCP"]["flows"]
+                  if x["src_port"] == port)
+
+
+def test_check_namespaces():
+    assert check_namespaces("all") == "all"
+    assert check_namespaces(("a",)) == ["a"]
+    for value in ("a", [""], [1]):
+        with pytest.raises(ValueError):
+            check_namespaces(value)
+
+
+def test_pool_dumps_every_namespace(listener, netns_dir):
+    port = listener.getsockname()[1]
+    pool = NamespacePool(["a", "b"], netns_dir, enter=stay)
+    diag = netlink.SockDiag()
+    try:
+        for _ in range(2):
+            stats = diag.get_socket_stats(namespaces=pool)
+            assert listener_flows(stats, port) == ["", "a", "b"]
+        assert sorted(pool.workers) == ["a", "b"]
+    finally:
+        pool.close()
+        diag.close()
+
+
+def test_pool_follows_all_namespaces(listener, tmpdir, netns_dir):
+    port = listener.getsockname()[1]
+    pool = NamespacePool("all", netns_dir, enter=stay)
+    diag = netlink.SockDiag()
+    try:
+        assert listener_flows(diag.get_socket_stats(namespaces=pool),
+                              port) == ["", "a", "b"]
+        tmpdir.join("a").remove()
+        tmpdir.join("c").write("")
+        assert listener_flows(diag.get_socket_stats(namespaces=pool),
+                              port) == ["", "b", "c"]
+        assert sorted(pool.workers) == ["b", "c"]
+    finally:
+        pool.close()
+        diag.close()
+
+
+def test_pool_drops_failed_namespaces(listener, netns_dir):
+    port = listener.getsockname()[1]
+    entered = []
+
+    def enter(path):
+        entered.append(path)
+        if path.endswith("b"):
+            raise OSError(errno.EPERM, "denied")
+
+    pool = NamespacePool(["a", "b"], netns_dir, enter=enter)
+    diag = netlink.SockDiag()
+    try:
+        for _ in range(2):
+            stats = diag.get_socket_stats(namespaces=pool)
+            assert listener_flows(stats, port) == ["", "a"]
+        assert pool.errors == {"b": 2}
+        # the worker of a is reused, the one of b is retried
+        assert len(entered) == 3
+    finally:
+        pool.close()
+        diag.close()
+
+
+def test_pool_counts_timeouts(netns_dir):
+    local = threading.local()
+    release = threading.Event()
+
+    def enter(path):
+        local.name = os.path.basename(path)
+
+    def dump(sock_diag):
+        if local.name == "b":
+            release.wait()
+        return local.name
+
+    pool = NamespacePool(["a", "b"], netns_dir, enter=enter, timeout=0.2)
+    try:
+        assert list(pool.wait(pool.submit(dump))) == [("a", "a")]
+        assert pool.errors == {"b": 1}
+        # the stuck worker is replaced on the next scrape
+        assert sorted(pool.workers) == ["a"]
+    finally:
+        release.set()
+        pool.close()
+
+
+def test_collector_netns_label(listener, netns_dir):
+    port = listener.getsockname()[1]
+    collector = SockPuppetCollector(mock_module(CONFIG % port))
+    assert collector.context.namespaces is not None
+    collector.context.namespaces = NamespacePool(["a", "b"], netns_dir,
+                                                 enter=stay)
+    try:
+        families = dict((x.name, x) for x in collector.collect())
+    finally:
+        collector.context.namespaces.close()
+    samples = families["sockpuppet_tcp_rtt"].samples
+    assert sorted(x.labels["netns"] for x in samples) == ["", "a", "b"]
+    assert "sockpuppet_namespace_errors" in families
+
+
+def test_no_netns_label_by_default():
+    config = mock_module((CONFIG % 1).replace('namespaces = ["a", "b"]',
+                                              ""))
+    collector = SockPuppetCollector(config)
+    assert collector.context.namespaces is None
+    assert "netns" not in collector.metric_definitions["rtt"].label_names
+
+
+def test_enter_own_namespace():
+    errors = []
+
+    def run():
+        try:
+            enter_namespace("/proc/self/ns/net")
+        except OSError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    if errors and errors[0].errno == errno.EPERM:
+        pytest.skip("entering network namespaces is not permitted")
+    assert errors == []
+
+
+@pytest.fixture
+def fresh_namespace():
+    name = "sockpuppet-test-{}".format(os.getpid())
+    try:
+        subprocess.check_call(["ip", "netns", "add", name],
+                              stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip("cannot create network namespaces")
+    yield name
+    subprocess.call(["ip", "netns", "del", name])
+
+
+def test_pool_enters_namespaces(listener, fresh_namespace):
+    port = listener.getsockname()[1]
+    pool = NamespacePool([fresh_namespace])
+    diag = netlink.SockDiag()
+    try:
+        stats = diag.get_socket_stats(namespaces=pool)
+    finally:
+        pool.close()
+        diag.close()
+    # the listener only exists in our own namespace
+    assert listener_flows(stats, port) == [""]
+    assert pool.errors == {}
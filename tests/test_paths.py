@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from sockpuppet.paths import FieldExtractor, accessor
+
+from test_collector import make_flow
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+
+def test_accessor():
+    flow = make_flow()
+    assert accessor("src")(flow) == "192.168.1.1"
+    assert accessor("tcp_info.rtt")(flow) == 23.44
+    assert accessor("tcp_info.missing")(flow) is None
+    assert accessor("tcp_info.rtt.nested")(flow) is None
+    assert accessor("nope")(None) is None
+    # not a dotted path, uses jmespath
+    assert accessor("tcp_info.opts[0]")(flow) == "ts"
+
+
+def test_field_extractor_matches_jmespath():
+    paths = ["tcp_info.rtt", "tcp_info.rcv_rtt", "meminfo.t", "src_port",
+             "tcp_info.missing", "missing.rtt", "tcp_info.opts[1]",
+             "tcp_info.rtt", "tcp_info"]
+    flow = make_flow()
+    values = FieldExtractor(paths)(flow)
+    assert values == [accessor(x)(flow) for x in paths]
+    assert values[0] == 23.44
+    assert values[6] == "sack"
+    assert values[-1] is flow["tcp_info"]
+
+
+def test_field_extractor_non_dict():
+    extractor = FieldExtractor(["tcp_info.rtt", "src"])
+    assert extractor({"tcp_info": None}) == [None, None]
+    assert extractor({"tcp_info": [1]}) == [None, None]
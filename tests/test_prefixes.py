@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import random
+import socket
+
+import pytest
+
+from sockpuppet.prefixes import PrefixTree, address_matches, \
+    parse_address, parse_prefix
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+
+def test_parse_address_normalises():
+    assert parse_address("::ffff:10.0.0.1") == parse_address("10.0.0.1")
+    assert parse_address("2001:DB8:0::1") == parse_address("2001:db8::1")
+    assert parse_address("ceph-mon") is None
+    assert parse_address(42) is None
+
+
+def test_parse_prefix():
+    assert parse_prefix("10.1.2.3/8") == \
+        (socket.AF_INET, socket.inet_aton("10.0.0.0"), 8)
+    assert parse_prefix("::ffff:10.1.0.0/112") == \
+        (socket.AF_INET, socket.inet_aton("10.1.0.0"), 16)
+    assert parse_prefix("2001:db8::1")[2] == 128
+    assert parse_prefix("host") is None
+    for value in ("10.0.0.0/33", "10.0.0.0/x", "::1/129"):
+        with pytest.raises(ValueError):
+            parse_prefix(value)
+
+
+def random_prefix(rng):
+    if rng.random() < 0.5:
+        length = rng.randint(0, 32)
+        address = socket.inet_ntoa(bytes(rng.randint(10, 11)
+                                         if i == 0 else rng.randint(0, 3)
+                                         for i in range(4)))
+    else:
+        length = rng.randint(0, 128)
+        address = "2001:db8::{:x}".format(rng.randint(0, 7))
+    return "{}/{}".format(address, length)
+
+
+def test_tree_agrees_with_linear_scan():
+    rng = random.Random(7)
+    prefixes = [random_prefix(rng) for _ in range(300)]
+    tree = PrefixTree()
+    for bit, prefix in enumerate(prefixes):
+        tree.add(*(parse_prefix(prefix) + (1 << bit,)))
+    for _ in range(500):
+        address = random_prefix(rng).partition("/")[0]
+        expected = sum(1 << bit for bit, prefix in enumerate(prefixes)
+                       if address_matches(prefix, address))
+        assert tree.lookup(*parse_address(address)) == expected, address
+
+
+def test_address_matches():
+    assert address_matches({"10.0.0.0/8", "host"}, "::ffff:10.9.9.9")
+    assert address_matches({"10.0.0.0/8", "host"}, "host")
+    assert not address_matches("10.0.0.0/8", "11.0.0.1")
+    assert not address_matches("::/0", "10.0.0.1")
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+import os
+import socket
+import stat
+
+from sockpuppet import process
+from sockpuppet.collector import SSContext, get_ss2_socket_stats, \
+    BACKEND_SS2, process_cmd
+from sockpuppet.process import ProcessCache, scan_socket_owners
+
+from test_collector import make_flow
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+
+def owner(cmd):
+    return {"root": {"1": {"full_cmd": [cmd], "cmd": cmd, "fds": [3]}}}
+
+
+class FakeProc(object):
+
+    def __init__(self, owners):
+        self.owners = owners
+        self.calls = []
+
+    def __call__(self, inodes):
+        self.calls.append(set(inodes))
+        return dict((x, self.owners[x]) for x in inodes if x in self.owners)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_scan_own_socket():
+    sock = socket.socket()
+    fd = sock.fileno()
+    try:
+        inode = os.fstat(fd).st_ino
+        owners = scan_socket_owners({inode})
+    finally:
+        sock.close()
+    pids = dict((pid, entry) for users in owners[inode].values()
+                for pid, entry in users.items())
+    assert pids[str(os.getpid())]["fds"] == [fd]
+
+
+def test_owner_with_empty_cmdline(tmpdir, monkeypatch):
+    for pid, comm in (("10", "kworker/0:1\n"), ("11", None)):
+        tmpdir.mkdir(pid).mkdir("fd")
+        tmpdir.join(pid, "fd", "3").mksymlinkto("socket:[{}]".format(pid))
+        tmpdir.join(pid, "cmdline").write("")
+        if comm is not None:
+            tmpdir.join(pid, "comm").write(comm)
+    monkeypatch.setattr(process, "_PROC", str(tmpdir))
+    owners = scan_socket_owners({10, 11})
+    # the process without a comm exited during the scan
+    assert list(owners) == [10]
+    entry = list(owners[10].values())[0]["10"]
+    assert entry == {"full_cmd": [], "cmd": "kworker/0:1", "fds": [3]}
+    assert process_cmd({"usr_ctxt": owners[10]}) == "kworker/0:1"
+
+
+def test_cache_only_scans_new_inodes():
+    proc = FakeProc({1: owner("a"), 2: owner("b")})
+    cache = ProcessCache(ttl=60, clock=Clock(), scan=proc)
+    assert cache.resolve({0, 1, 2, 3}) == {1: owner("a"), 2: owner("b")}
+    # neither known owners nor sockets without one are looked up again
+    assert cache.resolve({0, 1, 2, 3}) == {1: owner("a"), 2: owner("b")}
+    assert proc.calls == [{1, 2, 3}]
+    proc.owners[4] = owner("c")
+    assert cache.resolve({1, 4}) == {1: owner("a"), 4: owner("c")}
+    assert proc.calls[1:] == [{4}]
+    # closed sockets are evicted
+    assert sorted(cache.entries) == [1, 4]
+    assert cache.scans == 2
+
+
+def test_cache_ttl():
+    clock = Clock()
+    proc = FakeProc({1: owner("a")})
+    cache = ProcessCache(ttl=60, clock=clock, scan=proc)
+    cache.resolve({1})
+    clock.now += 59
+    cache.resolve({1})
+    assert len(proc.calls) == 1
+    proc.owners[1] = owner("b")
+    clock.now += 1
+    assert cache.resolve({1}) == {1: owner("b")}
+    assert len(proc.calls) == 2
+
+
+def test_cache_size():
+    proc = FakeProc({1: owner("a"), 2: owner("b")})
+    cache = ProcessCache(max_entries=1, clock=Clock(), scan=proc)
+    assert cache.resolve({1, 2}) == {1: owner("a"), 2: owner("b")}
+    assert len(cache.entries) == 1
+    cache.resolve({1, 2})
+    assert len(proc.calls) == 2
+    assert len(proc.calls[1]) == 1
+
+
+def test_ss2_without_process_flag(tmpdir, monkeypatch):
+    flow = make_flow(src_port=1)
+    script = tmpdir.join("ss2")
+    script.write("#!/bin/sh\ncase \"$*\" in *-p*) exit 1;; esac\n"
+                 "echo '{}'\n".format(json.dumps({"TCP": {"flows": [flow]}})))
+    os.chmod(str(script), stat.S_IRWXU)
+    monkeypatch.setenv("PATH", "{}:{}".format(tmpdir, os.environ["PATH"]))
+    proc = FakeProc({flow["inode"]: owner("ceph-osd")})
+    context = SSContext(tcp=True, process=True, backend=BACKEND_SS2,
+                        process_cache=ProcessCache(scan=proc))
+    for _ in range(2):
+        stats = get_ss2_socket_stats(context)
+        flows = stats["TCP"]["flows"]
+        assert flows[0]["usr_ctxt"] == owner("ceph-osd")
+    assert context.process
+    assert len(proc.calls) == 1
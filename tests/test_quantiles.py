@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock as mock
+
+from sockpuppet import columnar
+from sockpuppet.catalogue import build_catalogue
+from sockpuppet.collector import SockPuppetCollector
+from sockpuppet.quantiles import DDSketch, QuantileWindow, flow_quantiles
+
+from test_collector import make_flow, make_tcp_flows, mock_module
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+CONFIG = """
+process_cache_ttl = 0
+engine = "%s"
+flow_definitions = [
+    {
+        "class": "ceph",
+        "quantiles": {
+            "rtt": {"quantiles": [0.5, 0.99], "window": 2},
+            "notsent_bytes": None,
+        },
+        "flows": [
+            {
+                "flow": "ceph-osd-outbound",
+                "dst_port": "6800:7300",
+            },
+        ],
+    },
+]
+"""
+
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+def test_sketch_relative_accuracy():
+    rng = random.Random(1)
+    values = [rng.lognormvariate(0, 2) for _ in range(20000)]
+    sketch = DDSketch(accuracy=0.01)
+    for value in values:
+        sketch.add(value)
+    assert sketch.count == len(values)
+    for q in (0.01, 0.5, 0.9, 0.99, 1):
+        expected = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - expected) <= 0.01 * expected
+    assert sketch.quantile(0) == min(values)
+    assert DDSketch().quantile(0.5) != DDSketch().quantile(0.5)
+
+
+def test_sketch_merge_matches_single_sketch():
+    rng = random.Random(2)
+    values = [rng.uniform(0, 1000) for _ in range(3000)]
+    whole, left, right = DDSketch(), DDSketch(), DDSketch()
+    for i, value in enumerate(values):
+        whole.add(value)
+        (left if i % 2 else right).add(value)
+    left.merge(right)
+    assert left.bins == whole.bins
+    assert left.quantile(0.9) == whole.quantile(0.9)
+    with pytest.raises(ValueError):
+        left.merge(DDSketch(accuracy=0.05))
+
+
+def test_sketch_zeros_and_bounded_bins():
+    sketch = DDSketch(max_bins=16)
+    for value in [0] * 10 + [10 ** (x / 10.0) for x in range(100)]:
+        sketch.add(value)
+    assert len(sketch.bins) == 16
+    assert sketch.quantile(0.05) == 0
+    assert sketch.quantile(1) == pytest.approx(10 ** 9.9, rel=0.01)
+
+
+def test_window_forgets_old_intervals():
+    window = QuantileWindow(window=2)
+    for value in (1000, 1, 2):
+        window.begin()
+        window.add(value)
+    merged = window.merged()
+    assert merged.count == 2
+    assert merged.max == 2
+
+
+def test_invalid_quantiles():
+    catalogue = build_catalogue()
+    for spec in (["nope"], {"rtt": {"quantiles": [2]}},
+                 {"rtt": {"window": 0}}, {"rtt": {"accuracy": 1}}):
+        with pytest.raises(ValueError):
+            flow_quantiles([{"class": "x", "quantiles": spec,
+                             "flows": [{"flow": "y"}]}], catalogue)
+
+
+def make_sample(rtts):
+    flows = []
+    for i, rtt in enumerate(rtts):
+        flow = make_flow(src_port=40000 + i, dst_port=6800)
+        flow["inode"] = i + 1
+        flow["tcp_info"]["rtt"] = rtt
+        flows.append(flow)
+    flows.append(make_flow(dst_port=6789))
+    return make_tcp_flows(flows)
+
+
+def rtt_quantiles(collector, rtts):
+    with mock.patch("sockpuppet.collector.get_socket_stats",
+                    return_value=make_sample(rtts)):
+        items = dict((x.name, x) for x in collector.collect())
+    family = items["sockpuppet_tcp_flow_rtt_quantiles"]
+    assert family.type == "summary"
+    return dict((x.labels.get("quantile", x.name), x.value)
+                for x in family.samples)
+
+
+@pytest.mark.parametrize("engine", [
+    "python",
+    pytest.param("columnar", marks=pytest.mark.skipif(
+        not columnar.available(), reason="NumPy is not installed")),
+])
+def test_flow_quantiles_over_window(engine):
+    collector = SockPuppetCollector(mock_module(CONFIG % engine))
+    samples = rtt_quantiles(collector, [float(x) for x in range(1, 101)])
+    assert samples["0.5"] == pytest.approx(50, rel=0.01)
+    assert samples["0.99"] == pytest.approx(99, rel=0.01)
+    assert samples["sockpuppet_tcp_flow_rtt_quantiles_count"] == 100
+    # merged with the previous interval
+    samples = rtt_quantiles(collector, [1000.0] * 100)
+    assert samples["0.5"] == pytest.approx(100, rel=0.01)
+    assert samples["sockpuppet_tcp_flow_rtt_quantiles_count"] == 200
+    # the first interval left the window
+    samples = rtt_quantiles(collector, [1000.0] * 100)
+    assert samples["0.5"] == pytest.approx(1000, rel=0.01)
+    assert len(collector.quantiles.windows) == 2
+    # but count and sum are counters
+    assert samples["sockpuppet_tcp_flow_rtt_quantiles_count"] == 300
+    assert samples["sockpuppet_tcp_flow_rtt_quantiles_sum"] == \
+        5050 + 200 * 1000
+
+
+def test_quantiles_survive_reload():
+    collector = SockPuppetCollector(mock_module(CONFIG % "python"))
+    rtt_quantiles(collector, [10.0] * 10)
+    replacement = SockPuppetCollector(mock_module(CONFIG % "python"))
+    replacement.inherit(collector)
+    samples = rtt_quantiles(replacement, [20.0] * 10)
+    assert samples["sockpuppet_tcp_flow_rtt_quantiles_count"] == 20
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import signal
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock as mock
+
+from sockpuppet import cli
+from sockpuppet.collector import SockPuppetCollector
+from sockpuppet.matcher import FlowMatcher, unchanged_flows
+from sockpuppet.reload import ConfigReloader, ReloadingCollector
+
+from test_collector import make_flow, make_tcp_flows, mock_module
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+CONFIG = """
+process_cache_ttl = 0
+flow_definitions = [
+    {
+        "class": "web",
+        "flows": [
+            %s
+        ],
+    },
+]
+"""
+
+HTTPS = '{"flow": "https", "src_port": 443},'
+HTTP = '{"flow": "http", "src_port": 80},'
+HTTP_ALT = '{"flow": "http", "src_port": 8080},'
+SSH = '{"flow": "ssh", "src_port": 22},'
+
+
+def make_config(*flows):
+    return CONFIG % "\n            ".join(flows)
+
+
+def make_sample(acked):
+    flows = []
+    for i, (port, value) in enumerate(acked):
+        flow = make_flow(src_port=port, dst_port=50000 + i)
+        flow["inode"] = i + 1
+        flow["tcp_info"]["bytes_acked"] = value
+        flows.append(flow)
+    return make_tcp_flows(flows)
+
+
+def totals(collector):
+    for family in collector.collect():
+        if family.name == "sockpuppet_tcp_flow_bytes_acked":
+            return dict((x.labels["flow"], x.value) for x in family.samples
+                        if x.name.endswith("_total"))
+    return {}
+
+
+def test_unchanged_flows():
+    old = FlowMatcher(mock_module(make_config(HTTPS, HTTP))
+                      .flow_definitions)
+    new = FlowMatcher(mock_module(make_config(SSH, HTTP_ALT, HTTPS))
+                      .flow_definitions)
+    assert unchanged_flows(old.flows, new.flows) == {0: 2}
+
+
+@mock.patch("sockpuppet.collector.get_socket_stats")
+def test_replace_keeps_state_of_unchanged_flows(get_socket_stats):
+    collector = ReloadingCollector(
+        SockPuppetCollector(mock_module(make_config(HTTPS, HTTP))))
+    get_socket_stats.return_value = make_sample([(443, 100), (80, 10)])
+    assert totals(collector) == {"https": 100, "http": 10}
+    collector.replace(
+        SockPuppetCollector(mock_module(make_config(SSH, HTTPS, HTTP_ALT))))
+    assert totals(collector.collector) == {"https": 100}
+    assert [x.flow_index for x in
+            collector.collector.state.entries.values()] == [1]
+    # https continues from where it was, http counts from zero
+    get_socket_stats.return_value = make_sample([(443, 150), (80, 20),
+                                                 (8080, 5)])
+    assert totals(collector) == {"https": 150, "http": 5}
+
+
+@mock.patch("sockpuppet.collector.get_socket_stats")
+def test_replace_edited_flow_does_not_count_sockets_again(get_socket_stats):
+    collector = ReloadingCollector(
+        SockPuppetCollector(mock_module(make_config(HTTPS, HTTP))))
+    get_socket_stats.return_value = make_sample([(443, 100), (80, 1000)])
+    assert totals(collector) == {"https": 100, "http": 1000}
+    edited = '{"flow": "http", "src_port": 80, "dst_port": 50001},'
+    collector.replace(
+        SockPuppetCollector(mock_module(make_config(HTTPS, edited))))
+    assert totals(collector.collector) == {"https": 100, "http": 0}
+    # the socket was already tracked, only its growth since is counted
+    get_socket_stats.return_value = make_sample([(443, 150), (80, 1010)])
+    assert totals(collector) == {"https": 150, "http": 10}
+
+
+def write_config(path, flows, mtime):
+    path.write(make_config(*flows))
+    os.utime(str(path), (mtime, mtime))
+
+
+def test_reloader_watches_file(tmpdir):
+    path = tmpdir.join("config.py")
+    write_config(path, [HTTPS], 1000)
+    target = ReloadingCollector(
+        SockPuppetCollector(cli.load_config(str(path))))
+    reloader = ConfigReloader(str(path), target, cli.load_config,
+                              interval=1)
+    assert not reloader.poll()
+    path.write("flow_definitions = [")
+    os.utime(str(path), (1001, 1001))
+    assert not reloader.poll()
+    assert target.reloads == {"success": 0, "failure": 1}
+    write_config(path, [HTTPS, SSH], 1002)
+    old = target.collector
+    assert reloader.poll()
+    assert target.collector is not old
+    assert len(target.collector.matcher.flows) == 2
+    assert target.reloads == {"success": 1, "failure": 1}
+    samples = [x for x in target.collect()
+               if x.name == "sockpuppet_config_reloads"][0].samples
+    assert dict((x.labels["result"], x.value) for x in samples) == \
+        {"success": 1, "failure": 1}
+
+
+def test_reloader_sighup(tmpdir):
+    path = tmpdir.join("config.py")
+    write_config(path, [HTTPS], 1000)
+    target = ReloadingCollector(
+        SockPuppetCollector(cli.load_config(str(path))))
+    reloader = ConfigReloader(str(path), target, cli.load_config)
+    previous = signal.getsignal(signal.SIGHUP)
+    try:
+        reloader.install_signal_handler()
+        assert not reloader.poll()
+        write_config(path, [HTTPS, SSH], 1000)
+        os.kill(os.getpid(), signal.SIGHUP)
+        assert reloader.requested.is_set()
+        assert reloader.poll()
+    finally:
+        signal.signal(signal.SIGHUP, previous)
+    assert len(target.collector.matcher.flows) == 2
+
+
+def test_load_config_is_fresh(tmpdir):
+    path = tmpdir.join("config.py")
+    path.write("flow_definitions = []\nbackend = 'ss2'\n")
+    assert cli.load_config(str(path)).backend == "ss2"
+    path.write("flow_definitions = []\n")
+    assert not hasattr(cli.load_config(str(path)), "backend")
+
+
+def test_check_file_does_not_load(tmpdir):
+    path = tmpdir.join("config.py")
+    path.write("raise SystemExit(1)\n")
+    assert cli.check_file(str(path)) == str(path)
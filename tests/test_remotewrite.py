@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import random
+import struct
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from prometheus_client import CollectorRegistry, Counter, Gauge
+from prometheus_client.core import GaugeMetricFamily
+
+from sockpuppet import remotewrite
+from sockpuppet.sampler import Sampler
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+
+def read_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def read_fields(data):
+    """Decode a protobuf message into (field number, value) pairs"""
+    data = bytearray(data)
+    position = 0
+    while position < len(data):
+        key, position = read_varint(data, position)
+        number, kind = key >> 3, key & 7
+        if kind == 0:
+            value, position = read_varint(data, position)
+        elif kind == 1:
+            value, = struct.unpack_from("<d", data, position)
+            position += 8
+        elif kind == 2:
+            size, position = read_varint(data, position)
+            value = bytes(data[position:position + size])
+            position += size
+        else:
+            raise AssertionError("unexpected wire type {}".format(kind))
+        yield number, value
+
+
+def decode_write_request(body):
+    """Return the (labels, [(value, timestamp)]) of each TimeSeries"""
+    result = []
+    for _, timeseries in read_fields(remotewrite._decompress(body)):
+        labels, samples = [], []
+        for number, value in read_fields(timeseries):
+            fields = dict(read_fields(value))
+            if number == 1:
+                labels.append((fields[1].decode("utf-8"),
+                               fields[2].decode("utf-8")))
+            else:
+                samples.append((fields[1], fields[2]))
+        result.append((labels, samples))
+    return result
+
+
+class Receiver(object):
+    """A stand-in remote-write endpoint
+
+    Answers with the given statuses in turn, then with 200.
+    """
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.requests = []
+        self.accepted = []
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                receiver.requests.append(dict(self.headers))
+                status = receiver.statuses.pop(0) \
+                    if receiver.statuses else 200
+                if status == 200:
+                    receiver.accepted.append(decode_write_request(body))
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/api/v1/write".format(
+            self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def receiver():
+    receivers = []
+
+    def make(statuses=()):
+        receivers.append(Receiver(statuses))
+        return receivers[-1]
+
+    yield make
+    for x in receivers:
+        x.close()
+
+
+def make_registry(series=1):
+    registry = CollectorRegistry()
+    gauge = Gauge("sockpuppet_test", "Test gauge", ["flow", "class"],
+                  registry=registry)
+    for i in range(series):
+        gauge.labels("flow{}".format(i), "ceph").set(i + 0.5)
+    return registry
+
+
+def make_writer(url, registry=None, **kwargs):
+    kwargs.setdefault("min_backoff", 0.01)
+    sampler = Sampler(registry or make_registry(), 10,
+                      clock=lambda: 1500.25)
+    sampler.refresh()
+    return remotewrite.RemoteWriter(url, sampler, **kwargs)
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"x",
+    b"sockpuppet_tcp_rtt{class=\"ceph\"} 1.0\n" * 500,
+    os.urandom(70000),
+    bytes(bytearray(random.Random(1).choice(b"ab") for _ in range(5000))),
+])
+def test_snappy_round_trip(data):
+    compressed = remotewrite._compress(data)
+    assert remotewrite._decompress(compressed) == data
+    assert remotewrite.decompress(remotewrite.compress(data)) == data
+    # the worst case bound of the snappy format
+    assert len(compressed) <= 32 + len(data) + len(data) // 6
+
+
+def test_snappy_compresses_expositions():
+    data = b"sockpuppet_tcp_rtt{class=\"ceph\",port=\"6800\"} 1.0\n" * 500
+    assert len(remotewrite._compress(data)) < len(data) / 10
+
+
+def test_push(receiver):
+    endpoint = receiver()
+    registry = make_registry()
+    Counter("sockpuppet_test_events", "Test counter",
+            registry=registry).inc(3)
+    writer = make_writer(endpoint.url, registry)
+    writer.sample()
+    writer.flush()
+    assert endpoint.requests[0]["Content-Encoding"] == "snappy"
+    assert endpoint.requests[0]["Content-Type"] == "application/x-protobuf"
+    series = dict((tuple(labels), samples)
+                  for labels, samples in endpoint.accepted[0])
+    assert series[(("__name__", "sockpuppet_test"), ("class", "ceph"),
+                   ("flow", "flow0"))] == [(0.5, 1500250)]
+    assert series[(("__name__", "sockpuppet_test_events_total"),)] == \
+        [(3.0, 1500250)]
+    assert writer.sent_samples == len(series)
+
+
+class CountingCollector(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def collect(self):
+        self.calls += 1
+        yield GaugeMetricFamily("sockpuppet_test_calls", "Collect calls",
+                                value=self.calls)
+
+
+def test_pushes_sampler_snapshots(receiver):
+    endpoint = receiver()
+    registry = CollectorRegistry(auto_describe=False)
+    collector = CountingCollector()
+    registry.register(collector)
+    clock = [1500.0]
+    sampler = Sampler(registry, 10, clock=lambda: clock[0])
+    writer = remotewrite.RemoteWriter(endpoint.url, sampler)
+    # nothing to push before the first snapshot
+    assert not writer.sample()
+    sampler.refresh()
+    assert writer.sample()
+    # a snapshot is pushed once
+    assert not writer.sample()
+    clock[0] += 10
+    sampler.refresh()
+    assert writer.sample()
+    writer.flush()
+    # pushing does not collect the registry
+    assert collector.calls == 2
+    assert [x[0][1] for x in endpoint.accepted] == \
+        [[(1.0, 1500000)], [(2.0, 1510000)]]
+
+
+def test_batches(receiver):
+    endpoint = receiver()
+    writer = make_writer(endpoint.url, make_registry(5), batch_size=2)
+    writer.sample()
+    writer.flush()
+    assert [len(x) for x in endpoint.accepted] == [2, 2, 1]
+    assert [x[0][0][2][1] for x in endpoint.accepted] == \
+        ["flow0", "flow2", "flow4"]
+
+
+def test_retry_with_backoff(receiver):
+    endpoint = receiver([503, 429])
+    writer = make_writer(endpoint.url)
+    writer.sample()
+    writer.flush()
+    assert len(endpoint.requests) == 3
+    assert len(endpoint.accepted) == 1
+    assert writer.retries == 2
+    assert writer.dropped[remotewrite.DROP_RETRIES] == 0
+
+
+@pytest.mark.parametrize("statuses,reason", [
+    ([400], remotewrite.DROP_REJECTED),
+    ([500] * 3, remotewrite.DROP_RETRIES),
+])
+def test_drops(receiver, statuses, reason):
+    endpoint = receiver(statuses)
+    writer = make_writer(endpoint.url, make_registry(3), max_retries=2)
+    writer.sample()
+    writer.flush()
+    assert endpoint.accepted == []
+    assert writer.dropped[reason] == 3
+    assert writer.sent_samples == 0
+    samples = dict((x.labels.get("reason", x.name), x.value)
+                   for family in writer.collect() for x in family.samples)
+    assert samples[reason] == 3
+
+
+def test_connection_errors_are_retried():
+    writer = make_writer("http://127.0.0.1:1/api/v1/write", max_retries=1)
+    writer.sample()
+    writer.flush()
+    assert writer.retries == 1
+    assert writer.dropped[remotewrite.DROP_RETRIES] == 1
+
+
+def test_queue_drops_oldest_batches(receiver):
+    endpoint = receiver()
+    registry = make_registry(3)
+    writer = make_writer(endpoint.url, registry, batch_size=1,
+                         queue_size=2)
+    writer.sample()
+    assert len(writer.queue) == 2
+    assert writer.dropped[remotewrite.DROP_QUEUE_FULL] == 1
+    writer.flush()
+    assert [x[0][0][2][1] for x in endpoint.accepted] == ["flow1", "flow2"]
+
+
+def test_background_push(receiver):
+    endpoint = receiver()
+    sampler = Sampler(make_registry(), 0.05)
+    sampler.start()
+    writer = remotewrite.RemoteWriter(endpoint.url, sampler, interval=0.05,
+                                      min_backoff=0.01)
+    writer.start()
+    try:
+        deadline = time.time() + 5
+        while len(endpoint.accepted) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        writer.stop()
+        sampler.stop()
+    assert len(endpoint.accepted) >= 3
+    assert all(t.ident and not t.is_alive() for t in writer.threads)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+try:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, HTTPError
+
+import pytest
+from prometheus_client.core import CollectorRegistry, GaugeMetricFamily
+
+from sockpuppet import cli
+from sockpuppet.sampler import Sampler, start_snapshot_server
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+
+class CountingCollector(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def collect(self):
+        self.calls += 1
+        metric = GaugeMetricFamily("test_calls", "collect calls")
+        metric.add_metric([], self.calls)
+        yield metric
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_sampler(max_staleness=None):
+    registry = CollectorRegistry(auto_describe=False)
+    collector = CountingCollector()
+    registry.register(collector)
+    clock = FakeClock()
+    sampler = Sampler(registry, 10, max_staleness=max_staleness, clock=clock)
+    return sampler, collector, clock
+
+
+def test_render_serves_snapshot():
+    sampler, collector, clock = make_sampler()
+    assert sampler.render() is None
+    sampler.refresh()
+    clock.now += 2.5
+    first = sampler.render()
+    second = sampler.render()
+    assert collector.calls == 1
+    assert b"test_calls 1.0" in first
+    assert b"sockpuppet_snapshot_age_seconds 2.5" in first
+    assert first == second
+
+
+def test_render_refuses_stale_snapshot():
+    sampler, _, clock = make_sampler(max_staleness=30)
+    sampler.refresh()
+    clock.now += 30
+    assert sampler.render() is not None
+    clock.now += 1
+    assert sampler.render() is None
+
+
+def test_snapshot_server():
+    sampler, collector, clock = make_sampler(max_staleness=30)
+    sampler.refresh()
+    server = start_snapshot_server(sampler, 0, addr="127.0.0.1")
+    url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+    try:
+        for _ in range(3):
+            body = urlopen(url).read()
+            assert b"test_calls 1.0" in body
+        assert collector.calls == 1
+        clock.now += 60
+        with pytest.raises(HTTPError) as e:
+            urlopen(url)
+        assert e.value.code == 503
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_sample_interval_args():
+    args = cli.parse_args(["--config-path", "../config/config_example.py",
+                           "--sample-interval", "15"])
+    assert args.sample_interval == 15
+    assert args.max_staleness is None
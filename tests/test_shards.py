@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import signal
+import socket
+
+import pytest
+
+from sockpuppet import netlink
+from sockpuppet.collector import SockPuppetCollector
+from sockpuppet.shards import ShardPool, ShardSpec, _ShardWorker
+
+from test_collector import mock_module
+from test_netlink import make_attr, make_diag_msg, make_tcp_info
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+DEFINITIONS = [
+    {
+        "class": "ceph",
+        "flows": [
+            {"flow": "ceph-mon", "dst_port": 6789},
+            {"flow": "ceph-osd", "dst_port": "6800:7300"},
+        ],
+    },
+]
+
+CONFIG = """
+process_cache_ttl = 0
+workers = %(workers)s
+shard_size = 2
+flow_definitions = [
+    {
+        "class": "local",
+        "flows": [
+            {
+                "flow": "client",
+                "dst_port": %(port)s,
+            },
+            {
+                "flow": "server",
+                "src_port": %(port)s,
+            },
+        ],
+    },
+]
+"""
+
+
+def make_bodies():
+    bodies = []
+    for i, port in enumerate([6789, 22, 6800, 80, 7000, 6789, 443]):
+        attrs = make_attr(netlink.INET_DIAG_INFO,
+                          make_tcp_info(state=1, bytes_acked=i * 100))
+        bodies.append(make_diag_msg(dst_port=port, src_port=40000 + i,
+                                    inode=i + 1, attrs=attrs))
+    return bodies
+
+
+def make_pool(workers=2, shard_size=2, **kwargs):
+    return ShardPool(ShardSpec(DEFINITIONS,
+                               [["tcp_info.bytes_acked"]] * 2),
+                     workers, shard_size, **kwargs)
+
+
+@pytest.mark.parametrize("shard_size", [1, 2, 3, 100])
+def test_shards_are_merged_in_dump_order(shard_size):
+    pool = make_pool(shard_size=shard_size)
+    try:
+        tcp, udp, unmatched = pool.run([(None, make_bodies(), []),
+                                        ("blue", make_bodies()[:2], [])])
+    finally:
+        pool.close()
+    assert [(index, flow["inode"], flow.get("netns"), values)
+            for index, flow, values in tcp] == [
+        (0, 1, None, [0]), (1, 3, None, [200]), (1, 5, None, [400]),
+        (0, 6, None, [500]), (0, 1, "blue", [0])]
+    assert udp == []
+    assert unmatched == {"established": 4}
+    assert pool.shards["local"] == 0
+
+
+def test_single_shard_is_processed_locally():
+    pool = make_pool(shard_size=100)
+    tcp, _, _ = pool.run([(None, make_bodies(), [])])
+    assert len(tcp) == 4
+    assert pool.shards == {"pool": 0, "local": 1}
+    assert pool.pool is None
+
+
+def test_killed_worker(monkeypatch):
+    # python 2 always forks
+    start_method = getattr(multiprocessing, "get_start_method",
+                           lambda: "fork")
+    if start_method() != "fork":
+        pytest.skip("workers must inherit the patched worker")
+    parent = os.getpid()
+    run = _ShardWorker.run
+
+    def killed(self, *args):
+        if os.getpid() != parent:
+            os.kill(os.getpid(), signal.SIGKILL)
+        return run(self, *args)
+
+    monkeypatch.setattr(_ShardWorker, "run", killed)
+    pool = make_pool(timeout=1)
+    try:
+        tcp, _, unmatched = pool.run([(None, make_bodies(), [])])
+        # the shards are processed locally and the pool is replaced
+        assert [x[1]["inode"] for x in tcp] == [1, 3, 5, 6]
+        assert unmatched == {"established": 3}
+        assert pool.timeouts == 1
+        assert pool.shards == {"pool": 0, "local": 4}
+        assert pool.pool is None
+        monkeypatch.undo()
+        tcp, _, _ = pool.run([(None, make_bodies(), [])])
+        assert len(tcp) == 4
+        assert pool.shards["pool"] == 4
+    finally:
+        pool.close()
+
+
+def test_invalid_pool():
+    for workers, shard_size, timeout in ((0, 1, 1), (1, 0, 1), (1, 1, 0)):
+        with pytest.raises(ValueError):
+            make_pool(workers, shard_size, timeout=timeout)
+
+
+def series(collector, name):
+    for family in collector.collect():
+        if family.name == name:
+            return [(x.labels["flow"], x.labels["src_port"],
+                     x.labels["dst_port"]) for x in family.samples]
+    return []
+
+
+def test_workers_collect_like_a_single_process():
+    diag = netlink.SockDiag()
+    try:
+        diag.open()
+    except (IOError, OSError):
+        pytest.skip("NETLINK_SOCK_DIAG is not available")
+    diag.close()
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+    port = listener.getsockname()[1]
+    clients = [socket.create_connection(("127.0.0.1", port))
+               for _ in range(5)]
+    servers = [listener.accept()[0] for _ in clients]
+    sharded = SockPuppetCollector(mock_module(
+        CONFIG % {"workers": 2, "port": port}))
+    single = SockPuppetCollector(mock_module(
+        CONFIG % {"workers": 0, "port": port}))
+    try:
+        expected = series(single, "sockpuppet_tcp_bytes_acked")
+        assert len(expected) == 11
+        assert series(sharded, "sockpuppet_tcp_bytes_acked") == expected
+        assert sharded.context.shards.shards["pool"] > 1
+        replacement = SockPuppetCollector(mock_module(
+            CONFIG % {"workers": 2, "port": port}))
+        replacement.inherit(sharded)
+        assert sharded.context.shards.pool is None
+        assert series(replacement, "sockpuppet_tcp_bytes_acked") == expected
+    finally:
+        for sock in clients + servers + [listener]:
+            sock.close()
+        for collector in (sharded, single):
+            if collector.context.shards is not None:
+                collector.context.shards.close()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock as mock
+
+from sockpuppet.collector import SockPuppetCollector
+from sockpuppet.state import SocketStateTable, socket_key
+
+from test_collector import make_flow, make_tcp_flows, mock_module
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+CONFIG = """
+flow_definitions = [
+    {
+        "class": "https",
+        "flows": [
+            {
+                "flow": "https-inbound",
+                "src_port": 443
+            },
+        ],
+    },
+]
+"""
+
+
+def test_state_table_deltas():
+    table = SocketStateTable()
+    table.begin(100)
+    assert table.update("a", 0, (10, 20)) == (10, 20)
+    table.end()
+    table.begin(110)
+    assert table.elapsed == 10
+    assert table.update("a", 0, (15, 20)) == (5, 0)
+    # a new socket counts from zero
+    assert table.update("b", 0, (7, 8)) == (7, 8)
+    table.end()
+    table.begin(120)
+    # counters went backwards: the key was reused by a new socket
+    assert table.update("a", 0, (3, 30)) == (3, 30)
+    table.end()
+    assert set(table.entries) == {"a"}
+
+
+def test_state_table_evicts_vanished_sockets():
+    table = SocketStateTable()
+    table.begin(0)
+    table.update("a", 0, (1, 1))
+    table.update("b", 0, (1, 1))
+    assert table.end() == 0
+    table.begin(1)
+    table.update("b", 0, (2, 2))
+    assert table.end() == 1
+    assert list(table.entries) == ["b"]
+
+
+def test_socket_key():
+    flow = make_flow()
+    assert socket_key(flow) == (None, 582720, "192.168.1.1", 1,
+                                "192.168.1.2", 8888)
+    flow["inode"] = 0
+    other = dict(flow, netns="a")
+    assert socket_key(flow) != socket_key(other)
+
+
+def make_sample(acked):
+    flows = []
+    for i, value in enumerate(acked):
+        flow = make_flow(src_port=443, dst_port=50000 + i)
+        flow["inode"] = i + 1
+        flow["tcp_info"]["bytes_acked"] = value
+        flows.append(flow)
+    return make_tcp_flows(flows)
+
+
+@mock.patch("sockpuppet.collector.time.time")
+@mock.patch("sockpuppet.collector.get_socket_stats")
+def test_flow_rates(get_socket_stats, clock):
+    collector = SockPuppetCollector(mock_module(CONFIG))
+    clock.return_value = 100
+    get_socket_stats.return_value = make_sample([1000, 2000])
+    items = dict((i.name, i) for i in collector.collect())
+    assert "sockpuppet_tcp_flow_bytes_acked_rate" not in items
+
+    clock.return_value = 110
+    get_socket_stats.return_value = make_sample([1500, 2500, 300])
+    items = dict((i.name, i) for i in collector.collect())
+    delta = items["sockpuppet_tcp_flow_bytes_acked_delta"].samples
+    assert len(delta) == 1
+    assert delta[0].labels == {"class": "https", "flow": "https-inbound"}
+    assert delta[0].value == 1300
+    rate = items["sockpuppet_tcp_flow_bytes_acked_rate"].samples
+    assert rate[0].value == 130
+    received = items["sockpuppet_tcp_flow_bytes_received_delta"].samples
+    assert received[0].value == 45372
+
+    clock.return_value = 120
+    get_socket_stats.return_value = make_sample([1600])
+    items = dict((i.name, i) for i in collector.collect())
+    delta = items["sockpuppet_tcp_flow_bytes_acked_delta"].samples
+    assert delta[0].value == 100
+    assert len(collector.state.entries) == 1
+
+
+def test_state_table_is_bounded():
+    table = SocketStateTable(max_sockets=2)
+    table.begin(0)
+    assert table.update("a", 0, (1, 1)) == (1, 1)
+    assert table.update("b", 0, (1, 1)) == (1, 1)
+    assert table.update("c", 0, (5, 5)) is None
+    assert table.untracked == 1
+    table.end()
+    table.begin(1)
+    table.update("a", 0, (2, 2))
+    table.end()
+    table.begin(2)
+    # room again: c counts from zero, so none of its traffic is lost
+    assert table.update("c", 0, (6, 6)) == (6, 6)
+
+
+@mock.patch("sockpuppet.collector.time.time")
+@mock.patch("sockpuppet.collector.get_socket_stats")
+def test_flow_totals_include_closed_sockets(get_socket_stats, clock):
+    collector = SockPuppetCollector(mock_module(CONFIG))
+    labels = {"class": "https", "flow": "https-inbound"}
+    totals = []
+    for now, sample in enumerate([[1000, 2000], [1500, 2500, 300], [1600],
+                                  [], [10]]):
+        clock.return_value = now
+        get_socket_stats.return_value = make_sample(sample)
+        items = dict((i.name, i) for i in collector.collect())
+        samples = [s for s in items["sockpuppet_tcp_flow_bytes_acked"].samples
+                   if s.name.endswith("_total")]
+        assert samples[0].labels == labels
+        totals.append(samples[0].value)
+    assert totals == [3000, 4300, 4400, 4400, 4410]
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import random
+
+import pytest
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock as mock
+
+from sockpuppet import columnar
+from sockpuppet.collector import SockPuppetCollector
+from sockpuppet.topk import SpaceSaving
+
+from test_collector import make_flow, make_tcp_flows, mock_module
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+CONFIG = """
+process_cache_ttl = 0
+engine = "%(engine)s"
+flow_definitions = [
+    {
+        "class": "ceph",
+        "top": %(top)s,
+        "flows": [
+            {
+                "flow": "ceph-osd-outbound",
+                "dst_port": "6800:7300",
+            },
+        ],
+    },
+]
+"""
+
+
+def make_sample(acked, rtt=None):
+    flows = []
+    for i, value in enumerate(acked):
+        flow = make_flow(dst="10.0.0.{}".format(i), dst_port=6800)
+        flow["inode"] = i + 1
+        flow["tcp_info"]["bytes_acked"] = value
+        if rtt is not None:
+            flow["tcp_info"]["rtt"] = rtt[i]
+        flows.append(flow)
+    return make_tcp_flows(flows)
+
+
+def rtt_series(collector, stats):
+    with mock.patch("sockpuppet.collector.get_socket_stats",
+                    return_value=stats):
+        families = dict((x.name, x) for x in collector.collect())
+    return dict((x.labels["dst"], x.value)
+                for x in families["sockpuppet_tcp_rtt"].samples)
+
+
+def make_collector(top, engine="python"):
+    return SockPuppetCollector(mock_module(
+        CONFIG % {"top": top, "engine": engine}))
+
+
+def test_space_saving_finds_heavy_hitters():
+    sketch = SpaceSaving(capacity=8)
+    items = [("heavy", 100)] * 50 + [("light{}".format(i), 1)
+                                     for i in range(1000)]
+    random.Random(1).shuffle(items)
+    for key, weight in items:
+        sketch.add(key, weight)
+    assert len(sketch.counters) == 8
+    assert sketch.top(1) == ["heavy"]
+    estimate, error = sketch.counters["heavy"]
+    assert estimate - error <= 5000 <= estimate
+
+
+def test_space_saving_decay():
+    sketch = SpaceSaving(capacity=2, decay=0.5)
+    sketch.add("a", 100)
+    sketch.add("b", 10)
+    for _ in range(4):
+        sketch.age()
+        sketch.add("b", 10)
+    assert sketch.top(1) == ["b"]
+    assert sketch.estimate("a") == 100 / 16.0
+    assert sketch.estimate("c") == 0
+
+
+@pytest.mark.parametrize("top", [
+    '{"by": "nope"}',
+    '{"by": "total_retrans"}',
+    '{"k": 0}',
+    '{"k": 4, "capacity": 2}',
+    '{"decay": 0}',
+])
+def test_invalid_top(top):
+    with pytest.raises(ValueError):
+        make_collector(top)
+
+
+def test_top_and_aggregate():
+    config = (CONFIG % {"top": '{"k": 1}', "engine": "python"}).replace(
+        '"top"', '"aggregate": {"labels": []}, "top"')
+    with pytest.raises(ValueError):
+        SockPuppetCollector(mock_module(config))
+
+
+@pytest.mark.parametrize("engine", [
+    "python",
+    pytest.param("columnar", marks=pytest.mark.skipif(
+        not columnar.available(), reason="NumPy is not installed")),
+])
+def test_top_sockets_by_bytes(engine):
+    collector = make_collector('{"k": 2, "gauge": "max"}', engine)
+    rtt = [1.0, 2.0, 3.0, 4.0, 5.0]
+    series = rtt_series(collector, make_sample([10, 500, 20, 400, 30], rtt))
+    assert series == {"10.0.0.1": 2.0, "10.0.0.3": 4.0, "other": 5.0}
+    # the ranking follows the traffic of the later samples
+    acked = [10, 500, 20, 400, 30]
+    for _ in range(4):
+        acked = [acked[0] + 1000, acked[1], acked[2] + 2000, acked[3],
+                 acked[4]]
+        series = rtt_series(collector, make_sample(acked, rtt))
+    assert series == {"10.0.0.0": 1.0, "10.0.0.2": 3.0, "other": 5.0}
+
+
+def test_top_sockets_by_gauge():
+    collector = make_collector('{"k": 1, "by": "rtt"}')
+    series = rtt_series(collector, make_sample([0, 0, 0], [1.0, 9.0, 2.0]))
+    assert series == {"10.0.0.1": 9.0, "other": 3.0}
+
+
+def test_top_sketch_survives_reload():
+    collector = make_collector('{"k": 1}')
+    rtt_series(collector, make_sample([10, 20]))
+    replacement = make_collector('{"k": 1, "decay": 1}')
+    replacement.inherit(collector)
+    assert replacement.top_sketches[0] is collector.top_sketches[0]
+    assert replacement.top_sketches[0].decay == 1
+    replacement = make_collector('{"k": 2}')
+    replacement.inherit(collector)
+    assert replacement.top_sketches == {}
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import socket
+import struct
+
+import pytest
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock as mock
+
+from sockpuppet import bytecode, netlink
+from sockpuppet.collector import SockPuppetCollector, find_flow
+from sockpuppet.matcher import FlowMatcher, PROTOCOL_UDP
+
+from test_collector import make_flow, make_tcp_flows, mock_module
+from test_netlink import make_attr, make_diag_msg
+
+__author__ = "Will Szumski"
+__copyright__ = "Will Szumski"
+__license__ = "apache"
+
+CONFIG = """
+process_cache_ttl = 0
+flow_definitions = [
+    {
+        "class": "vpn",
+        "flows": [
+            {"flow": "vpn-tcp", "src_port": %(port)d},
+            {"flow": "vpn-udp", "src_port": %(port)d, "protocol": "udp"},
+            {"flow": "dns", "dst_port": 53, "protocol": ["tcp", "udp"]},
+        ],
+    },
+]
+"""
+
+
+def make_udp_flow(src_port, **skmeminfo):
+    flow = make_flow(src_port=src_port)
+    del flow["tcp_info"]
+    flow["skmeminfo"] = dict((name, 0)
+                             for name in netlink.SK_MEMINFO_FIELDS)
+    flow["skmeminfo"].update(skmeminfo)
+    return flow
+
+
+def samples(collector, name):
+    for family in collector.collect():
+        if family.name == name:
+            return dict((x.labels["flow"], x.value) for x in family.samples)
+    return {}
+
+
+def test_protocol_selector():
+    definitions = mock_module(CONFIG % {"port": 1194}).flow_definitions
+    tcp = FlowMatcher(definitions)
+    udp = FlowMatcher(definitions, PROTOCOL_UDP)
+    for labels, tcp_flow, udp_flow in [
+            ({"src_port": 1194}, 0, 1),
+            ({"dst_port": 53}, 2, 2),
+            ({"src_port": 1}, None, None)]:
+        assert tcp.match_index(labels) == tcp_flow
+        assert udp.match_index(labels) == udp_flow
+        expected = udp.flows[udp_flow] if udp_flow is not None \
+            else (None, None)
+        assert find_flow(definitions, labels, PROTOCOL_UDP) == expected
+    with pytest.raises(ValueError):
+        FlowMatcher([{"class": "a", "flows": [{"flow": "b",
+                                               "protocol": "sctp"}]}])
+
+
+def test_udp_bytecode_only_has_udp_flows():
+    definitions = [{"class": "a", "flows": [
+        {"flow": "tcp", "dst_port": 80},
+        {"flow": "udp", "dst_port": 53, "protocol": "udp"},
+    ]}]
+    code = bytecode.compile_flow_definitions(definitions, PROTOCOL_UDP)
+    assert code == bytecode.compile_flow_definitions(
+        [{"class": "a", "flows": [{"flow": "udp", "dst_port": 53}]}])
+
+
+def test_decode_skmeminfo():
+    values = list(range(1, len(netlink.SK_MEMINFO_FIELDS) + 1))
+    attr = make_attr(netlink.INET_DIAG_SKMEMINFO,
+                     struct.pack("={}I".format(len(values)), *values))
+    flow = netlink.decode_inet_diag_msg(make_diag_msg(attrs=attr),
+                                        socket.IPPROTO_UDP)
+    assert flow["skmeminfo"]["rmem_alloc"] == 1
+    assert flow["skmeminfo"]["drops"] == len(values)
+    assert "tcp_info" not in flow
+    # older kernels send fewer fields
+    attr = make_attr(netlink.INET_DIAG_SKMEMINFO,
+                     struct.pack("=4I", 1, 2, 3, 4))
+    flow = netlink.decode_inet_diag_msg(make_diag_msg(attrs=attr),
+                                        socket.IPPROTO_UDP)
+    assert sorted(flow["skmeminfo"]) == sorted(
+        netlink.SK_MEMINFO_FIELDS[:4])
+
+
+def test_udp_disabled_without_udp_flows():
+    config = mock_module("""
+flow_definitions = [{"class": "a", "flows": [{"flow": "b"}]}]
+""")
+    collector = SockPuppetCollector(config)
+    assert not collector.context.udp
+
+
+def test_udp_metrics():
+    config = mock_module(CONFIG % {"port": 1194})
+    collector = SockPuppetCollector(config)
+    assert collector.context.udp
+    stats = make_tcp_flows([make_flow(src_port=1194)])
+    stats["UDP"] = {"flows": [make_udp_flow(1194, rmem_alloc=768, drops=3),
+                              make_udp_flow(1195, drops=1)]}
+    with mock.patch('sockpuppet.collector.get_socket_stats',
+                    return_value=stats):
+        assert samples(collector, "sockpuppet_udp_drops") == {"vpn-udp": 3}
+        assert samples(collector, "sockpuppet_udp_receive_queue_bytes") == \
+            {"vpn-udp": 768}
+        assert list(samples(collector, "sockpuppet_tcp_rtt")) == ["vpn-tcp"]
+
+
+def test_live_udp_drops():
+    try:
+        netlink.SockDiag().open().close()
+    except (IOError, OSError):
+        pytest.skip("NETLINK_SOCK_DIAG is not available")
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        receiver.bind(("127.0.0.1", 0))
+        port = receiver.getsockname()[1]
+        # fill the receive buffer until datagrams are dropped
+        for _ in range(64):
+            sender.sendto(b"x" * 1024, ("127.0.0.1", port))
+        collector = SockPuppetCollector(mock_module(CONFIG % {"port": port}))
+        assert collector.context.udp_bytecode is not None
+        assert samples(collector, "sockpuppet_udp_drops")["vpn-udp"] > 0
+        assert samples(collector, "sockpuppet_udp_receive_queue_bytes")[
+            "vpn-udp"] > 0
+    finally:
+        sender.close()
+        receiver.close()